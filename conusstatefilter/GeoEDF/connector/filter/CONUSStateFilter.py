@@ -3,12 +3,14 @@
 
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
+from GeoEDF.connector.helper import ShpCacheHelper
 
 import os
 from osgeo import gdal,ogr,osr
 
 """ Module for implementing the CONUSStateFilter. This is a straightforward filter that returns two char
-    state codes for all states in CONUS
+    state codes for all states in CONUS. The list of state codes is cached on disk (see ShpCacheHelper)
+    so repeat runs do not need to re-read the Tiger states shapefile.
 """
 
 class CONUSStateFilter(GeoEDFPlugin):
@@ -57,6 +59,12 @@ class CONUSStateFilter(GeoEDFPlugin):
         lonmin = -125
         lonmax = -65
 
+        # check the on-disk cache first
+        cached = ShpCacheHelper.getCached(self.__states_shapefile,'CONUSStateFilter')
+        if cached is not None:
+            self.values.extend(cached['states'])
+            return
+
         # load up the tiger lines shapefile;
         driver = ogr.GetDriverByName('ESRI Shapefile')
         inDataset = driver.Open(self.__states_shapefile, 0)
@@ -76,3 +84,6 @@ class CONUSStateFilter(GeoEDFPlugin):
                         self.values.append(state_code)
         except:
             raise GeoEDFError("Error processing Tiger states shapefile in CONUSStateFilter")
+
+        # save state codes and projection for future runs
+        ShpCacheHelper.putCached(self.__states_shapefile,'CONUSStateFilter',{'states':self.values,'srs':inLayer.GetSpatialRef().ExportToWkt()})
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+from contextlib import closing
+
+""" Helper module for maintaining a local cache of CUAHSI subsetter results shared across runs. The
+    bounding box of a set of HUC12 watersheds is cached indefinitely, since watershed boundaries
+    only change with a new WBD release. Finished subset bundles (the extracted domain data) are stored
+    in a directory addressed by a hash of the subsetter service, its version, and the sorted set of
+    HUC12 IDs, so the same watersheds requested in any order reuse the same bundle. An SQLite index
+    records the bounding boxes and bundles. Results are extracted into the caller's directory first
+    and then copied into the cache; cached files are read-only and are copied out on a hit, so that
+    changes to the caller's files never reach the cache. The total size of the cached bundles is
+    bounded; the least recently used bundles are evicted once it exceeds MAX_CACHE_BYTES. The cache
+    is an optimization only: if it cannot be used (e.g. an unwritable cache directory or a locked
+    index), the error is reported and the functions below behave as on a cache miss.
+"""
+
+# cache location can be overridden via the environment, e.g. to point to a shared scratch directory
+CACHE_DIR = os.environ.get('GEOEDF_CUAHSI_CACHE_DIR',os.path.expanduser('~/.cache/geoedf/cuahsi'))
+
+# maximum total size in bytes of the subset bundles retained in the cache
+MAX_CACHE_BYTES = int(os.environ.get('GEOEDF_CUAHSI_CACHE_BYTES',str(20*1024*1024*1024)))
+
+def connect():
+    """ opens (and if needed creates) the cache index
+    """
+    os.makedirs(os.path.join(CACHE_DIR,'bundles'),exist_ok=True)
+    conn = sqlite3.connect(os.path.join(CACHE_DIR,'index.db'),timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS bboxes (hucs TEXT PRIMARY KEY, bbox TEXT, fetched REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS bundles (key TEXT PRIMARY KEY, hucs TEXT, version TEXT, bytes INTEGER, created REAL, accessed REAL)')
+    return conn
+
+def hucSet(huc12_ids):
+    """ returns the canonical form of a set of HUC12 IDs: sorted, unique, comma separated
+    """
+    return ','.join(sorted(set(huc12_ids)))
+
+def bundleKey(huc12_ids, service, version):
+    """ constructs the content address of a subset bundle from the subsetter service,
+        its version, and the set of HUC12 IDs
+    """
+    return hashlib.sha256(('%s|%s|%s' % (service,version,hucSet(huc12_ids))).encode('utf-8')).hexdigest()
+
+def bundleDir(key):
+    return os.path.join(CACHE_DIR,'bundles',key)
+
+def lookupBbox(huc12_ids):
+    """ returns the cached bounding box of the set of HUC12 IDs, or None
+    """
+    try:
+        with closing(connect()) as conn:
+            row = conn.execute('SELECT bbox FROM bboxes WHERE hucs = ?',(hucSet(huc12_ids),)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+    except Exception as e:
+        print('Error reading the CUAHSI subset cache, continuing without it: %s' % e)
+        return None
+
+def saveBbox(huc12_ids, bbox):
+    try:
+        with closing(connect()) as conn:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO bboxes (hucs, bbox, fetched) VALUES (?,?,?)',
+                             (hucSet(huc12_ids),json.dumps(bbox),time.time()))
+    except Exception as e:
+        print('Error writing the CUAHSI subset cache, continuing without it: %s' % e)
+
+def copyFiles(src_root, names, destDir, mode=None):
+    """ copies the files with the given paths relative to src_root into destDir, preserving
+        their relative paths and optionally setting their permissions; returns the copied paths
+    """
+    copied = []
+    for name in names:
+        dest = os.path.join(destDir,name)
+        os.makedirs(os.path.dirname(dest),exist_ok=True)
+        if os.path.exists(dest):
+            os.remove(dest)
+        shutil.copyfile(os.path.join(src_root,name),dest)
+        if mode is not None:
+            os.chmod(dest,mode)
+        copied.append(dest)
+    return copied
+
+def bundleFiles(root):
+    """ returns the paths of the files under root, relative to root
+    """
+    return [os.path.relpath(os.path.join(dirpath,filename),root) for dirpath, dirs, files in os.walk(root) for filename in files]
+
+def copyBundle(key, destDir):
+    """ copies a cached bundle into destDir; returns the copied paths, or None if the
+        bundle is not in the cache or cannot be read
+    """
+    try:
+        with closing(connect()) as conn:
+            row = conn.execute('SELECT key FROM bundles WHERE key = ?',(key,)).fetchone()
+            if row is None or not os.path.isdir(bundleDir(key)):
+                return None
+            with conn:
+                conn.execute('UPDATE bundles SET accessed = ? WHERE key = ?',(time.time(),key))
+        return copyFiles(bundleDir(key),bundleFiles(bundleDir(key)),destDir)
+    except Exception as e:
+        print('Error reading the CUAHSI subset cache, continuing without it: %s' % e)
+        return None
+
+def storeBundle(key, huc12_ids, version, src_dir, names):
+    """ copies a bundle, the files with the given paths relative to src_dir, into the cache under key
+    """
+    tmp_dir = None
+    try:
+        os.makedirs(os.path.join(CACHE_DIR,'bundles'),exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=CACHE_DIR,prefix='.bundle.')
+        # cached files are read-only, they are only ever copied out
+        copyFiles(src_dir,names,tmp_dir,mode=0o444)
+        nbytes = sum(os.path.getsize(os.path.join(src_dir,name)) for name in names)
+
+        # rename into place so that concurrent runs never see a partial bundle
+        try:
+            os.rename(tmp_dir,bundleDir(key))
+            # a bundle missing from the index would never be evicted, remove it unless indexed
+            tmp_dir = bundleDir(key)
+        except OSError:
+            # another run stored the same bundle first
+            if not os.path.isdir(bundleDir(key)):
+                raise
+
+        with closing(connect()) as conn:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO bundles (key, hucs, version, bytes, created, accessed) VALUES (?,?,?,?,?,?)',
+                             (key,hucSet(huc12_ids),version,nbytes,time.time(),time.time()))
+        tmp_dir = None
+    except Exception as e:
+        print('Error writing the CUAHSI subset cache, continuing without it: %s' % e)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir,ignore_errors=True)
+
+def evict(keep):
+    """ removes least recently used bundles until the cache is within MAX_CACHE_BYTES;
+        bundles with keys in keep are never evicted
+    """
+    try:
+        evicted = []
+        with closing(connect()) as conn:
+            with conn:
+                total = conn.execute('SELECT COALESCE(SUM(bytes),0) FROM bundles').fetchone()[0]
+                for key, nbytes in conn.execute('SELECT key, bytes FROM bundles ORDER BY accessed ASC').fetchall():
+                    if total <= MAX_CACHE_BYTES:
+                        break
+                    if key in keep:
+                        continue
+                    conn.execute('DELETE FROM bundles WHERE key = ?',(key,))
+                    evicted.append(key)
+                    total -= nbytes
+        # bundles are only deleted once they are no longer in the index, and outside of
+        # the transaction so the index is not locked while deleting
+        for key in evicted:
+            shutil.rmtree(bundleDir(key),ignore_errors=True)
+    except Exception as e:
+        print('Error evicting from the CUAHSI subset cache: %s' % e)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import struct
+import zipfile
+import tempfile
+
+""" Helper module for extracting a ZIP archive while it is being downloaded. Members are read in
+    order from their local file headers and written directly into the destination directory as the
+    bytes arrive, without first storing the archive. This works for stored and deflated members,
+    including members whose sizes are only given in a trailing data descriptor if they are deflated.
+    Members that cannot be read this way (encrypted members, other compression methods, or stored
+    members of unknown size) require the central directory. From the first such member on, the rest
+    of the same stream is written to a temporary file at its original offset, leaving a sparse hole
+    in place of the members already extracted, and the remaining members are extracted with zipfile.
+"""
+
+# size of the blocks in which member data is copied
+BLOCK_SIZE = 1024*1024
+
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+
+class ChunkReader:
+    """ Reads exact numbers of bytes from an iterator of byte chunks; unread bytes can be
+        returned to the front of the stream. offset is the position in the stream of the next
+        byte to be read
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self, size):
+        """ reads up to size bytes; fewer are returned only at the end of the stream
+        """
+        while len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.offset += len(data)
+        return data
+
+    def readExact(self, size):
+        data = self.read(size)
+        if len(data) < size:
+            raise zipfile.BadZipFile('Unexpected end of ZIP stream')
+        return data
+
+    def readSome(self, size):
+        """ reads at most size bytes, whatever is buffered or the next chunk
+        """
+        if len(self.buffer) == 0:
+            self.buffer = next(self.chunks,b'')
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.offset += len(data)
+        return data
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+        self.offset -= len(data)
+
+def memberPath(out_dir, name):
+    """ returns the destination path of a member, refusing paths outside out_dir
+    """
+    path = os.path.realpath(os.path.join(out_dir,name))
+    if os.path.commonpath([path,os.path.realpath(out_dir)]) != os.path.realpath(out_dir):
+        raise zipfile.BadZipFile('Unsafe member path %s in ZIP stream' % name)
+    return path
+
+def zip64Sizes(extra, csize, usize):
+    """ returns the compressed and uncompressed sizes, taking them from the ZIP64 extra
+        field when the header holds the 0xFFFFFFFF placeholder, and whether the member
+        has a ZIP64 extra field
+    """
+    zip64 = False
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack('<HH',extra[pos:pos+4])
+        if tag == 0x0001:
+            zip64 = True
+            values = extra[pos+4:pos+4+length]
+            offset = 0
+            if usize == 0xFFFFFFFF:
+                usize = struct.unpack('<Q',values[offset:offset+8])[0]
+                offset += 8
+            if csize == 0xFFFFFFFF:
+                csize = struct.unpack('<Q',values[offset:offset+8])[0]
+            break
+        pos += 4 + length
+    return csize, usize, zip64
+
+def extractMember(reader, path, method, csize, descriptor):
+    """ writes the data of one member to path; returns its CRC-32 and uncompressed size
+    """
+    decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+    crc = 0
+    usize = 0
+
+    # write to a temp file first so an interrupted extraction never leaves a partial member
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd,'wb') as outFile:
+            if descriptor:
+                # compressed size is unknown, read until the end of the deflate stream
+                while not decompressor.eof:
+                    block = reader.readSome(BLOCK_SIZE)
+                    if len(block) == 0:
+                        raise zipfile.BadZipFile('Unexpected end of ZIP stream')
+                    data = decompressor.decompress(block)
+                    outFile.write(data)
+                    crc = zlib.crc32(data,crc)
+                    usize += len(data)
+                reader.unread(decompressor.unused_data)
+            else:
+                remaining = csize
+                while remaining > 0:
+                    block = reader.readExact(min(BLOCK_SIZE,remaining))
+                    remaining -= len(block)
+                    data = decompressor.decompress(block) if decompressor is not None else block
+                    outFile.write(data)
+                    crc = zlib.crc32(data,crc)
+                    usize += len(data)
+                if decompressor is not None:
+                    data = decompressor.flush()
+                    outFile.write(data)
+                    crc = zlib.crc32(data,crc)
+                    usize += len(data)
+        os.replace(tmp_path,path)
+        tmp_path = None
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return crc, usize
+
+def readDescriptor(reader, zip64):
+    """ reads the data descriptor following a member's data; returns the member's CRC-32
+    """
+    # optional signature, then CRC and sizes (8 byte sizes for ZIP64 members)
+    data = reader.readExact(4)
+    if struct.unpack('<I',data)[0] != DATA_DESCRIPTOR_SIGNATURE:
+        reader.unread(data)
+    crc = struct.unpack('<I',reader.readExact(4))[0]
+    reader.readExact(16 if zip64 else 8)
+    return crc
+
+def extractRemaining(reader, out_dir, offset):
+    """ extracts the members starting at offset in the stream with zipfile, once the stream has
+        been read up to offset; returns the list of extracted member names
+    """
+    with tempfile.TemporaryFile(dir=out_dir) as spool:
+        # the members before offset are already extracted, leave a hole in their place
+        spool.seek(offset)
+        while True:
+            block = reader.readSome(BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            spool.write(block)
+        spool.seek(0)
+        with zipfile.ZipFile(spool,'r') as zip_ref:
+            members = [info for info in zip_ref.infolist() if info.header_offset >= offset]
+            for info in members:
+                memberPath(out_dir,info.filename)
+            zip_ref.extractall(out_dir,members)
+            return [info.filename for info in members]
+
+def extractStream(chunks, out_dir):
+    """ extracts the ZIP archive arriving as an iterator of byte chunks into out_dir;
+        returns the list of extracted member names
+    """
+    reader = ChunkReader(chunks)
+    extracted = []
+
+    while True:
+        offset = reader.offset
+        signature = reader.read(4)
+        if len(signature) < 4:
+            raise zipfile.BadZipFile('Unexpected end of ZIP stream')
+        signature = struct.unpack('<I',signature)[0]
+        if signature == CENTRAL_HEADER_SIGNATURE:
+            # all members have been read, the rest of the stream is the central directory
+            break
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile('Invalid local file header in ZIP stream')
+
+        header = reader.readExact(26)
+        (version, flags, method, mtime, mdate, crc, csize, usize,
+         name_len, extra_len) = struct.unpack('<HHHHHIIIHH',header)
+        name_bytes = reader.readExact(name_len)
+        name = name_bytes.decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.readExact(extra_len)
+        csize, usize, zip64 = zip64Sizes(extra,csize,usize)
+        descriptor = bool(flags & 0x8)
+
+        path = memberPath(out_dir,name)
+        if name.endswith('/'):
+            # directory entries have no data
+            os.makedirs(path,exist_ok=True)
+            if descriptor:
+                readDescriptor(reader,zip64)
+            continue
+
+        if flags & 0x1 or method not in (zipfile.ZIP_STORED,zipfile.ZIP_DEFLATED) or \
+           (descriptor and method == zipfile.ZIP_STORED):
+            # this member needs the central directory, extract it and all following members
+            # from the rest of the stream
+            reader.unread(struct.pack('<I',signature) + header + name_bytes + extra)
+            return extracted + extractRemaining(reader,out_dir,offset)
+
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+
+        actual_crc, _ = extractMember(reader,path,method,csize,descriptor)
+
+        if descriptor:
+            crc = readDescriptor(reader,zip64)
+
+        if actual_crc != crc:
+            os.remove(path)
+            raise zipfile.BadZipFile('CRC check failed for member %s in ZIP stream' % name)
+        extracted.append(name)
+
+    # drain the central directory so the connection can be reused
+    while len(reader.readSome(BLOCK_SIZE)) > 0:
+        pass
+    return extracted
@@ -6,25 +6,53 @@ from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 
 import os
 import requests
-import zipfile
 import time
-import shutil
 import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from GeoEDF.connector.helper import ZipStreamHelper, SubsetCacheHelper
 
 """ Module for implementing the CUAHSISubsetterInput connector. This accepts a HUC12 ID
     as input and submits a request to the CUAHSI subsetter to fetch domain data for this HUC12
-    watershed.
+    watershed. The huc12_id parameter can also be a list of groups (lists) of HUC12 IDs, in which
+    case a subsetter job is submitted for every group at once. The jobs are polled concurrently
+    with an exponential backoff, and each job's result is downloaded into its own subdirectory
+    as soon as that job finishes. Results are unzipped while they are being downloaded, without
+    first writing the ZIP file to disk. HUC12 bounding boxes and finished subset results are cached
+    locally (see SubsetCacheHelper), so a repeated request for the same set of HUC12 IDs is served
+    without submitting a subsetter job.
 """
 
 class CUAHSISubsetterInput(GeoEDFPlugin):
     __optional_params = []
     __required_params = ['huc12_id']
 
+    # CUAHSI subsetter service
+    __subsetter_url = 'https://subset.cuahsi.org'
+
+    # version of the subsetter API; cached results are only reused for the same version
+    __subsetter_version = 'v2_0'
+
+    # initial and maximum number of seconds between job status queries
+    __min_poll_interval = 1
+    __max_poll_interval = 10
+
+    # number of seconds to wait for a job to finish before assuming it failed
+    __max_wait = 1000
+
+    # maximum number of concurrent requests to the subsetter
+    __max_workers = 8
+
+    # (connect, read) timeouts in seconds for subsetter requests; a request that hangs
+    # would otherwise hold up the job past __max_wait
+    __request_timeout = (10,120)
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFPlugin super class
     def __init__(self, **kwargs):
 
-        # list to hold all the parameter names; will be accessed in super to 
+        # list to hold all the parameter names; will be accessed in super to
         # construct dependency graph
         self.provided_params = self.__required_params + self.__optional_params
 
@@ -44,86 +72,159 @@ class CUAHSISubsetterInput(GeoEDFPlugin):
 
         # class super class init
         super().__init__()
-        
+
+    # split the huc12_id parameter into groups of HUC12 IDs, one subsetter job per group
+    # a string is a comma separated list of IDs, a list of IDs is a single group, and
+    # a list of lists is a list of groups
+    def huc12_groups(self):
+        if isinstance(self.huc12_id,str):
+            return [self.huc12_id.split(',')]
+        if isinstance(self.huc12_id,(list,tuple)) and any(isinstance(group,(list,tuple)) for group in self.huc12_id):
+            return [[str(i) for i in group] if isinstance(group,(list,tuple)) else [str(group)] for group in self.huc12_id]
+        return [[str(i) for i in self.huc12_id]]
+
     # get the extents of the HUC12 watershed given a HUC12 ID
-    def get_huc12_extent(self):
+    # bounding boxes are cached since watershed boundaries rarely change
+    def get_huc12_extent(self,huc12_ids):
+
+        bbox = SubsetCacheHelper.lookupBbox(huc12_ids)
+        if bbox is not None:
+            return bbox
 
         try:
-            str_huc12_id = ','.join([str(i) for i in self.huc12_id])
-            gethucbbox_url = "https://subset.cuahsi.org/wbd/gethucbbox/lcc?hucID={}".format(str_huc12_id)
+            str_huc12_id = ','.join(huc12_ids)
+            gethucbbox_url = "{}/wbd/gethucbbox/lcc?hucID={}".format(self.__subsetter_url,str_huc12_id)
 
-            res = requests.get(gethucbbox_url)
+            res = requests.get(gethucbbox_url,timeout=self.__request_timeout)
             res.raise_for_status()
             gethubbox_res_json = res.json()
 
-            return gethubbox_res_json["bbox"]        
+            bbox = gethubbox_res_json["bbox"]
         except:
-            raise GeoEDFError('Error occurred in retrieving bounds for given HUC12 ID: %s' % self.huc12_id)
+            raise GeoEDFError('Error occurred in retrieving bounds for given HUC12 ID: %s' % ','.join(huc12_ids))
 
-    # each Connector plugin needs to implement this method
-    # if error, raise exception
-    # assume this method is called only when all params have been fully instantiated
-    def get(self):
-        
-        uid = None
-        
+        SubsetCacheHelper.saveBbox(huc12_ids,bbox)
+        return bbox
+
+    # submit a subsetter job for a group of HUC12 IDs; returns the job identifier
+    def submit_job(self,huc12_ids):
+
+        # first get the bounds for the huc12 IDs
+        west, south, east, north = self.get_huc12_extent(huc12_ids)
+
+        # next run the subsetter for these extents
+        submit_url = f'{self.__subsetter_url}/nwm/{self.__subsetter_version}/subset?' + \
+                     f'llat={south}&llon={west}&ulat={north}&ulon={east}&' + \
+                     f'hucs={",".join(huc12_ids)}'
+
+        res = requests.get(submit_url,timeout=self.__request_timeout)
+        res.raise_for_status()
+
+        # grab the job identifier
+        return res.url.split('jobid=')[-1]
+
+    # query the status of a subsetter job
+    def job_status(self,uid):
+        status_url = f'{self.__subsetter_url}/jobs/{uid}'
+        res = requests.get(status_url,timeout=self.__request_timeout)
+        res.raise_for_status()
+        return json.loads(res.text)['status']
+
+    # download the result of a finished job and unzip it into out_dir as it arrives
+    # returns the names of the extracted members
+    def download_result(self,uid,out_dir):
+        dl_url = f'{self.__subsetter_url}/download-zip/{uid}'
         try:
-            # first get the bounds for the huc12 ID
-            west, south, east, north = self.get_huc12_extent()
-            
-            # next run the subsetter for these extents
-            submit_url = f'https://subset.cuahsi.org/nwm/v2_0/subset?' + \
-                         f'llat={south}&llon={west}&ulat={north}&ulon={east}&' + \
-                         f'hucs={",".join([str(i) for i in self.huc12_id])}'
-            
-
-            res = requests.get(submit_url)
-            res.raise_for_status()
+            with requests.get(dl_url,stream=True,timeout=self.__request_timeout) as r:
+                r.raise_for_status()
+                try:
+                    return ZipStreamHelper.extractStream(r.iter_content(chunk_size=ZipStreamHelper.BLOCK_SIZE),out_dir)
+                except (requests.exceptions.RequestException,IOError):
+                    raise
+                except:
+                    raise GeoEDFError('Error occurred when unzipping domain data in CUAHSISubsetterInput connector')
+        except GeoEDFError:
+            raise
+        except:
+            raise GeoEDFError('Error occurred downloading CUAHSI subsetter result')
+
+    # the cache key of the subset result for a group of HUC12 IDs
+    def result_key(self,huc12_ids):
+        return SubsetCacheHelper.bundleKey(huc12_ids,self.__subsetter_url,self.__subsetter_version)
 
-            # grab the job identifier
-            uid = res.url.split('jobid=')[-1]
+    # download the result of a finished job into out_dir and store a copy in the cache
+    def fetch_result(self,uid,huc12_ids,out_dir):
+        names = self.download_result(uid,out_dir)
+        files = [name for name in names if not name.endswith('/')]
+        SubsetCacheHelper.storeBundle(self.result_key(huc12_ids),huc12_ids,self.__subsetter_version,out_dir,files)
 
-            # query job status
-            status_url = f'https://subset.cuahsi.org/jobs/{uid}'
+    # run the subsetter for a group of HUC12 IDs: use the cached result if there is one, otherwise
+    # submit the job, poll its status with exponential backoff, and download the result once finished;
+    # blocking requests are run in the executor
+    async def run_job(self,loop,executor,huc12_ids,out_dir):
+        huc12_str = ','.join(huc12_ids)
 
-            attempt = 0
-            max_attempts = 100
+        cached = await loop.run_in_executor(executor,SubsetCacheHelper.copyBundle,self.result_key(huc12_ids),out_dir)
+        if cached is not None:
+            print("using cached domain files for HUC12 %s" % huc12_str)
+            return
 
+        try:
+            uid = await loop.run_in_executor(executor,self.submit_job,huc12_ids)
+
+            interval = self.__min_poll_interval
+            deadline = time.time() + self.__max_wait
             status = None
-            
-            while attempt < max_attempts:
-                print("subsetting domain files" + ".." * (attempt+1))
-                res = requests.get(status_url)
-                res.raise_for_status()
-                status = json.loads(res.text)['status']
-                if status == 'finished':
-                    print("downloading...")
+
+            while True:
+                status = await loop.run_in_executor(executor,self.job_status,uid)
+                print("subsetting domain files for HUC12 %s: %s" % (huc12_str,status))
+                if status == 'finished' or time.time() >= deadline:
                     break
-                attempt += 1
-                time.sleep(10)
-                
+                await asyncio.sleep(interval)
+                interval = min(interval * 2,self.__max_poll_interval)
+
             if status != 'finished':
                 raise GeoEDFError('Could not determine if CUAHSI subsetter completed execution, assume job failed')
-                
+
         except:
-            raise GeoEDFError('Error occurred running the CUAHSI subsetter for the HUC12 watershed: ',self.huc12_id)
-    
-        try:
-            # download the result
-            dl_url = f'https://subset.cuahsi.org/download-zip/{uid}'
-            local_filename = f'{uid}.zip'
-            local_filepath = '%s/%s' % (self.target_path,local_filename)
-            with requests.get(dl_url, stream=True) as r:
-                with open(local_filepath, 'wb') as f:
-                    shutil.copyfileobj(r.raw, f)
-        except: 
-            raise GeoEDFError('Error occurred downloading CUAHSI subsetter result')
-            
+            raise GeoEDFError('Error occurred running the CUAHSI subsetter for the HUC12 watershed: %s' % huc12_str)
+
+        print("downloading %s..." % huc12_str)
+        await loop.run_in_executor(executor,self.fetch_result,uid,huc12_ids,out_dir)
+
+    # run the jobs for all groups concurrently; returns the outcome (None or an exception) per group
+    async def run_jobs(self,loop,executor,groups,out_dirs):
+        return await asyncio.gather(*[self.run_job(loop,executor,group,out_dir) for group, out_dir in zip(groups,out_dirs)],return_exceptions=True)
+
+    # each Connector plugin needs to implement this method
+    # if error, raise exception
+    # assume this method is called only when all params have been fully instantiated
+    def get(self):
+
+        groups = self.huc12_groups()
+
+        # a single group is extracted directly into the target path, multiple groups
+        # are each extracted into a subdirectory named for the group's HUC12 IDs
+        if len(groups) == 1:
+            out_dirs = [self.target_path]
+        else:
+            out_dirs = ['%s/%s' % (self.target_path,'_'.join(group)) for group in groups]
+            for out_dir in out_dirs:
+                os.makedirs(out_dir,exist_ok=True)
+
+        loop = asyncio.new_event_loop()
         try:
-            # unzip the domain data in the target folder and delete the zip
-            if os.path.exists(local_filepath):
-                with zipfile.ZipFile(local_filepath, 'r') as zip_ref:
-                    zip_ref.extractall(self.target_path)
-                os.remove(local_filepath)
-        except:
-            raise GeoEDFError('Error occurred when unzipping domain data in CUAHSISubsetterInput connector')
+            with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+                outcomes = loop.run_until_complete(self.run_jobs(loop,executor,groups,out_dirs))
+        finally:
+            loop.close()
+
+        # bound the size of the cache, keeping the results used in this run
+        SubsetCacheHelper.evict(set(self.result_key(group) for group in groups))
+
+        errors = [outcome for outcome in outcomes if outcome is not None]
+        if len(errors) == 1:
+            raise errors[0]
+        if len(errors) > 1:
+            raise GeoEDFError('Errors occurred running the CUAHSI subsetter: %s' % '; '.join(str(error) for error in errors))
@@ -1,7 +1,7 @@
 from setuptools import setup, find_packages
 
 setup(name='cuahsisubsetterinput',
-      version='0.3',
+      version='0.4',
       description='Connector for running the CUAHSI subsetter for a given (list of) HUC12 IDs',
       url='http://github.com/geoedf/cuahsisubsetterinput',
       author='Rajesh Kalyanam',
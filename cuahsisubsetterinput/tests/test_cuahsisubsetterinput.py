@@ -0,0 +1,142 @@
+import json
+import os
+import zipfile
+
+import pytest
+import requests
+
+pytest.importorskip('geoedfframework')
+
+from GeoEDF.connector.helper import SubsetCacheHelper
+from GeoEDF.connector.input.CUAHSISubsetterInput import CUAHSISubsetterInput
+
+# run from the cuahsisubsetterinput directory with: python -m pytest tests
+
+def groups(huc12_id):
+    return CUAHSISubsetterInput(huc12_id=huc12_id).huc12_groups()
+
+def test_groups_from_string():
+    assert groups('020200030604') == [['020200030604']]
+    assert groups('020200030604,020200030605') == [['020200030604','020200030605']]
+
+def test_groups_from_list_of_ids():
+    assert groups(['020200030604','020200030605']) == [['020200030604','020200030605']]
+    # numeric IDs are converted to strings
+    assert groups([20200030604]) == [['20200030604']]
+
+def test_groups_from_list_of_groups():
+    assert groups([['020200030604','020200030605'],['020200030606']]) == [['020200030604','020200030605'],['020200030606']]
+    # a bare ID alongside groups is a group of its own
+    assert groups([['020200030604','020200030605'],'020200030606']) == [['020200030604','020200030605'],['020200030606']]
+
+class Response:
+    def __init__(self, url, payload):
+        self.url = url
+        self.payload = payload
+        self.text = json.dumps(payload)
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+def test_requests_time_out(monkeypatch):
+    timeouts = []
+    def get(url, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        if '/wbd/gethucbbox/' in url:
+            return Response(url,{'bbox': [1,2,3,4]})
+        if '/subset?' in url:
+            return Response(url + '&jobid=abc',None)
+        return Response(url,{'status': 'finished'})
+    monkeypatch.setattr(requests,'get',get)
+    monkeypatch.setattr(SubsetCacheHelper,'lookupBbox',lambda huc12_ids: None)
+    monkeypatch.setattr(SubsetCacheHelper,'saveBbox',lambda huc12_ids, bbox: None)
+
+    plugin = CUAHSISubsetterInput(huc12_id='020200030604')
+    assert plugin.submit_job(['020200030604']) == 'abc'
+    assert plugin.job_status('abc') == 'finished'
+    assert len(timeouts) == 3
+    assert all(timeout is not None for timeout in timeouts)
+
+def test_hanging_request_fails_job(monkeypatch):
+    def get(url, timeout=None, **kwargs):
+        raise requests.exceptions.ReadTimeout()
+    monkeypatch.setattr(requests,'get',get)
+    monkeypatch.setattr(SubsetCacheHelper,'lookupBbox',lambda huc12_ids: None)
+    plugin = CUAHSISubsetterInput(huc12_id='020200030604')
+    with pytest.raises(Exception,match='020200030604'):
+        plugin.get_huc12_extent(['020200030604'])
+
+class ZipResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        return (self.data[start:start+chunk_size] for start in range(0,len(self.data),chunk_size))
+
+def test_download_result_reads_archive_once(monkeypatch, tmp_path):
+    from test_zipstreamhelper import Unseekable
+    out = Unseekable()
+    with zipfile.ZipFile(out,'w') as zip_ref:
+        zip_ref.writestr('a.txt',b'a' * 1000,compress_type=zipfile.ZIP_DEFLATED)
+        # stored with a data descriptor, needs the central directory
+        zip_ref.writestr('b.txt',b'b' * 1000,compress_type=zipfile.ZIP_STORED)
+    urls = []
+    def get(url, **kwargs):
+        urls.append(url)
+        return ZipResponse(bytes(out.data))
+    monkeypatch.setattr(requests,'get',get)
+    CUAHSISubsetterInput(huc12_id='020200030604').download_result('abc',str(tmp_path))
+    assert len(urls) == 1
+    assert sorted(os.listdir(str(tmp_path))) == ['a.txt','b.txt']
+
+def fake_subsetter(monkeypatch, plugin, data):
+    """ replaces the subsetter jobs by a job that finishes immediately with the given files;
+        returns the list of submitted groups """
+    submitted = []
+    def submit_job(huc12_ids):
+        submitted.append(huc12_ids)
+        return 'abc'
+    def download_result(uid, out_dir):
+        with open(os.path.join(out_dir,'domain.nc'),'wb') as result_file:
+            result_file.write(data)
+        return ['domain.nc']
+    monkeypatch.setattr(plugin,'submit_job',submit_job)
+    monkeypatch.setattr(plugin,'job_status',lambda uid: 'finished')
+    monkeypatch.setattr(plugin,'download_result',download_result)
+    return submitted
+
+def run(monkeypatch, tmp_path, name, data=b'domain'):
+    plugin = CUAHSISubsetterInput(huc12_id='020200030604')
+    plugin.target_path = str(tmp_path / name)
+    os.makedirs(plugin.target_path)
+    submitted = fake_subsetter(monkeypatch,plugin,data)
+    plugin.get()
+    with open(os.path.join(plugin.target_path,'domain.nc'),'rb') as result_file:
+        return submitted, result_file.read()
+
+def test_result_cached_and_copied(monkeypatch, tmp_path):
+    monkeypatch.setattr(SubsetCacheHelper,'CACHE_DIR',str(tmp_path / 'cache'))
+    assert run(monkeypatch,tmp_path,'first') == ([['020200030604']],b'domain')
+    # changing the first run's result does not change the cached result
+    with open(str(tmp_path / 'first' / 'domain.nc'),'wb') as result_file:
+        result_file.write(b'changed')
+    assert run(monkeypatch,tmp_path,'second',data=b'not used') == ([],b'domain')
+
+def test_unusable_cache_runs_uncached(monkeypatch, tmp_path):
+    blocker = tmp_path / 'blocker'
+    blocker.write_bytes(b'')
+    monkeypatch.setattr(SubsetCacheHelper,'CACHE_DIR',str(blocker / 'cache'))
+    assert run(monkeypatch,tmp_path,'first') == ([['020200030604']],b'domain')
+    assert run(monkeypatch,tmp_path,'second') == ([['020200030604']],b'domain')
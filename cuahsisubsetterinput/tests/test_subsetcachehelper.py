@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import stat
+
+import pytest
+
+from GeoEDF.connector.helper import SubsetCacheHelper
+
+# run from the cuahsisubsetterinput directory with: python -m pytest tests
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setattr(SubsetCacheHelper,'CACHE_DIR',cache_dir)
+    return cache_dir
+
+def make_result(root, files):
+    for name, data in files.items():
+        path = os.path.join(str(root),name)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'wb') as result_file:
+            result_file.write(data)
+    return sorted(files)
+
+def read(path):
+    with open(path,'rb') as result_file:
+        return result_file.read()
+
+def test_bbox_round_trip(cache_dir):
+    assert SubsetCacheHelper.lookupBbox(['02','01']) is None
+    SubsetCacheHelper.saveBbox(['02','01'],[1,2,3,4])
+    assert SubsetCacheHelper.lookupBbox(['01','02','01']) == [1,2,3,4]
+
+def test_bundle_is_copied_not_linked(cache_dir, tmp_path):
+    out_dir = tmp_path / 'out'
+    names = make_result(out_dir,{'a.txt': b'a','Domain/b.nc': b'b' * 100})
+    key = SubsetCacheHelper.bundleKey(['01'],'service','v1')
+    SubsetCacheHelper.storeBundle(key,['01'],'v1',str(out_dir),names)
+
+    cached = os.path.join(SubsetCacheHelper.bundleDir(key),'a.txt')
+    assert not os.stat(cached).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    assert os.stat(cached).st_ino != os.stat(str(out_dir / 'a.txt')).st_ino
+
+    # changing the result in place does not change the cache
+    with open(str(out_dir / 'a.txt'),'wb') as result_file:
+        result_file.write(b'changed')
+
+    hit_dir = tmp_path / 'hit'
+    copied = SubsetCacheHelper.copyBundle(key,str(hit_dir))
+    assert sorted(os.path.relpath(path,str(hit_dir)) for path in copied) == names
+    assert read(str(hit_dir / 'a.txt')) == b'a'
+    assert read(str(hit_dir / 'Domain' / 'b.nc')) == b'b' * 100
+    # the copy can be modified
+    with open(str(hit_dir / 'a.txt'),'wb') as result_file:
+        result_file.write(b'changed')
+    assert read(cached) == b'a'
+
+def test_missing_bundle(cache_dir, tmp_path):
+    assert SubsetCacheHelper.copyBundle(SubsetCacheHelper.bundleKey(['01'],'service','v1'),str(tmp_path)) is None
+
+def test_unusable_cache_behaves_as_miss(tmp_path, monkeypatch, capsys):
+    # the cache directory cannot be created below a regular file
+    blocker = tmp_path / 'blocker'
+    blocker.write_bytes(b'')
+    monkeypatch.setattr(SubsetCacheHelper,'CACHE_DIR',str(blocker / 'cache'))
+    names = make_result(tmp_path / 'out',{'a.txt': b'a'})
+    key = SubsetCacheHelper.bundleKey(['01'],'service','v1')
+
+    assert SubsetCacheHelper.lookupBbox(['01']) is None
+    SubsetCacheHelper.saveBbox(['01'],[1,2,3,4])
+    SubsetCacheHelper.storeBundle(key,['01'],'v1',str(tmp_path / 'out'),names)
+    assert SubsetCacheHelper.copyBundle(key,str(tmp_path / 'hit')) is None
+    SubsetCacheHelper.evict(set())
+    assert 'CUAHSI subset cache' in capsys.readouterr().out
+    # the result itself is untouched
+    assert read(str(tmp_path / 'out' / 'a.txt')) == b'a'
+
+def test_locked_index_behaves_as_miss(cache_dir, tmp_path, monkeypatch):
+    names = make_result(tmp_path / 'out',{'a.txt': b'a'})
+    key = SubsetCacheHelper.bundleKey(['01'],'service','v1')
+    SubsetCacheHelper.storeBundle(key,['01'],'v1',str(tmp_path / 'out'),names)
+
+    def locked():
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(SubsetCacheHelper,'connect',locked)
+    assert SubsetCacheHelper.copyBundle(key,str(tmp_path / 'hit')) is None
+    assert SubsetCacheHelper.lookupBbox(['01']) is None
+    SubsetCacheHelper.storeBundle(SubsetCacheHelper.bundleKey(['02'],'service','v1'),['02'],'v1',str(tmp_path / 'out'),names)
+    SubsetCacheHelper.evict(set())
+    # no partial bundle is left behind
+    assert sorted(os.listdir(os.path.join(cache_dir,'bundles'))) == [key]
+
+def test_evict_least_recently_used(cache_dir, tmp_path, monkeypatch):
+    keys = []
+    for i in range(4):
+        names = make_result(tmp_path / ('out%d' % i),{'a.txt': b'x' * 100})
+        keys.append(SubsetCacheHelper.bundleKey([str(i)],'service','v1'))
+        SubsetCacheHelper.storeBundle(keys[-1],[str(i)],'v1',str(tmp_path / ('out%d' % i)),names)
+    # the first bundle is used again, the second is kept by the caller
+    SubsetCacheHelper.copyBundle(keys[0],str(tmp_path / 'hit'))
+    monkeypatch.setattr(SubsetCacheHelper,'MAX_CACHE_BYTES',200)
+
+    # bundles are deleted only after the index no longer lists them
+    rmtree = SubsetCacheHelper.shutil.rmtree
+    def check_rmtree(path, **kwargs):
+        with sqlite3.connect(os.path.join(cache_dir,'index.db'),timeout=0) as conn:
+            assert conn.execute('SELECT COUNT(*) FROM bundles WHERE key = ?',(os.path.basename(path),)).fetchone()[0] == 0
+            # the index is not locked while deleting
+            conn.execute('UPDATE bundles SET accessed = accessed')
+        rmtree(path,**kwargs)
+    monkeypatch.setattr(SubsetCacheHelper.shutil,'rmtree',check_rmtree)
+
+    SubsetCacheHelper.evict({keys[1]})
+    remaining = sorted(os.listdir(os.path.join(cache_dir,'bundles')))
+    assert remaining == sorted([keys[0],keys[1]])
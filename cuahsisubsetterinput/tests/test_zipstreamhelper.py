@@ -0,0 +1,100 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from GeoEDF.connector.helper import ZipStreamHelper
+
+# run from the cuahsisubsetterinput directory with: python -m pytest tests
+
+class Unseekable(io.RawIOBase):
+    """ write only stream, zipfile writes data descriptors for members written to it """
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+def archive(members, seekable=True):
+    """ builds a ZIP archive of (name, data, compression) members """
+    out = io.BytesIO() if seekable else Unseekable()
+    with zipfile.ZipFile(out,'w') as zip_ref:
+        for name, data, compression in members:
+            zip_ref.writestr(name,data,compress_type=compression)
+    return bytes(out.getvalue() if seekable else out.data)
+
+def chunks(data, size=7):
+    return [data[start:start+size] for start in range(0,len(data),size)]
+
+def local_flags(data, name):
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_ref:
+        return zip_ref.getinfo(name).flag_bits
+
+DATA = os.urandom(5000) + b'domain' * 3000
+
+def read(out_dir, name):
+    with open(os.path.join(str(out_dir),name),'rb') as member:
+        return member.read()
+
+def test_deflated_with_data_descriptor(tmp_path):
+    data = archive([('Domain/geo.nc',DATA,zipfile.ZIP_DEFLATED),('Domain/empty.txt',b'',zipfile.ZIP_DEFLATED)],seekable=False)
+    assert local_flags(data,'Domain/geo.nc') & 0x8
+    assert ZipStreamHelper.extractStream(chunks(data),str(tmp_path)) == ['Domain/geo.nc','Domain/empty.txt']
+    assert read(tmp_path,'Domain/geo.nc') == DATA
+    assert read(tmp_path,'Domain/empty.txt') == b''
+
+def test_stored_and_deflated_with_sizes(tmp_path):
+    data = archive([('a.txt',DATA,zipfile.ZIP_STORED),('dir/',b'',zipfile.ZIP_STORED),('dir/b.txt',DATA[::-1],zipfile.ZIP_DEFLATED)])
+    assert not local_flags(data,'a.txt') & 0x8
+    assert ZipStreamHelper.extractStream(chunks(data,size=1000),str(tmp_path)) == ['a.txt','dir/b.txt']
+    assert read(tmp_path,'a.txt') == DATA
+    assert read(tmp_path,'dir/b.txt') == DATA[::-1]
+
+def test_path_traversal_is_refused(tmp_path):
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    data = archive([('../evil.txt',b'evil',zipfile.ZIP_STORED)])
+    with pytest.raises(zipfile.BadZipFile):
+        ZipStreamHelper.extractStream(chunks(data),str(out_dir))
+    assert not (tmp_path / 'evil.txt').exists()
+
+def test_crc_mismatch(tmp_path):
+    data = bytearray(archive([('a.txt',DATA,zipfile.ZIP_STORED)]))
+    pos = bytes(data).index(DATA[:100]) + 50
+    data[pos] ^= 0xFF
+    with pytest.raises(zipfile.BadZipFile):
+        ZipStreamHelper.extractStream(chunks(bytes(data)),str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+
+def test_truncated_stream(tmp_path):
+    data = archive([('a.txt',DATA,zipfile.ZIP_DEFLATED)])
+    with pytest.raises(zipfile.BadZipFile):
+        ZipStreamHelper.extractStream(chunks(data[:len(data)//2]),str(tmp_path))
+
+def test_unstreamable_member_falls_back_on_same_stream(tmp_path):
+    # a stored member with a data descriptor has no size in its local header
+    data = archive([('a.txt',DATA,zipfile.ZIP_DEFLATED),('b.txt',DATA[::-1],zipfile.ZIP_STORED),('c.txt',b'last',zipfile.ZIP_DEFLATED)],seekable=False)
+    assert local_flags(data,'b.txt') & 0x8
+
+    consumed = []
+    def stream():
+        for chunk in chunks(data,size=999):
+            consumed.append(chunk)
+            yield chunk
+        # the stream has been read to its end, a member extracted before the fallback
+        # must not be written again
+        with open(os.path.join(str(tmp_path),'a.txt'),'wb') as member:
+            member.write(b'streamed')
+
+    assert ZipStreamHelper.extractStream(stream(),str(tmp_path)) == ['a.txt','b.txt','c.txt']
+    assert b''.join(consumed) == data
+    assert read(tmp_path,'a.txt') == b'streamed'
+    assert read(tmp_path,'b.txt') == DATA[::-1]
+    assert read(tmp_path,'c.txt') == b'last'
+    # no spooled archive is left behind
+    assert sorted(os.listdir(str(tmp_path))) == ['a.txt','b.txt','c.txt']
@@ -3,20 +3,27 @@
 
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
+from GeoEDF.connector.helper import ShpCacheHelper
+from GeoEDF.connector.helper import DamCatalogHelper
 
 import os
+import numpy as np
 from osgeo import gdal,ogr,osr
-import requests
-import json
 
 """ Module for implementing the DamFilter. This is a straightforward filter that takes either
-    a shapefile (path) as input or a tuple of latmin,latmax,lonmin,lonmax extents to find 
-    all national dams that fall within that extent. The shapefile is reprojected to EPSG:4326 
-    to determine the lat-lon extent before querying for dams.
+    a shapefile (path) as input, a tuple of latmin,latmax,lonmin,lonmax extents, or a lat,lon point
+    and a radius in km to find all national dams that fall within that polygon, extent, or distance
+    of the point. For polygon shapefiles, the polygons are reprojected to EPSG:4326 and dams are tested
+    for true containment in these polygons (not just their bounding box); for other geometry types
+    (points, lines) the dams in the shapefile's bounding box are returned. The reprojected polygons or
+    extent are cached on disk (see ShpCacheHelper) so repeat runs on an unchanged shapefile do not need
+    to open it with GDAL.
+    The national dam catalog is also kept locally in an indexed columnar form (see DamCatalogHelper)
+    and only refreshed when stale, so each query is an in-memory lookup rather than a full download.
 """
 
 class DamFilter(GeoEDFPlugin):
-    __optional_params = ['shapefile','extent']
+    __optional_params = ['shapefile','extent','point','radius']
     __required_params = []
 
     # we use just kwargs since we need to be able to process the list of attributes
@@ -41,10 +48,14 @@ class DamFilter(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
             
-        # check if neither of the optional params have been provided
-        # note that shapefile takes precedence
-        if self.shapefile is None and self.extent is None:
-            raise GeoEDFError('Either a shapefile path or extent needs to be provided for DamFilter')
+        # point and radius need to be provided together
+        if (self.point is None) != (self.radius is None):
+            raise GeoEDFError('Both a point and radius need to be provided for a radius query in DamFilter')
+
+        # check if none of the optional params have been provided
+        # note that shapefile takes precedence, followed by point and radius
+        if self.shapefile is None and self.extent is None and self.point is None:
+            raise GeoEDFError('Either a shapefile path, extent, or point and radius needs to be provided for DamFilter')
             
         # initialize filter values array
         self.values = []
@@ -57,34 +68,90 @@ class DamFilter(GeoEDFPlugin):
     # assume this method is called only when all params have been fully instantiated
     def filter(self):
 
+        # query the (locally cached) dam catalog
+        try:
+            damCatalog = DamCatalogHelper.getCatalog()
+        except:
+            raise GeoEDFError('Error retrieving dams catalog in DamFilter')
+
+        # find dams that fall within the shapefile's polygons, or its extent if it is not a
+        # polygon shapefile
         if self.shapefile is not None:
-            # first load up the shapefile (if any) to determine its projection
-            driver = ogr.GetDriverByName('ESRI Shapefile')
-            inDataset = driver.Open(self.shapefile, 0)
-            if inDataset is None:
-                raise GeoEDFError('Error opening shapefile %s in DamFilter' % self.shapefile)
-            inLayer = inDataset.GetLayer()
+            # check the on-disk cache for the shapefile's reprojected polygons or extent
+            geometry = ShpCacheHelper.getCached(self.shapefile,'DamFilter:geometry')
+            if geometry is None:
+                geometry = self.shapefile_geometry()
+
+            if geometry.get('polygons') is not None:
+                polygons = [[np.array(ring) for ring in polygon] for polygon in geometry['polygons']]
+                self.values.extend(damCatalog.queryPolygons(polygons))
+            else:
+                lat_min, lat_max, lon_min, lon_max = geometry['extent']
+                self.values.extend(damCatalog.queryExtent(lat_min,lat_max,lon_min,lon_max))
+            return
+
+        # find dams within radius km of the point
+        if self.point is not None:
+            lat_lon = self.point.split(',')
+            if len(lat_lon) != 2:
+                raise GeoEDFError('Point must be provided as lat,lon in DamFilter')
             try:
-                inSpatialRef = inLayer.GetSpatialRef()
+                lat = float(lat_lon[0])
+                lon = float(lat_lon[1])
+                radius = float(self.radius)
             except:
-                raise GeoEDFError('Error determining projection of input shapefile, cannot fetch extents in lat-lon')
+                raise GeoEDFError('Error determining lat-lon of point or radius in DamFilter')
 
-            # construct the desired output projection
-            try:
-                outSpatialRef = osr.SpatialReference()
-                outSpatialRef.ImportFromEPSG(4326)
-            except BaseException as e:
-                raise GeoEDFError('Error occurred when constructing target projection: %s' % e)
+            if radius <= 0:
+                raise GeoEDFError('Radius must be a positive number of km in DamFilter')
 
+            self.values.extend(damCatalog.queryRadius(lat,lon,radius))
+            return
+
+        # parse out extent into lat-lon min and max
+        lat_lons = self.extent.split(',')
+        if len(lat_lons) != 4:
+            raise GeoEDFError('Error determining lat-lon min and max from extents in DamFilter')
+            
+        lat_min = float(lat_lons[0])
+        lat_max = float(lat_lons[1])
+        lon_min = float(lat_lons[2])
+        lon_max = float(lat_lons[3])
+
+        self.values.extend(damCatalog.queryExtent(lat_min,lat_max,lon_min,lon_max))
+
+    # helper function to read the shapefile's polygons and reproject them to EPSG:4326
+    # returns a dict with a list of polygons (one per feature), each a list of (lon,lat) ring lists;
+    # for non-polygon shapefiles returns a dict with the reprojected extent (latmin,latmax,lonmin,lonmax)
+    def shapefile_geometry(self):
+
+        # first load up the shapefile to determine its projection
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        inDataset = driver.Open(self.shapefile, 0)
+        if inDataset is None:
+            raise GeoEDFError('Error opening shapefile %s in DamFilter' % self.shapefile)
+        inLayer = inDataset.GetLayer()
+        try:
+            inSpatialRef = inLayer.GetSpatialRef()
+        except:
+            raise GeoEDFError('Error determining projection of input shapefile, cannot fetch polygons in lat-lon')
+
+        # construct the desired output projection
+        try:
+            outSpatialRef = osr.SpatialReference()
+            outSpatialRef.ImportFromEPSG(4326)
+        except BaseException as e:
+            raise GeoEDFError('Error occurred when constructing target projection: %s' % e)
+
+        # points and lines have no interior to test containment against, use the layer's extent
+        if ogr.GT_Flatten(inLayer.GetGeomType()) not in (ogr.wkbPolygon,ogr.wkbMultiPolygon):
             try:
                 # create Coordinate Transformation
                 coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
 
-                # get layer extent
+                # get layer extent; extent is in the format: xmin,xmax,ymin,ymax
                 inExtent = inLayer.GetExtent()
 
-                # extent is in the format: xmin,xmax,ymin,ymax
-
                 # construct the point geometry for both bottom left and top right
                 # then reproject
                 bottomLeft = ogr.Geometry(ogr.wkbPoint)
@@ -96,34 +163,48 @@ class DamFilter(GeoEDFPlugin):
                 bottomLeft.Transform(coordTransform)
                 topRight.Transform(coordTransform)
 
-                self.extent = '%f,%f,%f,%f' % (bottomLeft.GetY(),topRight.GetY(),bottomLeft.GetX(),topRight.GetX())
-            
+                geometry = {'extent':[bottomLeft.GetY(),topRight.GetY(),bottomLeft.GetX(),topRight.GetX()]}
             except:
                 raise GeoEDFError("Error occurred when trying to reproject extents in DamFilter")
-                
-        # at this point self.extent should not be empty
-        # parse out extent into lat-lon min and max
-        lat_lons = self.extent.split(',')
-        if len(lat_lons) != 4:
-            raise GeoEDFError('Error determining lat-lon min and max from extents in DamFilter')
-            
-        lat_min = float(lat_lons[0])
-        lat_max = float(lat_lons[1])
-        lon_min = float(lat_lons[2])
-        lon_max = float(lat_lons[3])
-            
-        # query for dams list to filter to given extent
-        r = requests.get("https://fim.sec.usace.army.mil/ci/fim/getAllEAPStructure")
-        damsMetadata = json.loads(r.content)
-        for dam in damsMetadata:
-            try:
-                damID = dam['ID']
-                damLat = float(dam['LAT'])
-                damLon = float(dam['LON'])
-            
-                # check to see if dam falls within extent
-                if lat_min <= damLat and damLat <= lat_max and lon_min <= damLon and damLon <= lon_max:
-                    self.values.append(damID)
-            except:
-                # some error parsing dam metadata, continue 
-                continue
+
+            ShpCacheHelper.putCached(self.shapefile,'DamFilter:geometry',dict(geometry,srs=inSpatialRef.ExportToWkt()))
+            return geometry
+
+        polygons = []
+
+        # recursively walk through multipolygons and polygons to their rings
+        def collect(geom,rings):
+            if geom.GetGeometryCount() > 0:
+                for i in range(geom.GetGeometryCount()):
+                    collect(geom.GetGeometryRef(i),rings)
+            else:
+                points = geom.GetPoints()
+                if points is not None and len(points) > 2:
+                    rings.append(np.array([point[:2] for point in points],dtype=float))
+
+        try:
+            # create Coordinate Transformation
+            coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
+
+            for feature in inLayer:
+                geom = feature.GetGeometryRef()
+                if geom is None:
+                    continue
+                geom = geom.Clone()
+                geom.Transform(coordTransform)
+                rings = []
+                collect(geom,rings)
+                if len(rings) > 0:
+                    polygons.append(rings)
+        except:
+            raise GeoEDFError("Error occurred when trying to reproject polygons in DamFilter")
+
+        geometry = {'polygons':[[ring.tolist() for ring in rings] for rings in polygons]}
+
+        # save polygons and source projection for future runs, unless they are too large to
+        # be worth storing
+        num_vertices = sum([len(ring) for rings in polygons for ring in rings])
+        if num_vertices <= ShpCacheHelper.MAX_CACHED_VERTICES:
+            ShpCacheHelper.putCached(self.shapefile,'DamFilter:geometry',dict(geometry,srs=inSpatialRef.ExportToWkt()))
+
+        return geometry
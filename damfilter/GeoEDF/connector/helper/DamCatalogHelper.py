@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import requests
+import numpy as np
+
+""" Helper module for maintaining a local copy of the national dam catalog (getAllEAPStructure).
+    The catalog is stored in a compact columnar form (arrays of dam ID, lat, and lon) along with a
+    1 degree grid index, so that queries by extent only need to examine the dams in the grid cells
+    overlapping the extent. The local copy is reused for CATALOG_TTL seconds, after which it is
+    revalidated with a conditional GET (ETag/Last-Modified) and only re-downloaded if it has changed.
+    If the catalog service cannot be reached, a stale local copy is used when available.
+    Besides extents, the catalog can be queried for dams contained in polygons or within a given
+    distance of a point; both are evaluated vectorized over the grid index candidates.
+"""
+
+CATALOG_URL = 'https://fim.sec.usace.army.mil/ci/fim/getAllEAPStructure'
+
+# cache location can be overridden via the environment, e.g. to point to a shared scratch directory
+CACHE_DIR = os.environ.get('GEOEDF_DAM_CACHE_DIR',os.path.expanduser('~/.cache/geoedf'))
+
+# number of seconds a local copy is used before revalidating with the catalog service
+CATALOG_TTL = int(os.environ.get('GEOEDF_DAM_CATALOG_TTL','86400'))
+
+# (connect, read) timeouts in seconds for catalog requests; the catalog is a single large response
+REQUEST_TIMEOUT = (10,300)
+
+# size of a grid index cell in degrees
+GRID_SIZE = 1.0
+
+# number of grid cells in a row of the index; used to linearize cell coordinates
+GRID_COLS = int(360/GRID_SIZE) + 1
+
+# mean Earth radius in km used for haversine distances
+EARTH_RADIUS_KM = 6371.0088
+
+# maximum number of (edge, point) pairs evaluated at once in point in polygon tests
+PIP_BLOCK_SIZE = 4*1024*1024
+
+def gridCells(lats, lons):
+    """ returns the linearized grid cell index for the given lat and lon arrays
+    """
+    rows = np.floor((np.asarray(lats) + 90.0)/GRID_SIZE).astype(np.int64)
+    cols = np.floor((np.asarray(lons) + 180.0)/GRID_SIZE).astype(np.int64)
+    return rows * GRID_COLS + cols
+
+def pointsInRings(rings, lons, lats):
+    """ even-odd point in polygon test of all points against a set of (lon,lat) rings; this
+        handles polygons with holes and multipolygons whose parts do not overlap
+    """
+    inside = np.zeros(len(lons),dtype=bool)
+    if len(lons) == 0:
+        return inside
+
+    for ring in rings:
+        x0 = ring[:,0]
+        y0 = ring[:,1]
+        x1 = np.roll(x0,-1)
+        y1 = np.roll(y0,-1)
+
+        # evaluate blocks of edges against all points at once
+        block = max(1,PIP_BLOCK_SIZE // len(lons))
+        for start in range(0,len(ring),block):
+            ex0 = x0[start:start+block,None]
+            ey0 = y0[start:start+block,None]
+            ex1 = x1[start:start+block,None]
+            ey1 = y1[start:start+block,None]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                crosses = ((ey0 > lats) != (ey1 > lats)) & \
+                          (lons < (ex1 - ex0) * (lats - ey0) / (ey1 - ey0) + ex0)
+            inside ^= (np.count_nonzero(crosses,axis=0) % 2).astype(bool)
+    return inside
+
+def haversine(lat, lon, lats, lons):
+    """ great circle distance in km from (lat,lon) to each of the points in lats, lons
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    a = np.sin((lats - lat)/2)**2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon)/2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a,1.0)))
+
+class DamCatalog:
+    """ Columnar dam catalog; dams are sorted by grid cell so that each cell occupies a
+        contiguous slice of the ID, lat, and lon arrays
+    """
+    def __init__(self, ids, lats, lons):
+        cells = gridCells(lats,lons)
+        order = np.argsort(cells,kind='mergesort')
+        self.ids = np.asarray(ids)[order]
+        self.lats = np.asarray(lats,dtype=np.float64)[order]
+        self.lons = np.asarray(lons,dtype=np.float64)[order]
+        self.cells = cells[order]
+
+    @classmethod
+    def fromMetadata(cls, damsMetadata):
+        """ builds a catalog from the parsed getAllEAPStructure JSON, skipping dams whose
+            metadata cannot be parsed
+        """
+        ids = []
+        lats = []
+        lons = []
+        for dam in damsMetadata:
+            try:
+                damID = dam['ID']
+                damLat = float(dam['LAT'])
+                damLon = float(dam['LON'])
+            except:
+                # some error parsing dam metadata, continue
+                continue
+            if np.isfinite(damLat) and np.isfinite(damLon):
+                ids.append(str(damID))
+                lats.append(damLat)
+                lons.append(damLon)
+        return cls(np.array(ids,dtype=str),np.array(lats),np.array(lons))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['ids'],data['lats'],data['lons'])
+
+    def save(self, path):
+        # write to a temp file first so concurrent readers never see a partial catalog
+        tmp_path = '%s.%d.tmp' % (path,os.getpid())
+        with open(tmp_path,'wb') as outFile:
+            np.savez(outFile,ids=self.ids,lats=self.lats,lons=self.lons)
+        os.replace(tmp_path,path)
+
+    def candidates(self, lat_min, lat_max, lon_min, lon_max):
+        """ returns the indices of dams in grid cells that overlap the given extent
+        """
+        row_min, col_min = np.floor([(lat_min + 90.0)/GRID_SIZE,(lon_min + 180.0)/GRID_SIZE]).astype(np.int64)
+        row_max, col_max = np.floor([(lat_max + 90.0)/GRID_SIZE,(lon_max + 180.0)/GRID_SIZE]).astype(np.int64)
+
+        # within a row of the grid the cells of the extent are contiguous
+        slices = []
+        for row in range(row_min,row_max+1):
+            start = np.searchsorted(self.cells,row * GRID_COLS + col_min,side='left')
+            end = np.searchsorted(self.cells,row * GRID_COLS + col_max,side='right')
+            if end > start:
+                slices.append(np.arange(start,end))
+        if len(slices) == 0:
+            return np.array([],dtype=np.int64)
+        return np.concatenate(slices)
+
+    def queryExtent(self, lat_min, lat_max, lon_min, lon_max):
+        """ returns the IDs of all dams that fall within the given extent
+        """
+        idx = self.candidates(lat_min,lat_max,lon_min,lon_max)
+        lats = self.lats[idx]
+        lons = self.lons[idx]
+        mask = (lat_min <= lats) & (lats <= lat_max) & (lon_min <= lons) & (lons <= lon_max)
+        return self.ids[idx[mask]].tolist()
+
+    def queryPolygons(self, polygons):
+        """ returns the IDs of all dams that fall within any of the given polygons; each
+            polygon is a list of (lon,lat) ring arrays
+        """
+        found = np.zeros(len(self.ids),dtype=bool)
+        for rings in polygons:
+            # use the polygon's bounding box to prefilter candidates using the grid index
+            coords = np.concatenate(rings)
+            lon_min, lat_min = coords.min(axis=0)
+            lon_max, lat_max = coords.max(axis=0)
+            idx = self.candidates(lat_min,lat_max,lon_min,lon_max)
+            idx = idx[~found[idx]]
+            found[idx[pointsInRings(rings,self.lons[idx],self.lats[idx])]] = True
+        return self.ids[found].tolist()
+
+    def queryRadius(self, lat, lon, radius):
+        """ returns the IDs of all dams within radius km of the given point
+        """
+        # bounding box of the radius; widen the longitude range toward the poles
+        lat_delta = np.degrees(radius/EARTH_RADIUS_KM)
+        lat_min = max(lat - lat_delta,-90.0)
+        lat_max = min(lat + lat_delta,90.0)
+        lon_delta = 180.0
+        if max(abs(lat_min),abs(lat_max)) < 90.0:
+            lon_delta = lat_delta / np.cos(np.radians(max(abs(lat_min),abs(lat_max))))
+
+        # a longitude range crossing the antimeridian is split into two ranges
+        if lon_delta >= 180.0:
+            lon_ranges = [(-180.0,180.0)]
+        elif lon - lon_delta < -180.0:
+            lon_ranges = [(-180.0,lon + lon_delta),(lon - lon_delta + 360.0,180.0)]
+        elif lon + lon_delta > 180.0:
+            lon_ranges = [(lon - lon_delta,180.0),(-180.0,lon + lon_delta - 360.0)]
+        else:
+            lon_ranges = [(lon - lon_delta,lon + lon_delta)]
+
+        idx = np.concatenate([self.candidates(lat_min,lat_max,lon_min,lon_max) for lon_min, lon_max in lon_ranges])
+        mask = haversine(lat,lon,self.lats[idx],self.lons[idx]) <= radius
+        return self.ids[idx[mask]].tolist()
+
+def getCatalog():
+    """ returns the dam catalog, refreshing the local copy if it is older than CATALOG_TTL
+    """
+    os.makedirs(CACHE_DIR,exist_ok=True)
+    catalog_path = os.path.join(CACHE_DIR,'dam_catalog.npz')
+    meta_path = os.path.join(CACHE_DIR,'dam_catalog.json')
+
+    meta = {}
+    if os.path.exists(catalog_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path,'r') as metaFile:
+                meta = json.load(metaFile)
+        except:
+            meta = {}
+
+    # local copy is fresh enough, no need to contact the service
+    if len(meta) > 0 and time.time() - meta.get('fetched',0) < CATALOG_TTL:
+        try:
+            return DamCatalog.load(catalog_path)
+        except:
+            meta = {}
+
+    # revalidate the local copy if we have one
+    headers = {}
+    if len(meta) > 0:
+        if meta.get('etag') is not None:
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified') is not None:
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        res = requests.get(CATALOG_URL,headers=headers,timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+    except:
+        # fall back to a stale local copy if one exists
+        if len(meta) > 0:
+            print('Error refreshing dam catalog, using local copy fetched at %s' % time.ctime(meta['fetched']))
+            return DamCatalog.load(catalog_path)
+        raise
+
+    if res.status_code == 304:
+        catalog = DamCatalog.load(catalog_path)
+    else:
+        catalog = DamCatalog.fromMetadata(json.loads(res.content))
+        catalog.save(catalog_path)
+
+    meta = {'fetched': time.time(),
+            'etag': res.headers.get('ETag',meta.get('etag')),
+            'last_modified': res.headers.get('Last-Modified',meta.get('last_modified'))}
+    tmp_path = '%s.%d.tmp' % (meta_path,os.getpid())
+    with open(tmp_path,'w') as metaFile:
+        json.dump(meta,metaFile)
+    os.replace(tmp_path,meta_path)
+
+    return catalog
@@ -1,11 +1,12 @@
 from setuptools import setup, find_packages
 
 setup(name='damfilter',
-      version='0.2',
+      version='0.3',
       description='Filter for returning the IDs of dams that fall within the given extent',
       url='http://github.com/geoedf/damfilter',
       author='Rajesh Kalyanam',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
+      install_requires=['shpcachehelper'],
       zip_safe=False)
@@ -0,0 +1,87 @@
+import json
+import time
+
+import numpy as np
+import pytest
+import requests
+
+from GeoEDF.connector.helper import DamCatalogHelper
+
+# run from the damfilter directory with: python -m pytest tests
+
+DAMS = [{'ID':'A','LAT':'40.5','LON':'-86.9'},
+        {'ID':'B','LAT':'40.1','LON':'-86.1'},
+        {'ID':'C','LAT':'35.0','LON':'-100.0'},
+        {'ID':'D','LAT':'bad','LON':'-100.0'}]
+
+class Response:
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(self.status_code)
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(DamCatalogHelper,'CACHE_DIR',str(tmp_path))
+    return DamCatalogHelper
+
+def test_query_extent():
+    catalog = DamCatalogHelper.DamCatalog.fromMetadata(DAMS)
+    assert sorted(catalog.queryExtent(40.0,41.0,-87.0,-86.0)) == ['A','B']
+    assert catalog.queryExtent(40.0,41.0,-86.5,-86.0) == ['B']
+    assert catalog.queryExtent(0.0,1.0,0.0,1.0) == []
+
+def test_query_polygons_and_radius():
+    catalog = DamCatalogHelper.DamCatalog.fromMetadata(DAMS)
+    square = np.array([[-87.0,40.0],[-86.5,40.0],[-86.5,41.0],[-87.0,41.0]])
+    assert catalog.queryPolygons([[square]]) == ['A']
+    assert catalog.queryRadius(40.5,-86.9,10) == ['A']
+
+def test_query_radius_across_antimeridian():
+    # dams about 11km apart on either side of the antimeridian, and one far to the west
+    catalog = DamCatalogHelper.DamCatalog.fromMetadata([{'ID':'E','LAT':'52.0','LON':'179.92'},
+                                                        {'ID':'W','LAT':'52.0','LON':'-179.92'},
+                                                        {'ID':'F','LAT':'52.0','LON':'178.0'}])
+    assert sorted(catalog.queryRadius(52.0,179.99,20)) == ['E','W']
+    assert sorted(catalog.queryRadius(52.0,-179.99,20)) == ['E','W']
+    assert catalog.queryRadius(52.0,-179.99,5) == ['W']
+    # near the pole the radius covers all longitudes
+    catalog = DamCatalogHelper.DamCatalog.fromMetadata([{'ID':'P','LAT':'89.95','LON':'170.0'}])
+    assert catalog.queryRadius(89.95,-10.0,20) == ['P']
+
+def test_catalog_request_has_timeout(cache, monkeypatch):
+    calls = []
+    def get(url, **kwargs):
+        calls.append(kwargs)
+        return Response(200,DAMS,{'ETag':'"v1"'})
+    monkeypatch.setattr(requests,'get',get)
+    catalog = cache.getCatalog()
+    assert len(catalog.ids) == 3
+    assert calls[0]['timeout'] == cache.REQUEST_TIMEOUT
+
+def test_stale_copy_used_on_timeout(cache, monkeypatch):
+    monkeypatch.setattr(requests,'get',lambda url, **kwargs: Response(200,DAMS,{'ETag':'"v1"'}))
+    cache.getCatalog()
+
+    # expire the local copy; the revalidation request times out
+    monkeypatch.setattr(cache,'CATALOG_TTL',0)
+    def timeout(url, **kwargs):
+        raise requests.exceptions.ReadTimeout()
+    monkeypatch.setattr(requests,'get',timeout)
+    assert sorted(cache.getCatalog().ids.tolist()) == ['A','B','C']
+
+def test_not_modified_reuses_local_copy(cache, monkeypatch):
+    monkeypatch.setattr(requests,'get',lambda url, **kwargs: Response(200,DAMS,{'ETag':'"v1"'}))
+    cache.getCatalog()
+    monkeypatch.setattr(cache,'CATALOG_TTL',0)
+    headers = []
+    def not_modified(url, **kwargs):
+        headers.append(kwargs['headers'])
+        return Response(304)
+    monkeypatch.setattr(requests,'get',not_modified)
+    assert len(cache.getCatalog().ids) == 3
+    assert headers[0]['If-None-Match'] == '"v1"'
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+from osgeo import gdal
+
+""" Helper module for converting GeoTIFFs to Cloud Optimized GeoTIFFs (COG), i.e. tiled and
+    compressed rasters with internal overviews. These allow windowed reads and web display
+    without reading the whole file. The COG driver is used when available (GDAL >= 3.1);
+    otherwise an equivalent layout is produced with the GTiff driver. The converted file
+    replaces the original atomically.
+"""
+
+# creation options shared by both conversion paths
+COMPRESS = 'DEFLATE'
+BLOCK_SIZE = 512
+
+# overview levels built when the COG driver is not available
+OVERVIEW_LEVELS = [2,4,8,16,32]
+
+def convertToCOG(path):
+    """ converts the GeoTIFF at path to a COG in place; returns a dict describing the outcome,
+        to be usable from a process pool errors are reported rather than raised
+    """
+    result = {'file': path, 'status': 'failed', 'error': None}
+
+    tmpPath = '%s.cog.tmp' % path
+    ovrPath = '%s.ovr.tmp' % path
+    gdal.UseExceptions()
+    try:
+        if gdal.GetDriverByName('COG') is not None:
+            gdal.Translate(tmpPath,path,format='COG',
+                           creationOptions=['COMPRESS=%s' % COMPRESS,'BLOCKSIZE=%d' % BLOCK_SIZE,'OVERVIEWS=AUTO','BIGTIFF=IF_SAFER'])
+        else:
+            # tiled copy with overviews, then copy again so the overviews are stored
+            # ahead of the full resolution data as COG readers expect
+            gdal.Translate(ovrPath,path,format='GTiff',
+                           creationOptions=['TILED=YES','BLOCKXSIZE=%d' % BLOCK_SIZE,'BLOCKYSIZE=%d' % BLOCK_SIZE,'COMPRESS=%s' % COMPRESS,'BIGTIFF=IF_SAFER'])
+            ds = gdal.Open(ovrPath,gdal.GA_Update)
+            levels = [level for level in OVERVIEW_LEVELS if min(ds.RasterXSize,ds.RasterYSize) // level >= BLOCK_SIZE // 2]
+            if len(levels) > 0:
+                ds.BuildOverviews('AVERAGE',levels)
+            ds = None
+            gdal.Translate(tmpPath,ovrPath,format='GTiff',
+                           creationOptions=['TILED=YES','BLOCKXSIZE=%d' % BLOCK_SIZE,'BLOCKYSIZE=%d' % BLOCK_SIZE,'COMPRESS=%s' % COMPRESS,'COPY_SRC_OVERVIEWS=YES','BIGTIFF=IF_SAFER'])
+        os.replace(tmpPath,path)
+        result['status'] = 'success'
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        for leftover in [tmpPath,ovrPath]:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return result
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import tempfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+""" Helper module for downloading files over a shared keep-alive session. Each download is
+    streamed to a temporary file in the destination directory and atomically renamed once
+    complete, so a failed or interrupted download never leaves a partial file behind. Failed
+    requests are retried with exponential backoff. Download functions return a result dict
+    rather than raising, so that callers can report a per-file summary. A HostLimiter can be
+    shared by many concurrent downloads to cap the number of simultaneous requests to any one host.
+"""
+
+# HTTP status codes that are worth retrying
+RETRY_STATUS = [429,500,502,503,504]
+
+def createSession(pool_size=10):
+    """ creates a requests session whose connection pool can hold pool_size
+        keep-alive connections per host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+    return session
+
+class HostLimiter:
+    """ Caps the number of concurrent requests per host; slots are held only while a
+        request is in flight, not while waiting to retry
+    """
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+class NoLimit:
+    """ Stand-in for a HostLimiter slot when no per-host limit applies
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+def downloadFile(session, url, outPath, timeout=60, retries=3, backoff=2, limiter=None):
+    """ download the file at url to outPath, retrying up to retries times with
+        exponential backoff; if a limiter is provided, each attempt waits for a free
+        slot for the url's host; returns a dict describing the outcome
+    """
+    result = {'url': url, 'file': outPath, 'status': 'failed', 'bytes': 0, 'attempts': 0, 'error': None}
+    start = time.time()
+
+    for attempt in range(retries + 1):
+        result['attempts'] = attempt + 1
+        tmpPath = None
+        slot = limiter.slot(url) if limiter is not None else NoLimit()
+        try:
+            with slot, session.get(url,stream=True,timeout=timeout) as res:
+                if res.status_code in RETRY_STATUS:
+                    raise requests.exceptions.HTTPError('HTTP %d' % res.status_code)
+                res.raise_for_status()
+
+                # stream to a temp file alongside the destination, then rename
+                fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(outPath),prefix='.%s.' % os.path.basename(outPath))
+                nbytes = 0
+                with os.fdopen(fd,'wb') as outFile:
+                    for chunk in res.iter_content(chunk_size=1024*1024):
+                        outFile.write(chunk)
+                        nbytes += len(chunk)
+                os.replace(tmpPath,outPath)
+                tmpPath = None
+
+            result['status'] = 'success'
+            result['bytes'] = nbytes
+            result['error'] = None
+            break
+        except requests.exceptions.HTTPError as e:
+            result['error'] = 'HTTPError: %s' % e
+            # client errors other than throttling will not succeed on retry
+            if e.response is not None and e.response.status_code not in RETRY_STATUS:
+                break
+        except requests.exceptions.ConnectionError as e:
+            result['error'] = 'ConnectionError: %s' % e
+        except requests.exceptions.Timeout as e:
+            result['error'] = 'Timeout: %s' % e
+        except requests.exceptions.RequestException as e:
+            result['error'] = 'Error: %s' % e
+        except OSError as e:
+            result['error'] = 'OSError: %s' % e
+        finally:
+            if tmpPath is not None and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+        if attempt < retries:
+            time.sleep(backoff * (2 ** attempt))
+
+    result['seconds'] = round(time.time() - start,2)
+    return result
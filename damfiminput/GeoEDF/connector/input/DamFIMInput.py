@@ -3,24 +3,38 @@
 
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
+from GeoEDF.connector.helper import DownloadHelper
+from GeoEDF.connector.helper import COGHelper
 
-import requests
 import sys
 import json
-import urllib
-import urllib.request
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 """ Module for implementing the Dam flood inundation map input connector plugin. 
     This module will implement the get() method required for all input plugins.
+    The dam_id parameter can be a single dam ID or a comma separated list of dam IDs. Scenario
+    metadata for all dams is looked up concurrently and matching scenarios are downloaded by a single
+    bounded pool of workers sharing a keep-alive session. Downloads take priority over the remaining
+    metadata lookups, so a dam's downloads start as soon as a worker frees up after its metadata arrives.
+    The optional max_workers (default 4) parameter caps the total number of concurrent requests,
+    max_per_host (default max_workers) caps the concurrent requests to any one host, and timeout
+    (seconds, default 60) sets the per-request timeout. If the optional cog parameter is true,
+    each downloaded raster is converted to a Cloud Optimized GeoTIFF in a process pool as soon
+    as its download completes. A per-scenario summary of successful and failed downloads is 
+    printed at the end of the run.
 """
 
 class DamFIMInput(GeoEDFPlugin):
 
-    # no optional params yet, but keep around for future extension
     # a comma separated list of scenarios is required
-    __optional_params = []
+    __optional_params = ['max_workers','max_per_host','timeout','cog']
     __required_params = ['dam_id','scenarios']
 
+    # base URLs of the FIM service
+    __layers_url = 'https://fim.sec.usace.army.mil/ci/fim/getEAPLayers?id='
+    __download_url = 'https://fim.sec.usace.army.mil/ci/download/start?LAYERID=%s&type=s3&RASTER_INFO_ID=%s&TABLE=FLOOD_DEPTH&TABLE_ID=%s'
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFInput super class
     def __init__(self, **kwargs):
@@ -46,39 +60,139 @@ class DamFIMInput(GeoEDFPlugin):
         # class super class init
         super().__init__()
 
+    # fetch the scenarios available for a dam
+    def dam_scenarios(self,session,limiter,dam_id,timeout):
+        url = self.__layers_url + dam_id
+        with limiter.slot(url):
+            r = session.get(url,timeout=timeout)
+        r.raise_for_status()
+        return json.loads(r.content)
+
+    # construct the downloads for scenarios of this dam that match the provided scenario names
+    # returns a dict mapping the output filename to the scenario name and download link
+    def dam_downloads(self,dam_id,dam_scenarios,user_scenarios):
+        downloads = {}
+        for scenario in dam_scenarios:
+            for user_scenario in user_scenarios:
+                if user_scenario in scenario['displayName']:
+                    link = self.__download_url % (scenario["layerId"],scenario["rasterInfoID"],scenario["floodDepthID"])
+
+                    #construct filename out of load and breach condition
+                    fileName = '%s/%s_%s_%s.tiff' % (self.target_path,scenario['loadCondition'],scenario['breachCondition'],dam_id)
+                    downloads[fileName] = (scenario['displayName'],link)
+                    break
+        return downloads
+
     # each Input plugin needs to implement this method
     # if error, raise exception; if not, return True
     def get(self):
 
+        # set defaults for optional params and check they are positive numbers
+        try:
+            max_workers = int(self.max_workers) if self.max_workers is not None else 4
+            max_per_host = int(self.max_per_host) if self.max_per_host is not None else max_workers
+            timeout = float(self.timeout) if self.timeout is not None else 60
+        except:
+            raise GeoEDFError('max_workers, max_per_host, and timeout parameters for DamFIMInput must be numeric')
+        if max_workers < 1 or max_per_host < 1 or timeout <= 0:
+            raise GeoEDFError('max_workers, max_per_host, and timeout parameters for DamFIMInput must be positive')
+
+        # COG conversion is disabled by default
+        convert_cog = str(self.cog).lower() in ['true','yes','1']
+
+        # dam IDs to process, dropping duplicates but retaining order
+        dam_ids = []
+        for dam_id in str(self.dam_id).split(','):
+            dam_id = dam_id.strip()
+            if len(dam_id) > 0 and dam_id not in dam_ids:
+                dam_ids.append(dam_id)
+
         # user provided scenarios to download
         user_scenarios = self.scenarios.split(',')
-        
-        # loop through scenarios available for this dam and download those that match the provided
-        # scenario names
-        r = requests.get("https://fim.sec.usace.army.mil/ci/fim/getEAPLayers?id=" + self.dam_id)
-        dam_scenarios = json.loads(r.content)
-        for scenario in dam_scenarios:
-            for user_scenario in user_scenarios:
-                if user_scenario in scenario['displayName']:
-                    # then download
-                    link = "https://fim.sec.usace.army.mil/ci/download/start?LAYERID="\
-                    + str(scenario["layerId"])\
-                    + "&type=s3&RASTER_INFO_ID=" + str(scenario["rasterInfoID"])\
-                    + "&TABLE=FLOOD_DEPTH&TABLE_ID=" + str(scenario["floodDepthID"])
 
-                    #construct filename out of load and breach condition
-                    fileName = '%s/%s_%s_%s.tiff' % (self.target_path,scenario['loadCondition'],scenario['breachCondition'],self.dam_id)
-                    # download file
-                    try:
-                        file = urllib.request.urlretrieve(link, fileName)
-                    except urllib.error.HTTPError as err:
-                        print("DamFIMInput for %s   - HTTPError" % self.dam_id)
-                    except requests.exceptions.ConnectionError as err:
-                        print("DamFIMInput for %s   - ConnectionError" % self.dam_id)
-                    except requests.exceptions.Timeout:
-                        print("DamFIMInput for %s   - Timeout" % self.dam_id)
-                    except requests.exceptions.TooManyRedirects:
-                        print("DamFIMInput for %s   - TooManyRedirects" % self.dam_id)
-                    except requests.exceptions.RequestException as e:
-                        print("DamFIMInput for %s   - Error" % self.dam_id)
+        # all requests share one session and per-host limits; metadata lookups and downloads run in
+        # a single pool of max_workers threads, which enforces the global limit, so the session needs
+        # at most max_workers connections
+        session = DownloadHelper.createSession(max_workers)
+        limiter = DownloadHelper.HostLimiter(max_per_host)
+
+        # the COG conversion pool is created before any threads are started, so that its
+        # worker processes are forked from a single threaded process
+        cog_pool = multiprocessing.Pool() if convert_cog else None
+
+        results = []
+        failed_dams = []
+
+        # worker processes are terminated and the session closed even if an error interrupts the run
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+                # at most max_workers tasks are submitted at a time, so that a waiting download is
+                # handed to the next free worker ahead of the remaining metadata lookups
+                pending_dams = list(dam_ids)
+                pending_downloads = []
+                running = {}
+                download_futures = []
+                cog_results = {}
+
+                while len(pending_dams) > 0 or len(pending_downloads) > 0 or len(running) > 0:
+                    while len(running) < max_workers and (len(pending_downloads) > 0 or len(pending_dams) > 0):
+                        if len(pending_downloads) > 0:
+                            dam_id,name,fileName,link = pending_downloads.pop(0)
+                            future = executor.submit(DownloadHelper.downloadFile,session,link,fileName,timeout,limiter=limiter)
+                            download_futures.append((dam_id,name,future))
+                            running[future] = (dam_id,True)
+                        else:
+                            dam_id = pending_dams.pop(0)
+                            running[executor.submit(self.dam_scenarios,session,limiter,dam_id,timeout)] = (dam_id,False)
+
+                    done, _ = wait(running,return_when=FIRST_COMPLETED)
+                    for future in done:
+                        dam_id, is_download = running.pop(future)
+
+                        # convert rasters to COG as their downloads complete
+                        if is_download:
+                            if convert_cog:
+                                result = future.result()
+                                if result['status'] == 'success':
+                                    cog_results[result['file']] = cog_pool.apply_async(COGHelper.convertToCOG,(result['file'],))
+                            continue
+
+                        # queue the downloads for this dam now that its metadata is available
+                        try:
+                            downloads = self.dam_downloads(dam_id,future.result(),user_scenarios)
+                        except:
+                            print("DamFIMInput for %s   - Error fetching scenarios" % dam_id)
+                            failed_dams.append(dam_id)
+                            continue
+                        for fileName,(name,link) in downloads.items():
+                            pending_downloads.append((dam_id,name,fileName,link))
+
+                for dam_id,name,future in download_futures:
+                    result = future.result()
+                    result['dam_id'] = dam_id
+                    result['scenario'] = name
+                    result['cog'] = None
+                    if result['file'] in cog_results:
+                        cog_result = cog_results[result['file']].get()
+                        result['cog'] = cog_result['status'] if cog_result['error'] is None else 'failed: %s' % cog_result['error']
+                    results.append(result)
+
+            if cog_pool is not None:
+                cog_pool.close()
+                cog_pool.join()
+        finally:
+            if cog_pool is not None:
+                cog_pool.terminate()
+            session.close()
+
+        if len(failed_dams) == len(dam_ids):
+            raise GeoEDFError('Error fetching scenarios for dam(s) %s in DamFIMInput' % ','.join(dam_ids))
+
+        # summarize
+        num_success = len([result for result in results if result['status'] == 'success'])
+        print("DamFIMInput for %d dam(s)   - downloaded %d of %d scenarios, scenario lookup failed for %d dam(s)" % (len(dam_ids),num_success,len(results),len(failed_dams)))
+        for result in results:
+            print(json.dumps({key: result[key] for key in ['dam_id','scenario','status','file','bytes','attempts','seconds','error','cog']}))
+        
         return True
@@ -1,7 +1,7 @@
 from setuptools import setup, find_packages
 
 setup(name='damfiminput',
-      version='0.3',
+      version='0.4',
       description='Connector for accessing Dam Flood Inundation Map datasets',
       url='http://github.com/geoedf/connectors',
       author='Rajesh Kalyanam',
@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('geoedfframework')
+pytest.importorskip('osgeo')
+
+from GeoEDF.connector.helper import DownloadHelper
+from GeoEDF.connector.input.DamFIMInput import DamFIMInput
+
+# run from the damfiminput directory with: python -m pytest tests
+
+SCENARIOS = [{'displayName':'MH Breach','layerId':1,'rasterInfoID':2,'floodDepthID':3,'loadCondition':'MH','breachCondition':'Breach'},
+             {'displayName':'TAS Breach','layerId':4,'rasterInfoID':5,'floodDepthID':6,'loadCondition':'TAS','breachCondition':'Breach'}]
+
+class Response:
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class Session:
+    """ records the maximum number of requests in flight at once """
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active,self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+        if 'getEAPLayers' in url:
+            return Response(json.dumps(SCENARIOS).encode('utf-8'))
+        return Response(b'raster')
+
+    def close(self):
+        pass
+
+def make_input(tmp_path, **kwargs):
+    plugin = DamFIMInput(**kwargs)
+    plugin.target_path = str(tmp_path)
+    return plugin
+
+@pytest.mark.parametrize('max_workers',[1,3])
+def test_max_workers_caps_total_concurrency(tmp_path, monkeypatch, max_workers):
+    session = Session()
+    pool_sizes = []
+    def create_session(pool_size):
+        pool_sizes.append(pool_size)
+        return session
+    monkeypatch.setattr(DownloadHelper,'createSession',create_session)
+
+    # all requests go to the same host, so lift the per-host limit to test the global limit
+    dam_ids = ','.join(str(i) for i in range(8))
+    make_input(tmp_path,dam_id=dam_ids,scenarios='MH,TAS',max_workers=str(max_workers),max_per_host='100').get()
+
+    # metadata lookups and downloads overlap, but never exceed max_workers requests in total
+    assert session.max_active <= max_workers
+    assert pool_sizes == [max_workers]
+    assert len(list(tmp_path.glob('*.tiff'))) == 16
+
+def test_cog_pool_terminated_on_error(tmp_path, monkeypatch):
+    import multiprocessing
+    from GeoEDF.connector.input import DamFIMInput as module
+
+    pools = []
+    create_pool = multiprocessing.Pool
+    def pool():
+        pools.append(create_pool(1))
+        return pools[-1]
+    monkeypatch.setattr(module.multiprocessing,'Pool',pool)
+    monkeypatch.setattr(DownloadHelper,'createSession',lambda pool_size: Session())
+    def fail(*args, **kwargs):
+        raise RuntimeError('download failed')
+    monkeypatch.setattr(DownloadHelper,'downloadFile',fail)
+
+    with pytest.raises(RuntimeError):
+        make_input(tmp_path,dam_id='1',scenarios='MH',cog='true').get()
+
+    # the pool's worker processes do not outlive the failed run
+    workers = pools[0]._pool
+    for worker in workers:
+        worker.join(5)
+    assert not any(worker.is_alive() for worker in workers)
+
+def test_downloads_before_remaining_lookups(tmp_path, monkeypatch):
+    session = Session()
+    urls = []
+    get = session.get
+    def record(url, **kwargs):
+        urls.append('lookup' if 'getEAPLayers' in url else 'download')
+        return get(url,**kwargs)
+    session.get = record
+    monkeypatch.setattr(DownloadHelper,'createSession',lambda pool_size: session)
+
+    make_input(tmp_path,dam_id='1,2,3',scenarios='MH,TAS',max_workers='1').get()
+
+    # a dam's downloads do not queue behind the lookups of the other dams
+    assert urls == ['lookup','download','download'] * 3
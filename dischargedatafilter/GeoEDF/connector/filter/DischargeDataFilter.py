@@ -4,23 +4,68 @@
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 
+import io
 import os
+import requests
 import pandas as pd
 import hydrofunctions as hf
 import numpy as np
 import math
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 """ Module for implementing the DischargeDataFilter. This filter takes a comma separated list of Gage IDs,
-    a start and end date, and a coverage % value. The filter uses the Hydrofunctions API to fetch discharge 
-    data for this date range and only retains those stations that have atleast coverage % availability wrt 
-    the maximum number of days that data is available for among these Gages.
+    a start and end date, and a coverage % value. The filter fetches daily discharge data for this date range
+    from the NWIS daily values service (parsed with the Hydrofunctions API) and only retains those stations
+    that have atleast coverage % availability wrt the maximum number of days that data is available for 
+    among these Gages. Gages are fetched in chunks
+    by a bounded thread pool, and each chunk is immediately reduced to its per-station count of valid
+    values, so the full discharge matrix for all gages is never assembled. Chunk sizes adapt to the
+    service: chunks grow while responses are fast, and a chunk that times out or is rejected (414, 429, or
+    5xx) is split in half and retried. After a 429 or 5xx response no requests are sent until the time
+    given by the service's Retry-After header, or an exponentially growing backoff. Only a response
+    without any time series counts as no data; any other failure is retried or reported.
+    If the optional mode parameter is set to catalog, coverage is instead screened using the NWIS site
+    service series catalog (begin date, end date, and count of daily discharge values for each gage).
+    This bounds the number of values each gage has in the date range; only the gages whose bounds
+    do not decide the outcome are verified by fetching their discharge data.
 """
 
 class DischargeDataFilter(GeoEDFPlugin):
-    __optional_params = []
+    __optional_params = ['mode']
     __required_params = ['start','end','gages','cutoff']
 
+    # maximum number of chunks fetched concurrently
+    __max_workers = 4
+
+    # initial and maximum number of gages per discharge data request; chunks are doubled
+    # (up to the maximum) whenever a response takes less than __fast_seconds
+    __chunk_size = 100
+    __max_chunk_size = 800
+    __fast_seconds = 10
+
+    # number of attempts for a single gage before it is skipped
+    __max_attempts = 3
+
+    # initial and maximum number of seconds to pause requests after a 429 or 5xx response
+    __backoff_seconds = 1
+    __max_backoff_seconds = 60
+
+    # NWIS daily values service endpoint
+    __dv_url = 'https://waterservices.usgs.gov/nwis/dv/'
+
+    # NWIS site service endpoint used for the series catalog
+    __site_url = 'https://waterservices.usgs.gov/nwis/site/'
+
+    # (connect, read) timeouts in seconds for NWIS requests
+    __request_timeout = (10,120)
+
+    # supported coverage modes
+    __modes = ['data','catalog']
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFPlugin super class
     def __init__(self, **kwargs):
@@ -57,7 +102,7 @@ class DischargeDataFilter(GeoEDFPlugin):
         # first transform comma separated gage IDs into a list of strings
         gage_ids = self.gages.rstrip().split(',')
 
-        # since HF cannot handle a large number of station IDs, split into chunks of 100
+        # the site service cannot handle a large number of station IDs, split into chunks of 100
         num_split = math.ceil(len(gage_ids)/100)
 
         gage_id_chunks = np.array_split(gage_ids,num_split)
@@ -83,32 +128,34 @@ class DischargeDataFilter(GeoEDFPlugin):
         except:
             raise GeoEDFError('Cutoff parameter in DischargeDataFilter must be an integer between 1 and 100')
 
+        # make sure mode is supported
+        mode = self.mode.lower() if self.mode is not None else 'data'
+        if mode not in self.__modes:
+            raise GeoEDFError('Mode parameter for DischargeDataFilter must be one of %s' % ','.join(self.__modes))
+
+        if mode == 'catalog':
+            try:
+                filtered_ids = self.catalog_filter(gage_ids,gage_id_chunks,start_date,end_date)
+            except:
+                raise GeoEDFError("Error retrieving series catalog for gages in DischargeDataFilter")
+            if len(filtered_ids) > 0:
+                self.values.append(','.join(filtered_ids))
+            return
+
         # next query Hydrofunctions for discharge data for the provided gages
         # 00060 is discharge parameter
         try:
-            # process each chunk separately and merge the resulting dataframes
-            # discharges holds the merged DF
-            discharges = None
-            for gage_chunk in gage_id_chunks:
-                chunk_data = hf.NWIS(list(gage_chunk),'dv',start_date=start_date.strftime('%Y-%m-%d'),end_date=end_date.strftime('%Y-%m-%d'),parameterCd='00060')
-                if discharges is None:
-                    discharges = chunk_data.df()
-                else:
-                    # simple merge
-                    discharges = discharges.merge(chunk_data.df(),how='outer',left_index=True,right_index=True)
-            
-            # get the statistics of retrieved data, we are looking for count
-            # in order to filter by coverage %
-            stn_data = discharges.describe()
+            # count of valid values for each station
+            stn_counts = self.adaptive_counts(gage_ids,start_date,end_date)
 
             # maximum data available
-            max_count = stn_data.loc['count'].max()
+            max_count = stn_counts.max()
 
             # cutoff number of days
             count_cutoff = (max_count * self.cutoff)/100
 
             # filter by availability
-            keep_stn = (stn_data.loc['count'] >= count_cutoff)
+            keep_stn = (stn_counts >= count_cutoff)
 
             valid_stns = keep_stn[keep_stn].index.to_list()
 
@@ -121,6 +168,221 @@ class DischargeDataFilter(GeoEDFPlugin):
         except:
             raise GeoEDFError("Error retrieving discharge data for gages in DischargeDataFilter")
 
-                        
+    # fetch discharge data for a chunk of gages and return the number of valid values per station
+    # the daily values service is called directly rather than through hf.NWIS, so that requests time
+    # out and HTTP errors are raised as such instead of being reported as missing data
+    def chunk_counts(self,gage_chunk,start_date,end_date):
+        dv_params = {'format': 'json,1.1',
+                     'sites': ','.join(gage_chunk),
+                     'parameterCd': '00060',
+                     'startDT': start_date.strftime('%Y-%m-%d'),
+                     'endDT': end_date.strftime('%Y-%m-%d')}
+        res = requests.get(self.__dv_url,params=dv_params,headers={'Accept-encoding': 'gzip'},timeout=self.__request_timeout)
+        # NWIS responds with 404 only if none of these gages have data in the date range
+        if res.status_code == 404:
+            return pd.Series(dtype=float)
+        res.raise_for_status()
+        try:
+            chunk_df, _ = hf.extract_nwis_df(res.json())
+        except hf.exceptions.HydroNoDataError:
+            # a valid response without any time series
+            return pd.Series(dtype=float)
+        # only the numeric data columns are counted, not the qualifiers
+        return chunk_df.select_dtypes(include='number').count()
+
+    # timed version of chunk_counts, returns the counts and the number of seconds taken
+    def timed_counts(self,gage_chunk,start_date,end_date):
+        start = time.time()
+        counts = self.chunk_counts(gage_chunk,start_date,end_date)
+        return counts, time.time() - start
+
+    # errors that may succeed with a smaller chunk of gages
+    def retryable_error(self,e):
+        if isinstance(e,(requests.exceptions.Timeout,requests.exceptions.ConnectionError,requests.exceptions.ChunkedEncodingError)):
+            return True
+        if isinstance(e,requests.exceptions.HTTPError) and e.response is not None:
+            return e.response.status_code in (414,429) or e.response.status_code >= 500
+        return False
+
+    # number of seconds to pause requests after a throttled (429) or failed (5xx) request: the delay
+    # given by the Retry-After header if present, otherwise exponential backoff in the number of
+    # consecutive such failures; None for other errors
+    def retry_delay(self,e,backoffs):
+        if not isinstance(e,requests.exceptions.HTTPError) or e.response is None:
+            return None
+        if e.response.status_code != 429 and e.response.status_code < 500:
+            return None
+        retry_after = e.response.headers.get('Retry-After')
+        if retry_after is not None:
+            # either a number of seconds or an HTTP date
+            try:
+                return min(max(0,float(retry_after)),self.__max_backoff_seconds)
+            except ValueError:
+                pass
+            try:
+                seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                return min(max(0,seconds),self.__max_backoff_seconds)
+            except (TypeError,ValueError):
+                pass
+        return min(self.__backoff_seconds * 2 ** backoffs,self.__max_backoff_seconds)
+
+    # fetch the number of valid values per station for all gages in adaptively sized chunks
+    # chunks grow while responses are fast; a chunk failing with a retryable error is split in
+    # half and both halves are retried, a single gage that keeps failing is skipped
+    # after a 429 or 5xx response, no chunks are submitted until the retry delay has passed
+    # returns counts ordered by gage
+    def adaptive_counts(self,gage_ids,start_date,end_date):
+        pending = list(gage_ids)
+        retry_chunks = []
+        attempts = {}
+        chunk_size = self.__chunk_size
+        # chunks are not grown beyond the halves of a failed chunk, unless larger chunks have succeeded
+        size_limit = self.__max_chunk_size
+        largest_ok = 0
+        chunk_counts = []
+        skipped = []
+        # time before which no requests are sent, and the number of consecutive throttled requests
+        resume_at = 0
+        backoffs = 0
+
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            running = {}
+            while len(pending) > 0 or len(retry_chunks) > 0 or len(running) > 0:
+                # keep the pool busy unless the service asked to back off, failed chunks are retried first
+                delay = resume_at - time.time()
+                while delay <= 0 and len(running) < self.__max_workers and (len(retry_chunks) > 0 or len(pending) > 0):
+                    if len(retry_chunks) > 0:
+                        gage_chunk = retry_chunks.pop()
+                    else:
+                        gage_chunk = pending[:chunk_size]
+                        pending = pending[chunk_size:]
+                    running[executor.submit(self.timed_counts,gage_chunk,start_date,end_date)] = gage_chunk
+
+                if len(running) == 0:
+                    time.sleep(max(0,delay))
+                    continue
+
+                done, _ = wait(running,timeout=delay if delay > 0 else None,return_when=FIRST_COMPLETED)
+                for future in done:
+                    gage_chunk = running.pop(future)
+                    try:
+                        counts, seconds = future.result()
+                    except Exception as e:
+                        if not self.retryable_error(e):
+                            raise
+                        retry_delay = self.retry_delay(e,backoffs)
+                        if retry_delay is not None:
+                            backoffs += 1
+                            resume_at = max(resume_at,time.time() + retry_delay)
+                        if len(gage_chunk) > 1:
+                            # split the failing chunk and do not submit new chunks larger than its halves
+                            half = len(gage_chunk) // 2
+                            retry_chunks.extend([gage_chunk[half:],gage_chunk[:half]])
+                            chunk_size = max(1,min(chunk_size,half))
+                            size_limit = min(size_limit,max(half,largest_ok))
+                        else:
+                            attempts[gage_chunk[0]] = attempts.get(gage_chunk[0],1) + 1
+                            if attempts[gage_chunk[0]] <= self.__max_attempts:
+                                retry_chunks.append(gage_chunk)
+                            else:
+                                print('Error retrieving discharge data for gage %s in DischargeDataFilter, skipping: %s' % (gage_chunk[0],e))
+                                skipped.append(gage_chunk[0])
+                        continue
+
+                    chunk_counts.append(counts)
+                    backoffs = 0
+                    largest_ok = max(largest_ok,len(gage_chunk))
+                    # a full size chunk returned quickly, try larger chunks
+                    if seconds < self.__fast_seconds and len(gage_chunk) >= chunk_size:
+                        chunk_size = min(size_limit,chunk_size * 2)
+
+        if len(skipped) == len(set(gage_ids)):
+            raise GeoEDFError('Error retrieving discharge data for all gages in DischargeDataFilter')
+
+        if len(chunk_counts) == 0:
+            return pd.Series(dtype=float)
+
+        # chunks complete in any order, restore the order of the gages
+        stn_counts = pd.concat(chunk_counts)
+        gage_order = {gage_id: pos for pos, gage_id in enumerate(gage_ids)}
+        stn_order = [gage_order.get(stn_id.split(':')[1],len(gage_order)) for stn_id in stn_counts.index]
+        return stn_counts.iloc[np.argsort(stn_order,kind='mergesort')]
+
+    # query the NWIS site service series catalog for the daily discharge series of a chunk of gages
+    # returns a DataFrame with site_no, begin and end date, and count of values
+    def chunk_catalog(self,gage_chunk):
+        site_params = {'format': 'rdb',
+                       'sites': ','.join(gage_chunk),
+                       'seriesCatalogOutput': 'true',
+                       'outputDataTypeCd': 'dv',
+                       'parameterCd': '00060',
+                       'siteStatus': 'all'}
+        res = requests.get(self.__site_url,params=site_params,timeout=self.__request_timeout)
+        # none of these gages have daily discharge data
+        if res.status_code == 404:
+            return pd.DataFrame(columns=['site_no','begin_date','end_date','count_nu'])
+        res.raise_for_status()
+        catalog = pd.read_csv(io.StringIO(res.text),sep='\t',comment='#',dtype=str)
+        # the first row after the header describes the column formats
+        catalog = catalog.iloc[1:]
+        # only the daily mean series is used to compute coverage
+        catalog = catalog[(catalog['data_type_cd'] == 'dv') & (catalog['parm_cd'] == '00060') & (catalog['stat_cd'] == '00003')]
+        return catalog[['site_no','begin_date','end_date','count_nu']]
+
+    # count the valid daily mean discharge values per gage by fetching the data for these gages
+    def verify_counts(self,gage_ids,start_date,end_date):
+        if len(gage_ids) == 0:
+            return pd.Series(dtype=float)
+        counts = self.adaptive_counts(gage_ids,start_date,end_date)
+        if len(counts) == 0:
+            return pd.Series(0.0,index=gage_ids)
+        counts = counts[counts.index.str.endswith(':00003')]
+        # gages without any returned data have no values
+        return counts.groupby(counts.index.str.split(':').str[1]).max().reindex(gage_ids).fillna(0)
+
+    # determine gages meeting the cutoff from the series catalog; the catalog count of values
+    # in the full period of record bounds the count within the date range, gages for which
+    # these bounds are inconclusive are verified against the actual data
+    def catalog_filter(self,gage_ids,gage_id_chunks,start_date,end_date):
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            catalog = pd.concat(list(executor.map(self.chunk_catalog,gage_id_chunks)),ignore_index=True)
+
+        begin = pd.to_datetime(catalog['begin_date'],format='%Y-%m-%d')
+        end = pd.to_datetime(catalog['end_date'],format='%Y-%m-%d')
+        count = pd.to_numeric(catalog['count_nu'],errors='coerce').fillna(0)
+
+        # days of the period of record within the date range and outside of it
+        overlap = ((end.clip(upper=end_date) - begin.clip(lower=start_date)).dt.days + 1).clip(lower=0)
+        outside = (end - begin).dt.days + 1 - overlap
+
+        # bounds on the number of values within the date range for each series
+        # a gage with multiple series has at least the values of its best series
+        bounds = pd.DataFrame({'site_no': catalog['site_no'],
+                               'lower': (count - outside).clip(lower=0),
+                               'upper': np.minimum(count,overlap),
+                               'overlap': overlap})
+        bounds = bounds.groupby('site_no').agg({'lower': 'max','upper': 'sum','overlap': 'max'})
+        bounds['upper'] = np.minimum(bounds['upper'],bounds['overlap'])
+
+        # gages without a daily discharge series have no values
+        bounds = bounds.reindex(pd.unique(np.array(gage_ids))).fillna(0)
+
+        # the maximum count is at least the largest lower bound; any gage that could exceed it
+        # needs to be verified to determine the actual maximum
+        max_lower = bounds['lower'].max()
+        verify_ids = bounds.index[bounds['upper'] > max_lower].to_list()
+        verified = self.verify_counts(verify_ids,start_date,end_date)
+        max_count = max(max_lower,verified.max() if len(verified) > 0 else 0)
+
+        # cutoff number of days
+        count_cutoff = (max_count * self.cutoff)/100
 
+        # gages whose bounds straddle the cutoff are verified as well
+        borderline = (bounds['lower'] < count_cutoff) & (bounds['upper'] >= count_cutoff) & ~bounds.index.isin(verified.index)
+        verified = pd.concat([verified,self.verify_counts(bounds.index[borderline].to_list(),start_date,end_date)])
 
+        # use verified counts where available, otherwise the bounds are conclusive
+        counts = bounds['lower'].copy()
+        counts.update(verified)
+        keep_stn = (counts >= count_cutoff) & (counts > 0)
+        return keep_stn[keep_stn].index.to_list()
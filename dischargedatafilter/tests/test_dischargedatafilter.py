@@ -0,0 +1,219 @@
+import json
+import time
+
+import pandas as pd
+import pytest
+import requests
+
+pytest.importorskip('geoedfframework')
+pytest.importorskip('hydrofunctions')
+
+from GeoEDF.connector.filter.DischargeDataFilter import DischargeDataFilter
+
+# run from the dischargedatafilter directory with: python -m pytest tests
+
+def waterml(site_days):
+    """ WaterML JSON (format=json,1.1) daily values response; site_days maps a site number
+        to the number of days with values starting 2020-01-01 """
+    series = []
+    for site_no, days in site_days.items():
+        values = [{'value': '%d' % (day + 1),'qualifiers': ['A'],'dateTime': (pd.Timestamp('2020-01-01') + pd.Timedelta(days=day)).strftime('%Y-%m-%dT00:00:00.000')}
+                  for day in range(days)]
+        series.append({'name': 'USGS:%s:00060:00003' % site_no,
+                       'sourceInfo': {'siteName': 'SITE %s' % site_no,
+                                      'geoLocation': {'geogLocation': {'srs': 'EPSG:4326','latitude': 40.0,'longitude': -86.0}}},
+                       'variable': {'noDataValue': -999999.0,'variableDescription': 'Discharge, cubic feet per second',
+                                    'unit': {'unitCode': 'ft3/s'}},
+                       'values': [{'value': values,'method': [{'methodDescription': '','methodID': 1}]}]})
+    return {'value': {'timeSeries': series}}
+
+class Response:
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = headers or {}
+        self.url = 'https://waterservices.usgs.gov/nwis/dv/'
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('HTTP %d' % self.status_code,response=self)
+
+class DailyValues:
+    """ stands in for the daily values service: rejects long site lists with 414, and can fail
+        requests containing given sites with 503 a number of times """
+    def __init__(self, site_days, max_sites=1000, fail_sites=(), failures=1, status_code=503, headers=None):
+        self.site_days = site_days
+        self.max_sites = max_sites
+        self.fail_sites = set(fail_sites)
+        self.failures = failures
+        self.status_code = status_code
+        self.headers = headers
+        self.requests = []
+        self.times = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        assert timeout is not None
+        site_nos = params['sites'].split(',')
+        self.requests.append(site_nos)
+        self.times.append(time.time())
+        if len(site_nos) > self.max_sites:
+            return Response(414)
+        if self.failures > 0 and self.fail_sites & set(site_nos):
+            self.failures -= 1
+            return Response(self.status_code,headers=self.headers)
+        found = {site_no: self.site_days[site_no] for site_no in site_nos if self.site_days.get(site_no,0) > 0}
+        if len(found) == 0:
+            return Response(404)
+        return Response(200,waterml(found))
+
+GAGES = ['0333%04d' % i for i in range(40)]
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    # keep the backoff after 429 and 5xx responses short
+    monkeypatch.setattr(DischargeDataFilter,'_DischargeDataFilter__backoff_seconds',0.01)
+    monkeypatch.setattr(DischargeDataFilter,'_DischargeDataFilter__max_backoff_seconds',0.5)
+
+def make_filter(gages=GAGES, cutoff=50, mode=None):
+    return DischargeDataFilter(start='01/01/2020',end='01/31/2020',gages=','.join(gages),cutoff=cutoff,mode=mode)
+
+def site_days():
+    # every fourth gage has no data, the others have 10, 20, or 30 days of data
+    return {gage: (0 if i % 4 == 0 else 10 * (i % 4)) for i, gage in enumerate(GAGES)}
+
+def expected(days, cutoff):
+    max_days = max(days.values())
+    return [gage for gage in GAGES if days[gage] > 0 and days[gage] >= max_days * cutoff / 100]
+
+def test_filter_counts(monkeypatch):
+    service = DailyValues(site_days())
+    monkeypatch.setattr(requests,'get',service.get)
+    plugin = make_filter()
+    plugin.filter()
+    assert plugin.values == [','.join(expected(site_days(),50))]
+
+def test_414_splits_chunks(monkeypatch):
+    service = DailyValues(site_days(),max_sites=8)
+    monkeypatch.setattr(requests,'get',service.get)
+    plugin = make_filter()
+    plugin.filter()
+    assert plugin.values == [','.join(expected(site_days(),50))]
+    # the rejected chunks were split until they were accepted
+    assert any(len(sites) > 8 for sites in service.requests)
+    assert all(len(sites) <= 8 for sites in service.requests[-5:])
+
+def test_503_is_retried_not_treated_as_no_data(monkeypatch):
+    service = DailyValues(site_days(),fail_sites=[GAGES[3]],failures=3)
+    monkeypatch.setattr(requests,'get',service.get)
+    plugin = make_filter()
+    plugin.filter()
+    # the gage in the failing requests still has its 30 days counted
+    assert GAGES[3] in plugin.values[0].split(',')
+    assert plugin.values == [','.join(expected(site_days(),50))]
+
+def test_retry_after_is_honoured(monkeypatch):
+    service = DailyValues(site_days(),fail_sites=[GAGES[3]],failures=1,status_code=429,headers={'Retry-After': '0.3'})
+    monkeypatch.setattr(requests,'get',service.get)
+    plugin = make_filter()
+    plugin.filter()
+    assert plugin.values == [','.join(expected(site_days(),50))]
+    # no request is sent until the service's delay has passed
+    assert service.times[1] - service.times[0] >= 0.3
+
+def test_backoff_grows_without_retry_after(monkeypatch):
+    monkeypatch.setattr(DischargeDataFilter,'_DischargeDataFilter__backoff_seconds',0.1)
+    service = DailyValues(site_days(),fail_sites=GAGES,failures=2)
+    monkeypatch.setattr(requests,'get',service.get)
+    plugin = make_filter(gages=[GAGES[1]])
+    plugin.filter()
+    assert plugin.values == [GAGES[1]]
+    gaps = [later - earlier for earlier, later in zip(service.times,service.times[1:])]
+    assert len(gaps) == 2 and gaps[0] >= 0.1 and gaps[1] >= 0.2
+
+def test_retry_delay_from_http_date():
+    plugin = make_filter()
+    response = Response(503,headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+    # a date in the past means no delay
+    assert plugin.retry_delay(requests.exceptions.HTTPError(response=response),0) == 0
+    response = Response(400)
+    assert plugin.retry_delay(requests.exceptions.HTTPError(response=response),0) is None
+
+def test_persistent_503_skips_only_that_gage(monkeypatch):
+    service = DailyValues(site_days(),fail_sites=[GAGES[3]],failures=1000)
+    monkeypatch.setattr(requests,'get',service.get)
+    plugin = make_filter()
+    plugin.filter()
+    assert GAGES[3] not in plugin.values[0].split(',')
+    assert GAGES[7] in plugin.values[0].split(',')
+
+def test_timeout_is_retried(monkeypatch):
+    service = DailyValues(site_days())
+    calls = []
+    def get(url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            raise requests.exceptions.ReadTimeout()
+        return service.get(url,**kwargs)
+    monkeypatch.setattr(requests,'get',get)
+    plugin = make_filter()
+    plugin.filter()
+    assert plugin.values == [','.join(expected(site_days(),50))]
+
+def test_client_error_is_surfaced(monkeypatch):
+    monkeypatch.setattr(requests,'get',lambda url, **kwargs: Response(400))
+    with pytest.raises(Exception):
+        make_filter().filter()
+
+def catalog_filter(monkeypatch, catalog, actual, cutoff=50):
+    """ runs catalog_filter for January 2020 with the series catalog rows given as
+        (site_no, begin_date, end_date, count_nu) and the actual counts used for verification;
+        returns the filtered gages and the gages that were verified """
+    plugin = make_filter(cutoff=cutoff)
+    gage_ids = sorted(set([row[0] for row in catalog]) | set(actual))
+    verified = []
+    def chunk_catalog(gage_chunk):
+        return pd.DataFrame([row for row in catalog if row[0] in gage_chunk],columns=['site_no','begin_date','end_date','count_nu'])
+    def verify_counts(ids, start_date, end_date):
+        verified.extend(ids)
+        return pd.Series([float(actual.get(gage_id,0)) for gage_id in ids],index=ids,dtype=float)
+    monkeypatch.setattr(plugin,'chunk_catalog',chunk_catalog)
+    monkeypatch.setattr(plugin,'verify_counts',verify_counts)
+    kept = plugin.catalog_filter(gage_ids,[gage_ids[:2],gage_ids[2:]],pd.Timestamp('2020-01-01'),pd.Timestamp('2020-01-31'))
+    return kept, verified
+
+def test_catalog_conclusive_bounds(monkeypatch):
+    catalog = [('01','2000-01-01','2025-01-01','9133'),   # complete record, all 31 days
+               ('02','2020-01-01','2020-01-05','5'),                  # at most 5 days
+               ('03','2020-01-10','2020-01-31','22')]                 # exactly 22 days
+    kept, verified = catalog_filter(monkeypatch,catalog,{})
+    assert kept == ['01','03']
+    assert verified == []
+
+def test_catalog_borderline_gages_are_verified(monkeypatch):
+    catalog = [('01','2000-01-01','2025-01-01','9133'),
+               ('02','2019-12-01','2020-01-31','40'),   # between 9 and 31 days
+               ('03','2019-12-01','2020-01-31','20')]   # between 0 and 20 days
+    kept, verified = catalog_filter(monkeypatch,catalog,{'02': 20,'03': 10})
+    assert sorted(verified) == ['02','03']
+    assert kept == ['01','02']
+
+def test_catalog_maximum_is_verified(monkeypatch):
+    # no gage is known to have the maximum count, the one that could exceed the
+    # largest lower bound is verified before the cutoff is computed
+    catalog = [('01','2019-12-01','2020-01-31','31'),   # between 0 and 31 days
+               ('02','2020-01-10','2020-01-21','12')]   # exactly 12 days
+    kept, verified = catalog_filter(monkeypatch,catalog,{'01': 20})
+    assert verified == ['01']
+    assert kept == ['01','02']
+    kept, verified = catalog_filter(monkeypatch,catalog,{'01': 30})
+    assert kept == ['01']
+
+def test_catalog_missing_gages_are_dropped(monkeypatch):
+    catalog = [('01','2000-01-01','2025-01-01','9133'),
+               ('02','2000-01-01','2025-01-01','bad')]
+    kept, verified = catalog_filter(monkeypatch,catalog,{'03': 0},cutoff=1)
+    assert kept == ['01']
+    assert '03' not in verified
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import geopandas as gpd
+
+""" Helper module for looking up the FLComID of gages from the GageLoc shapefile without reading
+    its geometries. The first lookup builds a compact index of the shapefile's attributes: the gage
+    IDs (SOURCE_FEA) as a sorted array alongside their FLComIDs, stored as an .npz file next to the
+    shapefile, or in CACHE_DIR if that location is not writable. The index records the size and
+    modification time of the shapefile's attribute table and is rebuilt if they change. Lookups are
+    a vectorized binary search of the sorted IDs.
+"""
+
+# fallback location for the index, used when the packaged data directory is read-only
+CACHE_DIR = os.environ.get('GEOEDF_GAGELOC_CACHE_DIR',os.path.expanduser('~/.cache/geoedf'))
+
+def sourceStamp(shapefile):
+    """ returns the (size, mtime) of the shapefile's attribute table, used to detect changes
+    """
+    dbf_path = '%s.dbf' % os.path.splitext(shapefile)[0]
+    stat = os.stat(dbf_path if os.path.exists(dbf_path) else shapefile)
+    return np.array([stat.st_size,stat.st_mtime])
+
+def indexPaths(shapefile):
+    """ returns the candidate locations of the index for this shapefile, in order of preference
+    """
+    name = '%s_index.npz' % os.path.splitext(os.path.basename(shapefile))[0]
+    return [os.path.join(os.path.dirname(os.path.abspath(shapefile)),name),os.path.join(CACHE_DIR,name)]
+
+def buildIndex(shapefile):
+    """ reads the gage IDs and FLComIDs from the shapefile attributes; returns the sorted
+        gage IDs and the corresponding FLComIDs, keeping the first entry of a repeated ID
+    """
+    gage_locs = gpd.read_file(shapefile,ignore_geometry=True)
+    ids = np.array(gage_locs['SOURCE_FEA'].astype(str).tolist(),dtype=str)
+    comids = gage_locs['FLComID'].astype('int64').values
+    order = np.argsort(ids,kind='mergesort')
+    ids = ids[order]
+    comids = comids[order]
+    first = np.ones(len(ids),dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    return ids[first], comids[first]
+
+def loadIndex(shapefile):
+    """ returns the sorted gage IDs and FLComIDs for the shapefile, building and saving
+        the index if it is missing or out of date
+    """
+    stamp = sourceStamp(shapefile)
+    for index_path in indexPaths(shapefile):
+        try:
+            with np.load(index_path) as index:
+                if np.array_equal(index['stamp'],stamp):
+                    return index['ids'], index['comids']
+        except:
+            continue
+
+    ids, comids = buildIndex(shapefile)
+
+    # save to the first writable location; write to a temp file first so concurrent
+    # readers never see a partial index
+    for index_path in indexPaths(shapefile):
+        tmp_path = '%s.%d.tmp' % (index_path,os.getpid())
+        try:
+            os.makedirs(os.path.dirname(index_path),exist_ok=True)
+            with open(tmp_path,'wb') as outFile:
+                np.savez(outFile,ids=ids,comids=comids,stamp=stamp)
+            os.replace(tmp_path,index_path)
+            break
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return ids, comids
+
+def lookupComids(shapefile, gage_ids):
+    """ returns a boolean array indicating which gage IDs were found and an array of
+        their FLComIDs (0 where not found)
+    """
+    ids, comids = loadIndex(shapefile)
+    gage_ids = np.asarray(gage_ids,dtype=str)
+    if len(ids) == 0:
+        return np.zeros(len(gage_ids),dtype=bool), np.zeros(len(gage_ids),dtype=np.int64)
+    pos = np.minimum(np.searchsorted(ids,gage_ids),len(ids) - 1)
+    found = ids[pos] == gage_ids
+    return found, np.where(found,comids[pos],0)
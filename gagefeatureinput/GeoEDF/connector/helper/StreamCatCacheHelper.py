@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+import zipfile
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+""" Helper module for maintaining a local cache of StreamCat region files shared across runs. StreamCat
+    ZIP files are downloaded once, extracted, and stored in a directory addressed by a hash of the file
+    name, ETag, and size reported by the server. An SQLite index maps each file name to its current entry.
+    Entries are reused without contacting the server for CACHE_TTL seconds; after that the ETag and size
+    are revalidated with a HEAD request and the file is only downloaded again if they have changed.
+    The extracted files are linked into the caller's directory (hardlinks, falling back to copies across
+    file systems). The total size of the cache is bounded; the least recently used entries are evicted
+    once it exceeds MAX_CACHE_BYTES.
+"""
+
+STREAMCAT_URL = 'https://gaftp.epa.gov/epadatacommons/ORD/NHDPlusLandscapeAttributes/StreamCat/HydroRegions/'
+
+# cache location can be overridden via the environment, e.g. to point to a shared scratch directory
+CACHE_DIR = os.environ.get('GEOEDF_STREAMCAT_CACHE_DIR',os.path.expanduser('~/.cache/geoedf/streamcat'))
+
+# maximum total size in bytes of the extracted files retained in the cache
+MAX_CACHE_BYTES = int(os.environ.get('GEOEDF_STREAMCAT_CACHE_BYTES',str(10*1024*1024*1024)))
+
+# number of seconds an entry is used before revalidating with the server; StreamCat files rarely change
+CACHE_TTL = int(os.environ.get('GEOEDF_STREAMCAT_CACHE_TTL',str(30*86400)))
+
+def connect():
+    """ opens (and if needed creates) the cache index
+    """
+    os.makedirs(os.path.join(CACHE_DIR,'objects'),exist_ok=True)
+    conn = sqlite3.connect(os.path.join(CACHE_DIR,'index.db'),timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, key TEXT, etag TEXT, size TEXT, bytes INTEGER, fetched REAL, accessed REAL)')
+    return conn
+
+def entryKey(name, etag, size):
+    """ constructs the content address of a file from its name, ETag, and size
+    """
+    return hashlib.sha256(('%s|%s|%s' % (name,etag,size)).encode('utf-8')).hexdigest()
+
+def entryDir(key):
+    return os.path.join(CACHE_DIR,'objects',key)
+
+def remoteVersion(name):
+    """ returns the (ETag, size) of a StreamCat file reported by the server
+    """
+    res = requests.head(STREAMCAT_URL + name,allow_redirects=True,verify=False,timeout=60)
+    res.raise_for_status()
+    return res.headers.get('ETag'), res.headers.get('Content-Length')
+
+def lookup(conn, name):
+    """ returns the cache entry for name if it is present and current, or None
+    """
+    row = conn.execute('SELECT key, etag, size, fetched FROM entries WHERE name = ?',(name,)).fetchone()
+    if row is None or not os.path.isdir(entryDir(row[0])):
+        return None
+    key, etag, size, fetched = row
+    if time.time() - fetched < CACHE_TTL:
+        return key
+
+    # revalidate with the server; if the server cannot be reached use the entry as is
+    try:
+        remote_etag, remote_size = remoteVersion(name)
+    except:
+        return key
+    if remote_etag == etag and remote_size == size:
+        with conn:
+            conn.execute('UPDATE entries SET fetched = ? WHERE name = ?',(time.time(),name))
+        return key
+    return None
+
+def download(name):
+    """ downloads and extracts a StreamCat ZIP file into a new cache entry; returns the
+        entry's key, the ETag and size of the file, and the number of bytes extracted
+    """
+    res = requests.get(STREAMCAT_URL + name,stream=True,verify=False,timeout=60)
+    res.raise_for_status()
+    etag = res.headers.get('ETag')
+    size = res.headers.get('Content-Length')
+    key = entryKey(name,etag,size)
+
+    # download and extract into temporary locations in the cache, then rename into place
+    # so that concurrent runs never see a partial entry
+    tmp_dir = tempfile.mkdtemp(dir=CACHE_DIR,prefix='.%s.' % name)
+    try:
+        zip_path = os.path.join(tmp_dir,name)
+        with open(zip_path,'wb') as outFile:
+            for chunk in res.iter_content(chunk_size=1024*1024):
+                outFile.write(chunk)
+        extract_dir = os.path.join(tmp_dir,'files')
+        with zipfile.ZipFile(zip_path,'r') as zip_ref:
+            zip_ref.extractall(extract_dir)
+        nbytes = sum(os.path.getsize(os.path.join(root,f)) for root, dirs, files in os.walk(extract_dir) for f in files)
+        try:
+            os.rename(extract_dir,entryDir(key))
+        except OSError:
+            # another run stored the same entry first
+            if not os.path.isdir(entryDir(key)):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir,ignore_errors=True)
+
+    return key, etag, size, nbytes
+
+def evict(conn, keep):
+    """ removes least recently used entries until the cache is within MAX_CACHE_BYTES;
+        entries with keys in keep are never evicted
+    """
+    total = conn.execute('SELECT COALESCE(SUM(bytes),0) FROM entries').fetchone()[0]
+    for name, key, nbytes in conn.execute('SELECT name, key, bytes FROM entries ORDER BY accessed ASC').fetchall():
+        if total <= MAX_CACHE_BYTES:
+            break
+        if key in keep:
+            continue
+        conn.execute('DELETE FROM entries WHERE name = ?',(name,))
+        shutil.rmtree(entryDir(key),ignore_errors=True)
+        total -= nbytes
+
+def linkFiles(key, destDir):
+    """ links the extracted files of a cache entry into destDir; returns the linked paths
+    """
+    linked = []
+    src_root = entryDir(key)
+    for root, dirs, files in os.walk(src_root):
+        for filename in files:
+            src = os.path.join(root,filename)
+            dest = os.path.join(destDir,os.path.relpath(src,src_root))
+            os.makedirs(os.path.dirname(dest),exist_ok=True)
+            if os.path.exists(dest):
+                os.remove(dest)
+            try:
+                os.link(src,dest)
+            except OSError:
+                # cache is on a different file system
+                shutil.copyfile(src,dest)
+            linked.append(dest)
+    return linked
+
+def fetchFiles(names, destDir, max_workers=4):
+    """ makes the extracted contents of the given StreamCat ZIP files available in destDir,
+        downloading only the files that are not in the cache; downloads run concurrently
+        returns a dict mapping each name to the list of files linked into destDir
+    """
+    conn = connect()
+    try:
+        keys = {}
+        for name in names:
+            key = lookup(conn,name)
+            if key is not None:
+                keys[name] = key
+
+        missing = [name for name in names if name not in keys]
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [(name,executor.submit(download,name)) for name in missing]
+
+            # record all successful downloads before reporting any failure
+            failed = []
+            with conn:
+                for name, future in futures:
+                    try:
+                        key, etag, size, nbytes = future.result()
+                    except Exception as e:
+                        failed.append('%s (%s)' % (name,e))
+                        continue
+                    # an outdated entry for the same name is replaced
+                    row = conn.execute('SELECT key FROM entries WHERE name = ?',(name,)).fetchone()
+                    if row is not None and row[0] != key:
+                        shutil.rmtree(entryDir(row[0]),ignore_errors=True)
+                    conn.execute('INSERT OR REPLACE INTO entries (name, key, etag, size, bytes, fetched, accessed) VALUES (?,?,?,?,?,?,?)',
+                                 (name,key,etag,size,nbytes,time.time(),time.time()))
+                    keys[name] = key
+            if len(failed) > 0:
+                raise IOError('Error downloading StreamCat files %s' % ', '.join(failed))
+
+        with conn:
+            conn.executemany('UPDATE entries SET accessed = ? WHERE name = ?',[(time.time(),name) for name in names])
+            evict(conn,set(keys.values()))
+
+        return {name: linkFiles(keys[name],destDir) for name in names}
+    finally:
+        conn.close()
@@ -3,25 +3,39 @@
 
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
+from GeoEDF.connector.helper import StreamCatCacheHelper
+from GeoEDF.connector.helper import GageLocIndexHelper
 
 import pandas as pd
 import geopandas as gpd
 import requests
-import hydrofunctions as hf
-from osgeo import ogr
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+import io
 import os
-import zipfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 """ Module for implementing the Gage feature input connector plugin. This plugin will retrieve data 
     from the StreamCat database and produce a CSV file with watershed characteristics. The plugin 
-    takes a comma separated list of gage IDs as input. 
+    takes a comma separated list of gage IDs as input. The HUC2 region of each gage is determined with a
+    single spatial join of all gage locations against the HUC2 polygons. Site information for the gages is
+    fetched from the NWIS site service in concurrent multi-site requests. StreamCat region files are kept in
+    a cache shared across runs (see StreamCatCacheHelper) and linked into the target path, so they are
+    only downloaded when missing or changed. Only the needed columns of the StreamCat files are read, in
+    chunks, retaining only the rows for the gages' COMIDs; all variables are then joined at once. Gage
+    FLComIDs are looked up in a precomputed index of the GageLoc shapefile (see GageLocIndexHelper).
+    Gages are processed region by region in batches of at most batch_size gages, and the rows for each
+    batch are appended to the output file (CSV, or row groups of a Parquet file if output_format is
+    parquet) as soon as they are complete, so memory use is bounded by the batch size.
 """
 
 class GageFeatureInput(GeoEDFPlugin):
 
     # auth is also required by GageFeatureInput
-    __optional_params = []
+    __optional_params = ['batch_size','output_format']
     __required_params = ['gages']
 
     # path to GageLoc shapefile that is installed as part of this filter package
@@ -45,6 +59,30 @@ class GageFeatureInput(GeoEDFPlugin):
     __streamcat_var['STATSGO_Set1'] = ['SandWs','ClayWs']
     __streamcat_var['GeoChemPhys3'] = ['HydrlCondWs']
     __streamcat_var['ImperviousSurfaces2011'] = ['PctImp2011Ws']
+
+    # number of rows of a StreamCat file read at a time
+    __streamcat_chunk_size = 200000
+
+    # NWIS site service endpoint used to fetch site information for the gages
+    __site_url = 'https://waterservices.usgs.gov/nwis/site/'
+
+    # number of gages per site service request and number of requests run concurrently
+    __site_batch_size = 100
+    __max_workers = 4
+
+    # (connect, read) timeouts in seconds for site service requests
+    __request_timeout = (10,120)
+
+    # number of attempts of a site service request that times out or fails with 429 or 5xx,
+    # and the initial number of seconds to wait between attempts (doubled after each attempt)
+    __max_attempts = 3
+    __backoff_seconds = 1
+
+    # default number of gages processed at a time
+    __batch_size = 5000
+
+    # supported output formats
+    __output_formats = ['csv','parquet']
     
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFInput super class
@@ -71,154 +109,251 @@ class GageFeatureInput(GeoEDFPlugin):
         # class super class init
         super().__init__()
 
-    # helper function to download a file given URL
-    def download_file(self,filename):
-
-        # base URL
-        url_prefix = 'https://gaftp.epa.gov/epadatacommons/ORD/NHDPlusLandscapeAttributes/StreamCat/HydroRegions/'
-
-        download_url = url_prefix + filename
-
-        try: 
-            res = requests.get(download_url,stream=True,verify=False)
-            res.raise_for_status()
-
-            outPath = '%s/%s' % (self.target_path,filename)
-        
-            with open(outPath,'wb') as outFile:
-                for chunk in res.iter_content(chunk_size=1024*1024):
-                    outFile.write(chunk)
-
+    # read the HUC2 region polygons; these are read once and reused for all gages
+    def read_huc2(self):
+        try:
+            return gpd.read_file(self.__huc2_shapefile)[['huc2','geometry']]
         except:
-            raise GeoEDFError('Error downloading StreamCat file %s in GageFeatureInput' % filename)
-
-        return True
-
-    # each Input plugin needs to implement this method
-    # if error, raise exception; if not, return True
-    def get(self):
-
-        # create a list of gage IDs
-        gage_ids = self.gages.split(',')
-
-        # initialize a data frame keyed by gage_ids
-        gages_data = {}
-
-        # create a dict of HUC_2 regions with geometries
-        # this will be used to check which region a gage is located in
-        # also avoids re-reading the shapefile each time
-        
-        driver = ogr.GetDriverByName('ESRI Shapefile')
-        inDataset = driver.Open(self.__huc2_shapefile, 0)
-        if inDataset is None:
             raise GeoEDFError('Error opening HUC2 regions shapefile in GageFeatureInput')
-        inLayer = inDataset.GetLayer()
-
-        # get discharge area, lat-lon, datum for each gage from NWIS
-        for gage_id in gage_ids:
 
-            gage_data = {}
-                
+    # determine the HUC2 region containing each gage
+    # all gage locations are joined against the HUC2 polygons at once; the join uses a spatial
+    # index on the polygon bounding boxes so that only candidate polygons are tested for containment
+    # returns a series of region IDs indexed like gage_feat_df, NaN if a gage is not in any region
+    def huc2_regions(self,gage_feat_df,huc2_df):
+
+        gage_locs = gpd.GeoDataFrame(index=gage_feat_df.index,
+                                     geometry=gpd.points_from_xy(gage_feat_df['Long'].astype(float),gage_feat_df['Lat'].astype(float)),
+                                     crs=huc2_df.crs)
+
+        gage_hucs = gpd.sjoin(gage_locs,huc2_df,'left','within')
+
+        # a gage on the boundary of two regions is assigned to the first one
+        gage_hucs = gage_hucs[~gage_hucs.index.duplicated(keep='first')]
+        return gage_hucs['huc2'].reindex(gage_feat_df.index)
+
+    # parse a tab separated RDB response from NWIS into a DataFrame of strings
+    def read_rdb(self,text):
+        rdb = pd.read_csv(io.StringIO(text),sep='\t',comment='#',dtype=str)
+        # the first row after the header describes the column formats
+        return rdb.iloc[1:]
+
+    # fetch site information for a batch of gages in a single site service request
+    # a batch rejected because of an invalid gage ID is split in half and each half is retried
+    # a request that times out or fails with 429 or 5xx is retried with backoff; if it keeps
+    # failing the batch is split as well, so that only the gages that cannot be fetched are lost
+    # returns a list of DataFrames of the sites that could be retrieved, failed sites are
+    # simply missing and reported by the caller
+    def site_batch(self,gage_batch):
+        site_params = {'format': 'rdb',
+                       'sites': ','.join(gage_batch),
+                       'siteOutput': 'expanded',
+                       'siteStatus': 'all'}
+        delay = self.__backoff_seconds
+        for attempt in range(self.__max_attempts):
+            if attempt > 0:
+                time.sleep(delay)
+                delay *= 2
             try:
-                gage_site_info = hf.site_file(gage_id)
-
-                gage_data['Lat'] = gage_site_info.table['dec_lat_va'].max()
-                gage_data['Long'] = gage_site_info.table['dec_long_va'].max()
-
-                gage_data['Datum'] = gage_site_info.table['alt_va'].max()
-                gage_data['Discharge_Area'] = gage_site_info.table['drain_area_va'].max()
-
+                res = requests.get(self.__site_url,params=site_params,timeout=self.__request_timeout)
+            except (requests.exceptions.Timeout,requests.exceptions.ConnectionError):
+                continue
+            if res.status_code == 429 or res.status_code >= 500:
+                # honour the delay requested by the service
+                try:
+                    delay = max(delay,float(res.headers.get('Retry-After')))
+                except (TypeError,ValueError):
+                    pass
+                continue
+            if res.status_code == 400 and len(gage_batch) > 1:
+                break
+            try:
+                res.raise_for_status()
+                return [self.read_rdb(res.text)]
             except:
                 # fail silently and continue
+                return []
+
+        if len(gage_batch) > 1:
+            half = len(gage_batch) // 2
+            return self.site_batch(gage_batch[:half]) + self.site_batch(gage_batch[half:])
+        return []
+
+    # fetch lat-lon, datum, and drainage area for all gages from the NWIS site service
+    # gages are fetched in concurrent multi-site requests; gages whose info could not be retrieved
+    # are reported and skipped
+    # returns a DataFrame indexed by gage ID
+    def site_info(self,gage_ids):
+        gage_batches = [gage_ids[start:start+self.__site_batch_size] for start in range(0,len(gage_ids),self.__site_batch_size)]
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            site_tables = [table for tables in executor.map(self.site_batch,gage_batches) for table in tables]
+
+        columns = ['Lat','Long','Datum','Drainage_Area']
+        if len(site_tables) == 0:
+            sites = pd.DataFrame(columns=columns)
+        else:
+            sites = pd.concat(site_tables,ignore_index=True)
+            sites = pd.DataFrame({'Lat': pd.to_numeric(sites['dec_lat_va'],errors='coerce').values,
+                                  'Long': pd.to_numeric(sites['dec_long_va'],errors='coerce').values,
+                                  'Datum': pd.to_numeric(sites['alt_va'],errors='coerce').values,
+                                  'Drainage_Area': pd.to_numeric(sites['drain_area_va'],errors='coerce').values},
+                                 index=sites['site_no'].values,columns=columns)
+            # the same site may be returned for more than one agency
+            sites = sites.groupby(level=0,sort=False).max()
+
+        # report gages missing from the responses individually, retaining the order of the gages
+        for gage_id in gage_ids:
+            if gage_id not in sites.index:
                 print('error fetching site info for gage: %s' % gage_id)
-                continue
-
-            # find huc_2 region ID for this gage
-            # initialize
-            gage_data['huc2'] = None
-
-            # create a point geometry for the gage location so we can check intersection
-            gage_loc = ogr.Geometry(ogr.wkbPoint)
-            gage_loc.AddPoint(float(gage_data['Long']),float(gage_data['Lat']))
-            
-            # loop through features in layer to determine containing HUC
-            for feature in inLayer:
-                geom = feature.GetGeometryRef()
-                if geom.Contains(gage_loc):
-                    gage_data['huc2'] = feature.GetField('huc2')
-                    break
-            # reset for next round
-            inLayer.ResetReading()
-            
-            gages_data[gage_id] = gage_data
-
-        # convert the gage feature data dict so far into a DataFrame
-        gage_feat_df = pd.DataFrame.from_dict(gages_data,orient='index')
+        return sites.reindex([gage_id for gage_id in pd.unique(np.array(gage_ids)) if gage_id in sites.index])
+
+    # read the variables of a StreamCat dataset for the given COMIDs from its files for the given regions
+    # only the COMID and variable columns are parsed, and files are read in chunks retaining only the
+    # rows for these COMIDs, so that memory use is bounded by the chunk size and number of COMIDs
+    # returns a DataFrame of the variables indexed by COMID
+    def read_streamcat(self,streamcat_file,regions,comids):
+        streamcat_vars = self.__streamcat_var[streamcat_file]
+        dtypes = {var: 'float64' for var in streamcat_vars}
+        dtypes['COMID'] = 'int64'
+
+        region_data = []
+        for huc_region in regions:
+            region_streamcat_file = '%s/%s_Region%s.csv' % (self.target_path,streamcat_file,huc_region)
+            for chunk in pd.read_csv(region_streamcat_file,usecols=['COMID'] + streamcat_vars,dtype=dtypes,chunksize=self.__streamcat_chunk_size):
+                region_data.append(chunk[chunk['COMID'].isin(comids)])
+
+        streamcat_data = pd.concat(region_data,ignore_index=True).drop_duplicates('COMID')
+        return streamcat_data.set_index('COMID')[streamcat_vars]
+
+    # determine site info, HUC2 region, and FLComID for a batch of gages
+    # returns a DataFrame indexed by gage ID, of only those gages with a region and FLComID
+    def gage_metadata(self,gage_batch,huc2_df):
+
+        # get discharge area, lat-lon, datum for the gages from NWIS
+        gage_feat_df = self.site_info(gage_batch)
         gage_feat_df.index.name = 'Gage_Number2'
+        if len(gage_feat_df) == 0:
+            return gage_feat_df
 
-        # distinct HUC regions that the gages fall into
-        gage_regions = list(set(gage_feat_df['huc2']))
-
-        # download CSVs for the HUC2 regions from StreamCat
-        for huc_region in gage_regions:
-            # loop through StreamCat files, constructing filename for region
-            for streamcat_file in self.__streamcat_files:
-                region_streamcat_file = '%s_Region%s.zip' % (streamcat_file,huc_region)
-                self.download_file(region_streamcat_file)
-
-                #unzip this file
-                region_streamcat_file = '%s/%s_Region%s.zip' % (self.target_path,streamcat_file,huc_region)
-                with zipfile.ZipFile(region_streamcat_file,"r") as zip_ref:
-                    zip_ref.extractall(self.target_path)
+        # find huc_2 region ID for all gages at once
+        gage_feat_df['huc2'] = self.huc2_regions(gage_feat_df,huc2_df)
 
-       # get FLComID for each gage
-        # read gage loc shapefile using GeoPandas
-        gage_loc_df = gpd.read_file(self.__gage_loc_shapefile)
-        gage_loc_df.index = gage_loc_df.SOURCE_FEA
-
-        # first merge gage data with gage loc shapefile
-        # FLComID will be the new merge key
-        gage_feat_df = pd.merge(gage_feat_df,gage_loc_df,how='inner',left_index=True,right_index=True)
-
-        # filter out columns
-        keep_col = ['Gage_Number2','Lat','Long','Drainage_Area','Datum','FLComID']
-        gage_feat_df = gage_feat_df[keep_col]
-
-        # set index now to FLComID
-        gage_feat_df.index = gage_feat_df.FLComID
+        # get FLComID for each gage
+        # looked up in a sorted index of the gage loc shapefile attributes, built on first use
+        try:
+            found, comids = GageLocIndexHelper.lookupComids(self.__gage_loc_shapefile,gage_feat_df.index.values)
+        except:
+            raise GeoEDFError('Error reading GageLoc shapefile in GageFeatureInput')
 
-        # loop through downloaded StreamCat files and merge in
-        for huc_region in gage_regions:
-            # loop through StreamCat files, constructing filename for region
-            for streamcat_file in self.__streamcat_files:
-                region_streamcat_file = '%s/%s_Region%s.csv' % (self.target_path,streamcat_file,huc_region)
+        # retain gages with a region and FLComID, which will be the new merge key
+        gage_feat_df = gage_feat_df.assign(FLComID=comids)
+        return gage_feat_df[found & gage_feat_df['huc2'].notna().values]
 
-                gage_var = pd.read_csv(region_streamcat_file)
-                gage_var.index = gage_var.COMID
+    # join the StreamCat variables for a batch of gages in a single region
+    # returns the output rows for these gages indexed by FLComID
+    def streamcat_batch(self,gage_feat_df,huc_region,keep_col):
 
-                gage_feat_df = pd.merge(gage_feat_df,gage_var,how='inner',left_index=True,right_index=True)
+        # read the variables for the gages' COMIDs from each StreamCat dataset
+        comids = gage_feat_df['FLComID'].unique()
+        try:
+            streamcat_data = [self.read_streamcat(streamcat_file,[huc_region],comids) for streamcat_file in self.__streamcat_files]
+        except:
+            raise GeoEDFError('Error reading StreamCat files in GageFeatureInput')
 
-                keep_col += self.__streamcat_var(streamcat_file)
+        # join all variables at once on FLComID, now the index
+        gage_feat_df = gage_feat_df.reset_index()
+        gage_feat_df.index = gage_feat_df['FLComID']
+        gage_feat_df = gage_feat_df.join(streamcat_data,how='inner')
+        gage_feat_df.index.name = 'FLComID'
 
-                gage_feat_df = gage_feat_df[keep_col]
-                
+        # consistent column types across batches
+        gage_feat_df = gage_feat_df[keep_col]
+        return gage_feat_df.astype({col: 'float64' for col in keep_col if col not in ['Gage_Number2','FLComID']})
+
+    # append a batch of output rows to the output file; for parquet each batch is a row group
+    # of the file written by parquet_writer, which is created with the first batch
+    # returns the parquet writer
+    def write_batch(self,batch_df,res_file,output_format,first_batch,parquet_writer):
+        if output_format == 'csv':
+            batch_df.to_csv(res_file,mode='w' if first_batch else 'a',header=first_batch)
+            return None
+        table = pa.Table.from_pandas(batch_df,preserve_index=False)
+        if parquet_writer is None:
+            parquet_writer = pq.ParquetWriter(res_file,table.schema)
+        parquet_writer.write_table(table)
+        return parquet_writer
 
-        # clean up all temporary files in target path before writing out the dataframe
-        for file_or_dir in os.listdir(self.target_path):
-            os.remove('%s/%s' % (self.target_path,file_or_dir))
+    # each Input plugin needs to implement this method
+    # if error, raise exception; if not, return True
+    def get(self):
 
-        # write out dataframe to csv
-        res_file = '%s/gages.csv' % self.target_path
+        # semantic checks on params
+        # check (1) batch size is a positive integer
+        if self.batch_size is None:
+            batch_size = self.__batch_size
+        else:
+            try:
+                batch_size = int(self.batch_size)
+            except:
+                raise GeoEDFError('Batch size for GageFeatureInput must be a positive integer')
+            if batch_size < 1:
+                raise GeoEDFError('Batch size for GageFeatureInput must be a positive integer')
 
-        gage_feat_df.to_csv(res_file)
+        # check (2) output format is supported
+        output_format = self.output_format.lower() if self.output_format is not None else 'csv'
+        if output_format not in self.__output_formats:
+            raise GeoEDFError('Output format for GageFeatureInput must be one of %s' % ','.join(self.__output_formats))
 
-                
+        # create a list of gage IDs
+        gage_ids = self.gages.split(',')
 
-                
-        
+        # determine site info, region, and FLComID of the gages in batches
+        # this only retains a few values per gage
+        huc2_df = self.read_huc2()
+        gage_meta = pd.concat([self.gage_metadata(gage_ids[start:start+batch_size],huc2_df) for start in range(0,len(gage_ids),batch_size)])
 
-                    
-                        
-             
-                        
+        if len(gage_meta) == 0:
+            raise GeoEDFError('Error fetching site info for all gages in GageFeatureInput')
 
+        # output columns
+        keep_col = ['Gage_Number2','Lat','Long','Drainage_Area','Datum','FLComID']
+        for streamcat_file in self.__streamcat_files:
+            keep_col += self.__streamcat_var[streamcat_file]
+
+        res_file = '%s/gages.%s' % (self.target_path,output_format)
+        first_batch = True
+        parquet_writer = None
+
+        try:
+            # process one region at a time so each region's StreamCat files are only present while needed
+            # and are read once per batch of that region's gages
+            for huc_region, region_gages in gage_meta.groupby('huc2',sort=True):
+
+                # download CSVs for the HUC2 region from StreamCat
+                # files are served from the shared cache, only missing files are downloaded
+                region_streamcat_files = ['%s_Region%s.zip' % (streamcat_file,huc_region) for streamcat_file in self.__streamcat_files]
+                try:
+                    linked_files = StreamCatCacheHelper.fetchFiles(region_streamcat_files,self.target_path,max_workers=self.__max_workers)
+                except Exception as e:
+                    raise GeoEDFError('Error downloading StreamCat files in GageFeatureInput: %s' % e)
+
+                for start in range(0,len(region_gages),batch_size):
+                    batch_df = self.streamcat_batch(region_gages.iloc[start:start+batch_size],huc_region,keep_col)
+                    if len(batch_df) == 0:
+                        continue
+                    parquet_writer = self.write_batch(batch_df,res_file,output_format,first_batch,parquet_writer)
+                    first_batch = False
+
+                # clean up the region's StreamCat files in target path
+                for region_files in linked_files.values():
+                    for region_file in region_files:
+                        os.remove(region_file)
+
+            # no gages had StreamCat data, write out an empty file
+            if first_batch:
+                empty_df = pd.DataFrame(columns=keep_col)
+                empty_df.index.name = 'FLComID'
+                parquet_writer = self.write_batch(empty_df,res_file,output_format,first_batch,parquet_writer)
+        finally:
+            if parquet_writer is not None:
+                parquet_writer.close()
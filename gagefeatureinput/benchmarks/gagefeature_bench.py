@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import resource
+import tempfile
+import subprocess
+
+""" Measures the peak memory use (RSS) of GageFeatureInput for an increasing number of gages. The
+    NWIS site service and the StreamCat file server are replaced by local stubs serving generated
+    data; the HUC2 join, GageLoc index, StreamCat cache, and output writing run unchanged. Fixtures
+    (HUC2 and GageLoc shapefiles, and StreamCat ZIP files for two regions) are generated once, and
+    every run is a separate process, so that each peak RSS reflects a single get() call. Each run
+    also reports the Parquet row groups written, which equal the number of batches if the output is
+    written batch by batch. Requires the GeoEDF framework and the plugin's requirements.
+    Usage: python benchmarks/gagefeature_bench.py [batch size] [number of gages ...]
+"""
+
+# HUC2 regions of the generated gages; each region is a one degree square
+REGIONS = {'01': (-87.0,40.0), '02': (-86.0,40.0)}
+
+# number of rows of each StreamCat file in addition to the gages' rows
+FILLER_ROWS = 50000
+
+def site_no(i):
+    return '%08d' % (10000000 + i)
+
+def comid(i):
+    return 5000000 + i
+
+def site_location(i):
+    """ (lon, lat) of the i-th gage, alternating between the regions """
+    lon, lat = REGIONS[sorted(REGIONS)[i % len(REGIONS)]]
+    return lon + 0.5, lat + 0.0001 + (i // len(REGIONS)) % 9000 / 10000.0
+
+def make_fixtures(fixture_dir, max_gages):
+    """ writes the HUC2 and GageLoc shapefiles and the StreamCat ZIP files for max_gages gages """
+    import numpy as np
+    import pandas as pd
+    import geopandas as gpd
+    from shapely.geometry import box
+    from GeoEDF.connector.input.GageFeatureInput import GageFeatureInput
+
+    gpd.GeoDataFrame({'huc2': sorted(REGIONS)},geometry=[box(lon,lat,lon + 1,lat + 1) for region, (lon, lat) in sorted(REGIONS.items())],
+                     crs='EPSG:4269').to_file(os.path.join(fixture_dir,'HUC2.shp'))
+
+    locations = [site_location(i) for i in range(max_gages)]
+    gpd.GeoDataFrame({'SOURCE_FEA': [site_no(i) for i in range(max_gages)],'FLComID': [comid(i) for i in range(max_gages)]},
+                     geometry=gpd.points_from_xy([loc[0] for loc in locations],[loc[1] for loc in locations]),
+                     crs='EPSG:4269').to_file(os.path.join(fixture_dir,'GageLoc.shp'))
+
+    streamcat_vars = GageFeatureInput._GageFeatureInput__streamcat_var
+    rng = np.random.default_rng(0)
+    for r, region in enumerate(sorted(REGIONS)):
+        comids = np.concatenate([[comid(i) for i in range(r,max_gages,len(REGIONS))],np.arange(FILLER_ROWS) + 1])
+        for streamcat_file in GageFeatureInput._GageFeatureInput__streamcat_files:
+            rows = {'COMID': comids,'CatAreaSqKm': rng.random(len(comids))}
+            for var in streamcat_vars[streamcat_file]:
+                rows[var] = rng.random(len(comids))
+            name = '%s_Region%s' % (streamcat_file,region)
+            with zipfile.ZipFile(os.path.join(fixture_dir,'%s.zip' % name),'w',zipfile.ZIP_DEFLATED) as zip_ref:
+                zip_ref.writestr('%s.csv' % name,pd.DataFrame(rows).to_csv(index=False))
+
+class Response:
+    """ minimal stand-in for a requests response """
+    def __init__(self, status_code=200, text='', content=b'', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError('HTTP %d' % self.status_code,response=self)
+
+    def iter_content(self, chunk_size=1):
+        return (self.content[start:start+chunk_size] for start in range(0,len(self.content),chunk_size))
+
+def stub_services(fixture_dir):
+    """ replaces the NWIS site service and the StreamCat file server """
+    import requests
+
+    def site_rdb(site_nos):
+        lines = ['# stub site service','agency_cd\tsite_no\tdec_lat_va\tdec_long_va\talt_va\tdrain_area_va','5s\t15s\t16s\t16s\t8s\t8s']
+        for site in site_nos:
+            lon, lat = site_location(int(site) - 10000000)
+            lines.append('USGS\t%s\t%.6f\t%.6f\t600\t12.5' % (site,lat,lon))
+        return '\n'.join(lines) + '\n'
+
+    def streamcat_file(url):
+        path = os.path.join(fixture_dir,url.split('/')[-1])
+        return path, {'ETag': '"%d"' % os.path.getmtime(path),'Content-Length': str(os.path.getsize(path))}
+
+    def get(url, params=None, **kwargs):
+        if 'waterservices' in url:
+            return Response(text=site_rdb(params['sites'].split(',')))
+        path, headers = streamcat_file(url)
+        with open(path,'rb') as zip_file:
+            return Response(content=zip_file.read(),headers=headers)
+
+    def head(url, **kwargs):
+        return Response(headers=streamcat_file(url)[1])
+
+    requests.get = get
+    requests.head = head
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxrss / 1024.0
+
+def run(fixture_dir, num_gages, batch_size):
+    """ runs get() for num_gages gages in this process and prints the measurements as JSON """
+    work_dir = tempfile.mkdtemp(prefix='gagefeature_bench.')
+    os.environ['GEOEDF_STREAMCAT_CACHE_DIR'] = os.path.join(work_dir,'cache')
+    os.environ['GEOEDF_GAGELOC_CACHE_DIR'] = os.path.join(work_dir,'cache')
+
+    import pyarrow.parquet as pq
+    from GeoEDF.connector.input.GageFeatureInput import GageFeatureInput
+
+    stub_services(fixture_dir)
+    GageFeatureInput._GageFeatureInput__huc2_shapefile = os.path.join(fixture_dir,'HUC2.shp')
+    GageFeatureInput._GageFeatureInput__gage_loc_shapefile = os.path.join(fixture_dir,'GageLoc.shp')
+
+    # record the size of each batch as it is written
+    batches = []
+    write_batch = GageFeatureInput.write_batch
+    def record_batch(self, batch_df, *args):
+        batches.append(len(batch_df))
+        return write_batch(self,batch_df,*args)
+    GageFeatureInput.write_batch = record_batch
+
+    try:
+        plugin = GageFeatureInput(gages=','.join(site_no(i) for i in range(num_gages)),batch_size=str(batch_size),output_format='parquet')
+        plugin.target_path = os.path.join(work_dir,'out')
+        os.makedirs(plugin.target_path)
+        baseline = max_rss_mb()
+        start = time.perf_counter()
+        plugin.get()
+        seconds = time.perf_counter() - start
+
+        metadata = pq.ParquetFile(os.path.join(plugin.target_path,'gages.parquet')).metadata
+        row_groups = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+        print(json.dumps({'gages': num_gages,'seconds': seconds,'baseline_mb': baseline,'peak_mb': max_rss_mb(),
+                          'rows': metadata.num_rows,'row_groups': row_groups,'batches': batches}))
+    finally:
+        shutil.rmtree(work_dir,ignore_errors=True)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2],int(sys.argv[3]),int(sys.argv[4]))
+        return
+
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    sizes = [int(size) for size in sys.argv[2:]] or [100,1000,5000,20000]
+
+    fixture_dir = tempfile.mkdtemp(prefix='gagefeature_fixtures.')
+    try:
+        make_fixtures(fixture_dir,max(sizes))
+        print('batch size %d, %d StreamCat filler rows per file' % (batch_size,FILLER_ROWS))
+        print('%8s %10s %12s %12s %10s %10s' % ('gages','seconds','baseline MB','peak MB','rows','row groups'))
+        for num_gages in sizes:
+            output = subprocess.run([sys.executable,os.path.abspath(__file__),'--run',fixture_dir,str(num_gages),str(batch_size)],
+                                    stdout=subprocess.PIPE,check=True,universal_newlines=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            # every batch is written as its own row group, no larger than the batch size
+            batched = result['row_groups'] == result['batches'] and max(result['batches']) <= batch_size
+            print('%8d %10.2f %12.1f %12.1f %10d %10d%s' % (num_gages,result['seconds'],result['baseline_mb'],result['peak_mb'],
+                                                          result['rows'],len(result['row_groups']),'' if batched else '  NOT BATCHED'))
+    finally:
+        shutil.rmtree(fixture_dir,ignore_errors=True)
+
+if __name__ == '__main__':
+    # run from the gagefeatureinput directory so the plugin package is importable
+    sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main()
@@ -0,0 +1,342 @@
+import io
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+import requests
+
+pytest.importorskip('geoedfframework')
+gpd = pytest.importorskip('geopandas')
+pq = pytest.importorskip('pyarrow.parquet')
+
+from shapely.geometry import box
+
+from GeoEDF.connector.helper import StreamCatCacheHelper
+from GeoEDF.connector.input.GageFeatureInput import GageFeatureInput
+
+# run from the gagefeatureinput directory with: python -m pytest tests
+
+STREAMCAT_VARS = ['ElevWs','DamDensWs','PctConif2011Ws','PctDecid2011Ws','PctMxtFst2011Ws','PctUrbHi2011Ws','PctUrbLo2011Ws',
+                  'PctUrbOp2011Ws','PermWs','RdDensWs','WetIndexWs','SandWs','ClayWs','HydrlCondWs','PctImp2011Ws']
+
+@pytest.fixture
+def huc2_shapefile(tmp_path, monkeypatch):
+    """ two adjacent unit square HUC2 regions, 01 west of 02 """
+    shapefile = str(tmp_path / 'HUC2.shp')
+    gpd.GeoDataFrame({'huc2': ['01','02'],'name': ['West','East']},geometry=[box(0,0,1,1),box(1,0,2,1)],crs='EPSG:4269').to_file(shapefile)
+    monkeypatch.setattr(GageFeatureInput,'_GageFeatureInput__huc2_shapefile',shapefile)
+    return shapefile
+
+def test_huc2_regions(huc2_shapefile):
+    plugin = GageFeatureInput(gages='1')
+    huc2_df = plugin.read_huc2()
+    assert list(huc2_df.columns) == ['huc2','geometry']
+
+    # site service values are strings; one gage outside all regions, one on the shared boundary
+    gage_feat_df = pd.DataFrame({'Lat': ['0.5','0.5','5.0','0.5','0.25'],'Long': ['1.5','0.5','5.0','1.0','0.75']},
+                                index=['g1','g2','g3','g4','g5'])
+    regions = plugin.huc2_regions(gage_feat_df,huc2_df)
+    assert list(regions.index) == ['g1','g2','g3','g4','g5']
+    assert regions['g1'] == '02'
+    assert regions['g2'] == '01'
+    assert regions['g5'] == '01'
+    assert pd.isna(regions['g3'])
+    # a point on the boundary is not within either polygon
+    assert pd.isna(regions['g4'])
+
+def test_huc2_overlapping_regions_keep_first(huc2_shapefile):
+    plugin = GageFeatureInput(gages='1')
+    huc2_df = gpd.GeoDataFrame({'huc2': ['01','03']},geometry=[box(0,0,1,1),box(0,0,2,2)],crs='EPSG:4269')
+    regions = plugin.huc2_regions(pd.DataFrame({'Lat': [0.5,1.5],'Long': [0.5,1.5]},index=['g1','g2']),huc2_df)
+    assert regions.tolist() == ['01','03']
+
+def test_missing_huc2_shapefile(tmp_path, monkeypatch):
+    monkeypatch.setattr(GageFeatureInput,'_GageFeatureInput__huc2_shapefile',str(tmp_path / 'missing.shp'))
+    with pytest.raises(Exception,match='HUC2'):
+        GageFeatureInput(gages='1').read_huc2()
+
+def site_rdb(site_nos):
+    """ site service RDB response (siteOutput=expanded, abridged) for the given sites """
+    lines = ['# US Geological Survey','agency_cd\tsite_no\tdec_lat_va\tdec_long_va\talt_va\tdrain_area_va','5s\t15s\t16s\t16s\t8s\t8s']
+    for site_no in site_nos:
+        lines.append('USGS\t%s\t40.%s\t-86.%s\t600\t%s' % (site_no,site_no[-2:],site_no[-2:],int(site_no[-2:]) + 1))
+    return '\n'.join(lines) + '\n'
+
+class Response:
+    def __init__(self, status_code, text='', headers=None, content=b''):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.content = content
+
+    def iter_content(self, chunk_size=1):
+        return (self.content[start:start+chunk_size] for start in range(0,len(self.content),chunk_size))
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('HTTP %d' % self.status_code,response=self)
+
+class SiteService:
+    """ stands in for the NWIS site service: requests including a stalled gage time out, and
+        requests including a flaky gage fail with 503 the given number of times """
+    def __init__(self, stalled=(), flaky=(), failures=1, invalid=()):
+        self.stalled = set(stalled)
+        self.flaky = set(flaky)
+        self.failures = failures
+        self.invalid = set(invalid)
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        assert timeout is not None
+        site_nos = params['sites'].split(',')
+        self.requests.append(site_nos)
+        if self.stalled & set(site_nos):
+            raise requests.exceptions.ReadTimeout()
+        if self.failures > 0 and self.flaky & set(site_nos):
+            self.failures -= 1
+            return Response(503,headers={'Retry-After': '0'})
+        if self.invalid & set(site_nos):
+            return Response(400)
+        return Response(200,site_rdb(site_nos))
+
+SITES = ['033350%02d' % i for i in range(40)]
+
+@pytest.fixture
+def site_service(monkeypatch):
+    monkeypatch.setattr(GageFeatureInput,'_GageFeatureInput__backoff_seconds',0)
+    def make(**kwargs):
+        service = SiteService(**kwargs)
+        monkeypatch.setattr(requests,'get',service.get)
+        return service
+    return make
+
+def test_site_info(site_service):
+    service = site_service()
+    sites = GageFeatureInput(gages='1').site_info(SITES)
+    assert list(sites.index) == SITES
+    assert sites.loc['03335007','Lat'] == 40.07
+    assert sites.loc['03335007','Drainage_Area'] == 8
+    assert len(service.requests) == 1
+
+def test_site_batch_retries_5xx(site_service):
+    service = site_service(flaky=[SITES[5]],failures=2)
+    sites = GageFeatureInput(gages='1').site_info(SITES)
+    assert list(sites.index) == SITES
+    # the whole batch was retried, not split
+    assert [len(batch) for batch in service.requests] == [40,40,40]
+
+def test_site_batch_isolates_stalled_gage(site_service, capsys):
+    service = site_service(stalled=[SITES[5]])
+    sites = GageFeatureInput(gages='1').site_info(SITES)
+    # only the gage that keeps timing out is dropped and reported
+    assert list(sites.index) == SITES[:5] + SITES[6:]
+    assert capsys.readouterr().out == 'error fetching site info for gage: %s\n' % SITES[5]
+    assert service.requests.count([SITES[5]]) == 3
+
+def test_site_batch_splits_invalid_ids(site_service):
+    service = site_service(invalid=['bad'])
+    sites = GageFeatureInput(gages='1').site_info(SITES[:3] + ['bad'])
+    assert list(sites.index) == SITES[:3]
+    assert service.requests.count(['bad']) == 1
+
+@pytest.fixture
+def gageloc_shapefile(tmp_path, monkeypatch):
+    """ GageLoc shapefile with FLComIDs for all but the last of SITES """
+    from GeoEDF.connector.helper import GageLocIndexHelper
+    monkeypatch.setattr(GageLocIndexHelper,'CACHE_DIR',str(tmp_path / 'cache'))
+    shapefile = str(tmp_path / 'GageLoc.shp')
+    gpd.GeoDataFrame({'SOURCE_FEA': SITES[:-1],'FLComID': [100 + i for i in range(len(SITES) - 1)]},
+                     geometry=gpd.points_from_xy([-86.0] * (len(SITES) - 1),[40.0] * (len(SITES) - 1)),crs='EPSG:4269').to_file(shapefile)
+    monkeypatch.setattr(GageFeatureInput,'_GageFeatureInput__gage_loc_shapefile',shapefile)
+    return shapefile
+
+# region 01 covers SITES with latitudes below 40.20, region 02 the others up to 40.29
+SITE_REGIONS = {'01': box(-87,39.9,-85.9,40.195),'02': box(-87,40.195,-85.9,40.295)}
+
+def test_gage_metadata(site_service, gageloc_shapefile):
+    site_service()
+    huc2_df = gpd.GeoDataFrame({'huc2': list(SITE_REGIONS)},geometry=list(SITE_REGIONS.values()),crs='EPSG:4269')
+    meta = GageFeatureInput(gages='1').gage_metadata(SITES,huc2_df)
+
+    # gages from 40.30 on have no region, the last gage has no FLComID
+    assert list(meta.index) == SITES[:30]
+    assert meta.index.name == 'Gage_Number2'
+    assert meta['huc2'].tolist() == ['01'] * 20 + ['02'] * 10
+    assert meta['FLComID'].tolist() == [100 + i for i in range(30)]
+
+STREAMCAT_FILES = {'Elevation': ['ElevWs'],'Dams': ['DamDensWs'],
+                   'NLCD2011': ['PctConif2011Ws','PctDecid2011Ws','PctMxtFst2011Ws','PctUrbHi2011Ws','PctUrbLo2011Ws','PctUrbOp2011Ws'],
+                   'STATSGO_Set2': ['PermWs'],'RoadDensity': ['RdDensWs'],'WetIndx': ['WetIndexWs'],'STATSGO_Set1': ['SandWs','ClayWs'],
+                   'GeoChemPhys3': ['HydrlCondWs'],'ImperviousSurfaces2011': ['PctImp2011Ws']}
+
+def streamcat_value(comid, var):
+    return comid + STREAMCAT_VARS.index(var) / 100
+
+def streamcat_csv(streamcat_file, comids):
+    """ contents of a StreamCat CSV file for the given COMIDs; besides the variables, each
+        file has a catchment area column and a text column that are not needed """
+    rows = {'COMID': comids,'CatAreaSqKm': [1.5] * len(comids),'Notes': ['n/a'] * len(comids)}
+    for var in STREAMCAT_FILES[streamcat_file]:
+        rows[var] = [streamcat_value(comid,var) for comid in comids]
+    return pd.DataFrame(rows).to_csv(index=False)
+
+def write_streamcat(target_path, region, comids):
+    """ writes the StreamCat CSV files of a region for the given COMIDs """
+    for streamcat_file in STREAMCAT_FILES:
+        with open(os.path.join(str(target_path),'%s_Region%s.csv' % (streamcat_file,region)),'w') as csv_file:
+            csv_file.write(streamcat_csv(streamcat_file,comids))
+
+@pytest.fixture
+def streamcat_input(tmp_path, monkeypatch):
+    # read files a few rows at a time
+    monkeypatch.setattr(GageFeatureInput,'_GageFeatureInput__streamcat_chunk_size',3)
+    plugin = GageFeatureInput(gages='1')
+    plugin.target_path = str(tmp_path)
+    write_streamcat(tmp_path,'01',list(range(100,110)))
+    write_streamcat(tmp_path,'02',list(range(200,205)) + [100])
+    return plugin
+
+def test_read_streamcat(streamcat_input, monkeypatch):
+    read_csv = pd.read_csv
+    calls = []
+    def record(*args, **kwargs):
+        calls.append(kwargs)
+        return read_csv(*args,**kwargs)
+    monkeypatch.setattr(pd,'read_csv',record)
+
+    data = streamcat_input.read_streamcat('NLCD2011',['01','02'],[109,101,202,999])
+    # only the requested COMIDs, once each, and only the variable columns
+    assert sorted(data.index) == [101,109,202]
+    assert list(data.columns) == STREAMCAT_FILES['NLCD2011']
+    assert data.loc[202,'PctUrbHi2011Ws'] == streamcat_value(202,'PctUrbHi2011Ws')
+    assert all(dtype == 'float64' for dtype in data.dtypes)
+    assert [call['usecols'] for call in calls] == [['COMID'] + STREAMCAT_FILES['NLCD2011']] * 2
+    assert all(call['chunksize'] == 3 for call in calls)
+
+def test_read_streamcat_duplicate_comid(streamcat_input):
+    # COMID 100 is in both regions, the first is kept
+    data = streamcat_input.read_streamcat('Dams',['01','02'],[100])
+    assert list(data.index) == [100]
+
+def test_streamcat_batch_joins_all_files(streamcat_input):
+    keep_col = ['Gage_Number2','Lat','Long','Drainage_Area','Datum','FLComID'] + STREAMCAT_VARS
+    gage_feat_df = pd.DataFrame({'Lat': [40.1,40.2,40.3],'Long': [-86.1,-86.2,-86.3],'Datum': [600.0,610.0,620.0],
+                                 'Drainage_Area': [1.0,2.0,3.0],'huc2': '01','FLComID': [103,105,999]},
+                                index=pd.Index(['g1','g2','g3'],name='Gage_Number2'))
+    batch_df = streamcat_input.streamcat_batch(gage_feat_df,'01',keep_col)
+
+    # a gage without StreamCat data is dropped
+    assert list(batch_df.columns) == keep_col
+    assert batch_df.index.name == 'FLComID'
+    assert list(batch_df.index) == [103,105]
+    assert batch_df['Gage_Number2'].tolist() == ['g1','g2']
+    for var in STREAMCAT_VARS:
+        assert batch_df.loc[105,var] == streamcat_value(105,var)
+    assert batch_df.loc[103,'Lat'] == 40.1
+    assert batch_df['Datum'].dtype == 'float64'
+
+class StreamCatFiles:
+    """ stands in for the StreamCat file server, serving the ZIP files of each region with
+        rows for the given COMIDs """
+    def __init__(self, region_comids):
+        self.files = {}
+        self.gets = []
+        for region, comids in region_comids.items():
+            for streamcat_file in STREAMCAT_FILES:
+                name = '%s_Region%s' % (streamcat_file,region)
+                out = io.BytesIO()
+                with zipfile.ZipFile(out,'w') as zip_ref:
+                    zip_ref.writestr('%s.csv' % name,streamcat_csv(streamcat_file,comids))
+                self.files['%s.zip' % name] = out.getvalue()
+
+    def response(self, url):
+        name = url.split('/')[-1]
+        if name not in self.files:
+            return Response(404)
+        return Response(200,headers={'ETag': '"v1"','Content-Length': str(len(self.files[name]))},content=self.files[name])
+
+    def get(self, url, **kwargs):
+        assert kwargs.get('timeout') is not None
+        self.gets.append(url.split('/')[-1])
+        return self.response(url)
+
+    def head(self, url, **kwargs):
+        return self.response(url)
+
+def written_rows(res_file, output_format):
+    # only CSV output can be read before the file is complete
+    if output_format != 'csv' or not os.path.exists(res_file):
+        return 0
+    return len(pd.read_csv(res_file))
+
+@pytest.fixture
+def gage_input(tmp_path, monkeypatch, site_service, gageloc_shapefile):
+    """ returns a function creating a GageFeatureInput for SITES, with only the site service and
+        the StreamCat file server replaced; the HUC2 and GageLoc shapefiles are those of
+        SITE_REGIONS and gageloc_shapefile, and the StreamCat files of each region have rows
+        for the given COMIDs. The function returns the plugin, output file, StreamCat server, and
+        the list of batches passed to streamcat_batch with the rows written before each """
+    huc2_shapefile = str(tmp_path / 'HUC2.shp')
+    gpd.GeoDataFrame({'huc2': list(SITE_REGIONS)},geometry=list(SITE_REGIONS.values()),crs='EPSG:4269').to_file(huc2_shapefile)
+    monkeypatch.setattr(GageFeatureInput,'_GageFeatureInput__huc2_shapefile',huc2_shapefile)
+    monkeypatch.setattr(StreamCatCacheHelper,'CACHE_DIR',str(tmp_path / 'streamcat'))
+
+    def make(region_comids, batch_size, output_format, gages=SITES):
+        sites = site_service()
+        streamcat = StreamCatFiles(region_comids)
+        monkeypatch.setattr(requests,'get',lambda url, **kwargs: (sites.get if 'waterservices' in url else streamcat.get)(url,**kwargs))
+        monkeypatch.setattr(requests,'head',streamcat.head)
+
+        plugin = GageFeatureInput(gages=','.join(gages),batch_size=str(batch_size),output_format=output_format)
+        plugin.target_path = str(tmp_path / 'out')
+        os.makedirs(plugin.target_path)
+        res_file = os.path.join(plugin.target_path,'gages.%s' % output_format)
+
+        batches = []
+        def streamcat_batch(gage_feat_df, huc_region, keep_col):
+            batches.append((len(gage_feat_df),written_rows(res_file,output_format)))
+            return GageFeatureInput.streamcat_batch(plugin,gage_feat_df,huc_region,keep_col)
+        monkeypatch.setattr(plugin,'streamcat_batch',streamcat_batch)
+        return plugin, res_file, streamcat, batches
+    return make
+
+# StreamCat rows for the FLComIDs of the gages in each region, except for the gage with FLComID 105,
+# and for some other catchments
+REGION_COMIDS = {'01': [comid for comid in range(100,120) if comid != 105] + [1,2,3],'02': list(range(120,130)) + [4,5]}
+
+def test_parquet_row_group_per_batch(gage_input):
+    plugin, res_file, streamcat, batches = gage_input(REGION_COMIDS,8,'parquet')
+    plugin.get()
+    parquet_file = pq.ParquetFile(res_file)
+    row_groups = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+
+    # batches are per region and never larger than batch_size; gages without StreamCat data are dropped
+    assert [num_gages for num_gages, _ in batches] == [8,8,4,8,2]
+    assert row_groups == [7,8,4,8,2]
+    output = parquet_file.read().to_pandas()
+    assert output['Gage_Number2'].tolist() == SITES[:5] + SITES[6:30]
+    assert output['FLComID'].tolist() == [100 + i for i in range(30) if i != 5]
+    row = output.set_index('FLComID').loc[123]
+    for var in STREAMCAT_VARS:
+        assert row[var] == streamcat_value(123,var)
+    assert row['Lat'] == 40.23
+
+    # each region's files are downloaded once, and removed from the target path when done
+    assert sorted(streamcat.gets) == sorted(streamcat.files)
+    assert os.listdir(plugin.target_path) == ['gages.parquet']
+
+def test_csv_written_incrementally(gage_input):
+    plugin, res_file, streamcat, batches = gage_input(REGION_COMIDS,8,'csv')
+    plugin.get()
+    # rows of earlier batches are already in the output when the next batch is joined
+    assert batches == [(8,0),(8,7),(4,15),(8,19),(2,27)]
+    output = pd.read_csv(res_file,dtype={'Gage_Number2': str})
+    assert len(output) == 29
+    assert output['Gage_Number2'].iloc[0] == SITES[0]
+
+def test_no_streamcat_data_writes_empty_file(gage_input):
+    plugin, res_file, streamcat, batches = gage_input({'01': [1,2,3]},10,'parquet',gages=SITES[:3])
+    plugin.get()
+    assert batches == [(3,0)]
+    assert pq.ParquetFile(res_file).metadata.num_rows == 0
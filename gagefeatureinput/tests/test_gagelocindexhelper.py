@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+
+from shapely.geometry import Point
+
+from GeoEDF.connector.helper import GageLocIndexHelper
+
+# run from the gagefeatureinput directory with: python -m pytest tests
+
+def write_gageloc(shapefile, rows):
+    """ writes a GageLoc shapefile of (SOURCE_FEA, FLComID) rows """
+    gpd.GeoDataFrame({'SOURCE_FEA': [row[0] for row in rows],'FLComID': [row[1] for row in rows]},
+                     geometry=[Point(-86.0,40.0)] * len(rows),crs='EPSG:4269').to_file(shapefile)
+
+@pytest.fixture
+def gageloc(tmp_path, monkeypatch):
+    monkeypatch.setattr(GageLocIndexHelper,'CACHE_DIR',str(tmp_path / 'cache'))
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    shapefile = str(data_dir / 'GageLoc.shp')
+    write_gageloc(shapefile,[('03335500',300),('01010000',100),('03335500',301),('02020000',200)])
+    return shapefile
+
+def test_lookup(gageloc):
+    found, comids = GageLocIndexHelper.lookupComids(gageloc,['02020000','00000001','03335500','99999999','01010000'])
+    assert found.tolist() == [True,False,True,False,True]
+    # a repeated gage ID keeps its first FLComID; missing gages have 0
+    assert comids.tolist() == [200,0,300,0,100]
+
+def test_index_built_lazily_next_to_shapefile(gageloc, monkeypatch):
+    index_path = os.path.join(os.path.dirname(gageloc),'GageLoc_index.npz')
+    assert not os.path.exists(index_path)
+    GageLocIndexHelper.lookupComids(gageloc,['01010000'])
+    assert os.path.exists(index_path)
+
+    # later lookups use the saved index
+    def build(shapefile):
+        raise AssertionError('index rebuilt')
+    monkeypatch.setattr(GageLocIndexHelper,'buildIndex',build)
+    assert GageLocIndexHelper.lookupComids(gageloc,['03335500'])[1].tolist() == [300]
+
+def test_index_rebuilt_when_shapefile_changes(gageloc):
+    GageLocIndexHelper.lookupComids(gageloc,['01010000'])
+    write_gageloc(gageloc,[('01010000',111),('04040000',400)])
+    # make sure the modification time differs even on coarse timestamps
+    dbf_path = gageloc.replace('.shp','.dbf')
+    stat = os.stat(dbf_path)
+    os.utime(dbf_path,(stat.st_atime,stat.st_mtime + 10))
+    found, comids = GageLocIndexHelper.lookupComids(gageloc,['01010000','04040000','02020000'])
+    assert found.tolist() == [True,True,False]
+    assert comids.tolist() == [111,400,0]
+
+def test_index_saved_to_cache_dir_when_data_dir_not_writable(gageloc, monkeypatch):
+    # the index cannot be written next to the shapefile
+    data_dir = os.path.dirname(gageloc)
+    replace = os.replace
+    def read_only(src, dest):
+        if os.path.dirname(dest) == data_dir:
+            raise PermissionError('Read-only file system')
+        replace(src,dest)
+    monkeypatch.setattr(os,'replace',read_only)
+    GageLocIndexHelper.lookupComids(gageloc,['01010000'])
+    assert os.path.exists(os.path.join(GageLocIndexHelper.CACHE_DIR,'GageLoc_index.npz'))
+    assert not any(name.startswith('GageLoc_index') for name in os.listdir(data_dir))
+
+    def build(shapefile):
+        raise AssertionError('index rebuilt')
+    monkeypatch.setattr(GageLocIndexHelper,'buildIndex',build)
+    assert GageLocIndexHelper.lookupComids(gageloc,['02020000'])[1].tolist() == [200]
+
+def test_empty_gageloc(tmp_path, monkeypatch):
+    monkeypatch.setattr(GageLocIndexHelper,'CACHE_DIR',str(tmp_path / 'cache'))
+    shapefile = str(tmp_path / 'GageLoc.shp')
+    write_gageloc(shapefile,[])
+    found, comids = GageLocIndexHelper.lookupComids(shapefile,['01010000'])
+    assert found.tolist() == [False]
+    assert comids.dtype == np.int64
@@ -0,0 +1,154 @@
+import io
+import os
+import sqlite3
+import zipfile
+
+import pytest
+import requests
+
+from GeoEDF.connector.helper import StreamCatCacheHelper
+
+# run from the gagefeatureinput directory with: python -m pytest tests
+
+def zipped(files):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out,'w') as zip_ref:
+        for name, data in files.items():
+            zip_ref.writestr(name,data)
+    return out.getvalue()
+
+class Response:
+    def __init__(self, data, etag):
+        self.data = data
+        self.headers = {'ETag': etag,'Content-Length': str(len(data))}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        return (self.data[start:start+chunk_size] for start in range(0,len(self.data),chunk_size))
+
+class StreamCatServer:
+    """ stands in for the StreamCat file server, serving ZIP files with an ETag """
+    def __init__(self):
+        self.files = {}
+        self.gets = []
+        self.heads = []
+
+    def publish(self, name, files, etag):
+        self.files[name] = (zipped(files),etag)
+
+    def get(self, url, **kwargs):
+        assert kwargs.get('timeout') is not None
+        name = url.split('/')[-1]
+        self.gets.append(name)
+        return Response(*self.files[name])
+
+    def head(self, url, **kwargs):
+        assert kwargs.get('timeout') is not None
+        name = url.split('/')[-1]
+        self.heads.append(name)
+        data, etag = self.files[name]
+        return Response(data,etag)
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(StreamCatCacheHelper,'CACHE_DIR',str(tmp_path / 'cache'))
+    server = StreamCatServer()
+    monkeypatch.setattr(requests,'get',server.get)
+    monkeypatch.setattr(requests,'head',server.head)
+    return server
+
+def read(path):
+    with open(path,'rb') as data_file:
+        return data_file.read()
+
+def entry_keys():
+    with sqlite3.connect(os.path.join(StreamCatCacheHelper.CACHE_DIR,'index.db')) as conn:
+        return dict(conn.execute('SELECT name, key FROM entries').fetchall())
+
+def test_cache_hit(server, tmp_path):
+    server.publish('Dams_Region01.zip',{'Dams_Region01.csv': b'COMID,DamDensWs\n1,0.5\n'},'"v1"')
+    first = StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run1'))
+    second = StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run2'))
+
+    # downloaded once, and not revalidated within the TTL
+    assert server.gets == ['Dams_Region01.zip']
+    assert server.heads == []
+    assert second == {'Dams_Region01.zip': [str(tmp_path / 'run2' / 'Dams_Region01.csv')]}
+    assert read(first['Dams_Region01.zip'][0]) == read(second['Dams_Region01.zip'][0]) == b'COMID,DamDensWs\n1,0.5\n'
+
+    # the entry is addressed by the file name, ETag and size
+    data, etag = server.files['Dams_Region01.zip']
+    key = StreamCatCacheHelper.entryKey('Dams_Region01.zip',etag,str(len(data)))
+    assert entry_keys() == {'Dams_Region01.zip': key}
+    assert os.path.isdir(StreamCatCacheHelper.entryDir(key))
+
+def test_expired_entry_unchanged_is_not_downloaded(server, tmp_path, monkeypatch):
+    server.publish('Dams_Region01.zip',{'Dams_Region01.csv': b'v1'},'"v1"')
+    StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run1'))
+    monkeypatch.setattr(StreamCatCacheHelper,'CACHE_TTL',0)
+    linked = StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run2'))
+    assert server.heads == ['Dams_Region01.zip']
+    assert server.gets == ['Dams_Region01.zip']
+    assert read(linked['Dams_Region01.zip'][0]) == b'v1'
+
+def test_expired_entry_changed_is_replaced(server, tmp_path, monkeypatch):
+    server.publish('Dams_Region01.zip',{'Dams_Region01.csv': b'v1'},'"v1"')
+    StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run1'))
+    old_key = entry_keys()['Dams_Region01.zip']
+
+    server.publish('Dams_Region01.zip',{'Dams_Region01.csv': b'v2'},'"v2"')
+    monkeypatch.setattr(StreamCatCacheHelper,'CACHE_TTL',0)
+    linked = StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run2'))
+    assert server.heads == ['Dams_Region01.zip']
+    assert server.gets == ['Dams_Region01.zip','Dams_Region01.zip']
+    assert read(linked['Dams_Region01.zip'][0]) == b'v2'
+    # the outdated entry is removed
+    assert entry_keys()['Dams_Region01.zip'] != old_key
+    assert not os.path.exists(StreamCatCacheHelper.entryDir(old_key))
+
+def test_expired_entry_used_when_server_unreachable(server, tmp_path, monkeypatch):
+    server.publish('Dams_Region01.zip',{'Dams_Region01.csv': b'v1'},'"v1"')
+    StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run1'))
+    monkeypatch.setattr(StreamCatCacheHelper,'CACHE_TTL',0)
+    def unreachable(url, **kwargs):
+        raise requests.exceptions.ConnectTimeout()
+    monkeypatch.setattr(requests,'head',unreachable)
+    linked = StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run2'))
+    assert read(linked['Dams_Region01.zip'][0]) == b'v1'
+    assert server.gets == ['Dams_Region01.zip']
+
+def test_eviction_by_bytes(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(StreamCatCacheHelper,'MAX_CACHE_BYTES',250)
+    for region in ['01','02','03']:
+        server.publish('Dams_Region%s.zip' % region,{'Dams_Region%s.csv' % region: region.encode() * 50},'"v1"')
+
+    StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run1'))
+    StreamCatCacheHelper.fetchFiles(['Dams_Region02.zip'],str(tmp_path / 'run2'))
+    # region 01 is used again, so region 02 is the least recently used
+    StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run3'))
+    evicted_key = entry_keys()['Dams_Region02.zip']
+    StreamCatCacheHelper.fetchFiles(['Dams_Region03.zip'],str(tmp_path / 'run4'))
+
+    assert sorted(entry_keys()) == ['Dams_Region01.zip','Dams_Region03.zip']
+    assert not os.path.exists(StreamCatCacheHelper.entryDir(evicted_key))
+
+    # files in use are never evicted, even if they alone exceed the budget
+    monkeypatch.setattr(StreamCatCacheHelper,'MAX_CACHE_BYTES',10)
+    StreamCatCacheHelper.fetchFiles(['Dams_Region02.zip'],str(tmp_path / 'run5'))
+    assert sorted(entry_keys()) == ['Dams_Region02.zip']
+
+def test_hardlink_with_copy_fallback(server, tmp_path, monkeypatch):
+    server.publish('Dams_Region01.zip',{'Dams_Region01.csv': b'v1'},'"v1"')
+    linked = StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run1'))['Dams_Region01.zip'][0]
+    cached = os.path.join(StreamCatCacheHelper.entryDir(entry_keys()['Dams_Region01.zip']),'Dams_Region01.csv')
+    assert os.stat(linked).st_ino == os.stat(cached).st_ino
+
+    # across file systems the files are copied
+    def cross_device(src, dest):
+        raise OSError('Invalid cross-device link')
+    monkeypatch.setattr(os,'link',cross_device)
+    copied = StreamCatCacheHelper.fetchFiles(['Dams_Region01.zip'],str(tmp_path / 'run2'))['Dams_Region01.zip'][0]
+    assert os.stat(copied).st_ino != os.stat(cached).st_ino
+    assert read(copied) == b'v1'
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import pandas as pd
+
+""" Helper module for maintaining a local, per-station store of GHCND daily series. Each station
+    has its own directory holding a Parquet file with the date indexed series and a JSON file with
+    the (contiguous) date range and datatypes that have been fetched for the station. Callers use missingIntervals
+    to determine the leading and/or trailing intervals of a request that still need to be fetched,
+    and saveSeries to merge newly fetched data into the store.
+"""
+
+# cache location can be overridden via the environment, e.g. to point to a shared scratch directory
+CACHE_DIR = os.environ.get('GEOEDF_GHCND_CACHE_DIR',os.path.expanduser('~/.cache/geoedf/ghcnd'))
+
+# recent observations may still be revised or arrive late, so the most recent days
+# are never recorded as covered and will be refetched on the next request
+LATE_DAYS = 7
+
+def stationDir(station_id):
+    return os.path.join(CACHE_DIR,station_id.replace(':','_'))
+
+def loadSeries(station_id):
+    """ returns the cached series, covered (start,end) dates, and datatypes for a station,
+        or (None,None,None) if nothing is cached
+    """
+    station_dir = stationDir(station_id)
+    try:
+        with open(os.path.join(station_dir,'coverage.json'),'r') as covFile:
+            coverage = json.load(covFile)
+        series = pd.read_parquet(os.path.join(station_dir,'series.parquet'))
+        return series, (pd.Timestamp(coverage['start']),pd.Timestamp(coverage['end'])), coverage['datatypes']
+    except:
+        return None, None, None
+
+def missingIntervals(covered, start, end):
+    """ returns the list of (start,end) intervals of the requested date range that are not
+        covered; intervals are chosen so that coverage remains contiguous once fetched
+    """
+    if covered is None:
+        return [(start,end)]
+
+    intervals = []
+    one_day = pd.Timedelta(days=1)
+    if start < covered[0]:
+        intervals.append((start,max(start,covered[0] - one_day)))
+    if end > covered[1]:
+        intervals.append((min(end,covered[1] + one_day),end))
+    return intervals
+
+def saveSeries(station_id, series, covered, datatypes):
+    """ saves the series for a station along with its covered (start,end) dates and the
+        datatypes fetched; the end date is capped to exclude the most recent LATE_DAYS days
+    """
+    latest = pd.Timestamp.now().normalize() - pd.Timedelta(days=LATE_DAYS)
+    if covered[0] > latest:
+        # nothing old enough to be considered final
+        return
+
+    coverage = {'start': covered[0].strftime('%Y-%m-%d'),
+                'end': min(covered[1],latest).strftime('%Y-%m-%d'),
+                'datatypes': list(datatypes)}
+
+    station_dir = stationDir(station_id)
+    os.makedirs(station_dir,exist_ok=True)
+
+    # write to temp files first so concurrent readers never see a partial store
+    series_path = os.path.join(station_dir,'series.parquet')
+    cov_path = os.path.join(station_dir,'coverage.json')
+    series.to_parquet('%s.%d.tmp' % (series_path,os.getpid()))
+    with open('%s.%d.tmp' % (cov_path,os.getpid()),'w') as covFile:
+        json.dump(coverage,covFile)
+    os.replace('%s.%d.tmp' % (series_path,os.getpid()),series_path)
+    os.replace('%s.%d.tmp' % (cov_path,os.getpid()),cov_path)
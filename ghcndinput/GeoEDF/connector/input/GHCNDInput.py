@@ -3,23 +3,58 @@
 
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
+from GeoEDF.connector.helper import SeriesCacheHelper
 
+import io
+import json
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import feather
 import requests
 from cdo_api_py import Client
+from concurrent.futures import ThreadPoolExecutor
 
 """ Module for implementing the GHCND input connector plugin. This plugin will retrieve data for 
     five specific meterological parameters for a given station ID and date range. The plugin returns 
     a CSV file for each parameter with data records for each intervening date. The CSV file is named 
     based on the station and parameter. The new NOAA API is used that does not require tokens.
+    Long date ranges are split into year long windows that are fetched concurrently as CSV and 
+    concatenated in date order. The station_id parameter can also be a comma separated list of 
+    station IDs; these are grouped into batches (bounded by the request URL length) that are 
+    fetched in a single request each, and the results are split back out by station.
+    Fetched series are kept in a local per-station store (see SeriesCacheHelper), so that later
+    requests only fetch the leading or trailing dates not already in the store.
+    The optional datatypes parameter (comma separated) overrides the default five parameters. The 
+    optional output_format parameter can be set to parquet or feather to write a single file per 
+    station instead of the CSV files; this file has a datetime index, a float32 column for each 
+    parameter, and a per-parameter count of missing values stored in the file's schema metadata.
 """
 
 class GHCNDInput(GeoEDFPlugin):
 
     # auth is also required by GHCNDInput
-    __optional_params = []
+    __optional_params = ['datatypes','output_format']
     __required_params = ['start_date','end_date','station_id']
 
+    # NCEI data service endpoint
+    __data_url = 'https://www.ncei.noaa.gov/access/services/data/v1'
+
+    # maximum number of requests (station batch and date window pairs) fetched concurrently
+    __max_workers = 4
+
+    # (connect, read) timeouts in seconds for data requests
+    __request_timeout = (10,120)
+
+    # maximum length of the comma separated list of stations in a single request
+    __max_stations_length = 1500
+
+    # parameters are only written out if they have fewer missing values than these cutoffs
+    __missing_cutoffs = {'PRCP': 365, 'TMAX': 365, 'TMIN': 365, 'SNOW': 3500, 'SNWD': 3500}
+
+    # supported output formats
+    __output_formats = ['csv','parquet','feather']
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFInput super class
     def __init__(self, **kwargs):
@@ -42,13 +77,103 @@ class GHCNDInput(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
             
-        # set the hardcoded set of meterological params
-        # can possibly generalize to fetch any list of params in the future
+        # set the default set of meterological params
+        # can be overridden using the datatypes param
         self.met_params = ['SNOW','SNWD','TMAX','TMIN','PRCP']
 
         # class super class init
         super().__init__()
 
+    # split the date range into year long windows, returns a list of (start,end) pairs
+    def date_windows(self,startdate,enddate):
+        windows = []
+        window_start = startdate
+        while window_start <= enddate:
+            window_end = min(pd.Timestamp(year=window_start.year,month=12,day=31),enddate)
+            windows.append((window_start,window_end))
+            window_start = window_end + pd.Timedelta(days=1)
+        return windows
+
+    # group station IDs into batches whose comma separated list fits within the URL length limit
+    def station_batches(self,station_ids):
+        batches = []
+        batch = []
+        batch_length = 0
+        for station_id in station_ids:
+            if len(batch) > 0 and batch_length + len(station_id) + 1 > self.__max_stations_length:
+                batches.append(batch)
+                batch = []
+                batch_length = 0
+            batch.append(station_id)
+            batch_length += len(station_id) + 1
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    # fetch data for the stations in the given date window as a DataFrame
+    def fetch_window(self,session,station_ids,window,datatypes):
+        params = {'dataset': 'daily-summaries',
+                  'dataTypes': ','.join(datatypes),
+                  'stations': ','.join(station_ids),
+                  'startDate': window[0].strftime('%Y-%m-%d'),
+                  'endDate': window[1].strftime('%Y-%m-%d'),
+                  'includeAttributes': 'false',
+                  'format': 'csv'}
+        res = session.get(self.__data_url,params=params,timeout=self.__request_timeout)
+        res.raise_for_status()
+
+        # no data in this window
+        if len(res.text.strip()) == 0:
+            return pd.DataFrame(columns=['STATION','DATE'])
+
+        # parse with an explicit schema rather than inferring types
+        dtypes = {'STATION': str, 'DATE': str}
+        for met_param in datatypes:
+            dtypes[met_param] = 'float64'
+        return pd.read_csv(io.StringIO(res.text),dtype=dtypes)
+
+    # for each of the params, first check if we have sufficient data
+    # then write out to a CSV file per param, or a single columnar file for the station
+    def write_station(self,station_id,station_data,datatypes,output_format):
+        # batches and windows are combined before splitting by station, so a param the station
+        # never reported is still present as an all missing column; treat it as absent
+        station_data = station_data.dropna(axis=1,how='all')
+
+        keep_params = []
+        for met_param in datatypes:
+            if met_param in station_data:
+                num_nan = station_data[met_param].isna().sum()
+                # params without a cutoff are always written out
+                if num_nan < self.__missing_cutoffs.get(met_param,len(station_data) + 1):
+                    keep_params.append(met_param)
+
+        if output_format == 'csv':
+            for met_param in keep_params:
+                try:
+                    # write out csv file
+                    param_csvfile = '%s/%s_%s.csv' % (self.target_path,station_id,met_param)
+                    param_data = station_data.filter([met_param])
+                    param_data.to_csv(param_csvfile)
+                except:
+                    raise GeoEDFError("Error occurred while writing out %s data to CSV for station %s in GHCNDInput" % (met_param,station_id))
+            return
+
+        try:
+            # typed columnar table with the missing value counts in the schema metadata
+            param_data = station_data.filter(keep_params).astype('float32')
+            param_data.index.name = 'DATE'
+            missing = {met_param: int(station_data[met_param].isna().sum()) if met_param in station_data else len(station_data) for met_param in datatypes}
+            table = pa.Table.from_pandas(param_data,preserve_index=True)
+            table = table.replace_schema_metadata(dict(table.schema.metadata or {},missing_counts=json.dumps(missing)))
+
+            outfile = '%s/%s.%s' % (self.target_path,station_id,output_format)
+            if output_format == 'parquet':
+                pq.write_table(table,outfile)
+            else:
+                feather.write_feather(table,outfile)
+        except:
+            raise GeoEDFError("Error occurred while writing out %s file for station %s in GHCNDInput" % (output_format,station_id))
+
     # each Input plugin needs to implement this method
     # if error, raise exception; if not, return True
     def get(self):
@@ -60,53 +185,115 @@ class GHCNDInput(GeoEDFPlugin):
             enddate = pd.to_datetime(self.end_date,format='%m/%d/%Y')
         except:
             raise GeoEDFError("Error parsing dates provided to GHCNDInput, please ensure format is mm/dd/YYYY")
+
+        if startdate > enddate:
+            raise GeoEDFError("Start date cannot be later than end date in GHCNDInput")
+
+        # process datatypes and output format
+        if self.datatypes is not None:
+            datatypes = [datatype.strip().upper() for datatype in self.datatypes.split(',') if len(datatype.strip()) > 0]
+            if len(datatypes) == 0:
+                raise GeoEDFError("At least one datatype needs to be provided to GHCNDInput")
+        else:
+            datatypes = self.met_params
+
+        output_format = self.output_format.lower() if self.output_format is not None else 'csv'
+        if output_format not in self.__output_formats:
+            raise GeoEDFError("Output format for GHCNDInput must be one of %s" % ','.join(self.__output_formats))
+
+        # parse out station IDs, mapping the IDs used by the data service (without the
+        # GHCND: prefix) back to the provided station IDs
+        stations = {}
+        for station in self.station_id.split(','):
+            station = station.strip()
+            if len(station) > 0:
+                stations[station.split(':')[-1]] = station
             
         # param checks complete
-        try:
-            # parse out station_id
-            station_id = self.station_id.split(':')[1]
-            
-            # use new API
-            # construct URL
-            station_data_url = "https://www.ncei.noaa.gov/access/services/data/v1?dataset=daily-summaries&dataTypes=SNOW,PRCP,SNWD,TMIN,TMAX&stations=%s&startDate=2010-08-30&endDate=2020-09-30&format=json" % station_id
-            
-            res = requests.get(station_data_url)
-            res.raise_for_status()
-            
-            station_data = pd.read_json(res.text)
 
-            # first reindex data by date
-            station_data.set_index(pd.to_datetime(station_data['DATE']), inplace=True)
+        # determine the intervals that still need to be fetched for each station given what
+        # is already in the local store; stations needing the same interval and datatypes are
+        # fetched together
+        cached = {}
+        intervals = {}
+        for station_id in stations:
+            series, covered, cached_types = SeriesCacheHelper.loadSeries(station_id)
+            if cached_types is None or not set(datatypes).issubset(cached_types):
+                # the store cannot serve these datatypes, start afresh
+                series, covered, fetch_types = None, None, tuple(datatypes)
+            else:
+                # keep fetching all stored datatypes so the store remains complete
+                fetch_types = tuple(cached_types)
+            cached[station_id] = (series,covered,fetch_types)
+            for interval in SeriesCacheHelper.missingIntervals(covered,startdate,enddate):
+                intervals.setdefault((interval,fetch_types),[]).append(station_id)
 
-        except:
-            print("Error fetching GHCND data for station %s in GHCNDInput" % self.station_id)
-            return
-            
-        # for each of the five params, first check if we have sufficient data
-        # then write out to CSV file
-        for met_param in self.met_params:
+        # use new API, fetching each batch of stations in year long windows concurrently
+        # over a shared session
+        tasks = []
+        for (interval,fetch_types),interval_stations in intervals.items():
+            windows = self.date_windows(interval[0],interval[1])
+            batches = self.station_batches(interval_stations)
+            tasks += [(batch,window,fetch_types) for batch in batches for window in windows]
+
+        # stations with at least one interval to fetch, and those for which a fetch failed
+        to_fetch = set([station_id for interval_stations in intervals.values() for station_id in interval_stations])
+        failed = set()
+
+        def fetch_task(task):
             try:
-                if met_param == 'PRCP' or met_param == 'TMAX' or met_param == 'TMIN':
-                    if met_param in station_data:
-                        num_nan = station_data[met_param].isna().sum()
-                        if num_nan < 365: # then we are fine
-                            # write out csv file
-                            param_csvfile = '%s/%s_%s.csv' % (self.target_path,self.station_id,met_param)
-                            param_data = station_data.filter([met_param])
-                            param_data.to_csv(param_csvfile)
-                # check for snow params
-                if met_param == 'SNOW' or met_param == 'SNWD':
-                    if met_param in station_data:
-                        num_nan = station_data[met_param].isna().sum()
-                        if num_nan < 3500:
-                            # write out csv file
-                            param_csvfile = '%s/%s_%s.csv' % (self.target_path,self.station_id,met_param)
-                            param_data = station_data.filter([met_param])
-                            param_data.to_csv(param_csvfile)
+                return self.fetch_window(session,task[0],task[1],task[2])
             except:
-                raise GeoEDFError("Error occurred while writing out %s data to CSV for station %s in GHCNDInput" % (met_param,self.station_id))
-                    
-                        
-             
-                        
+                print("Error fetching GHCND data for stations %s in GHCNDInput" % ','.join([stations[station_id] for station_id in task[0]]))
+                failed.update(task[0])
+                return None
+
+        with requests.Session() as session:
+            with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+                # map returns results in task order, i.e. in window order within each batch
+                task_data = [data for data in executor.map(fetch_task,tasks) if data is not None]
+
+        if len(task_data) > 0:
+            all_data = pd.concat(task_data,ignore_index=True)
+        else:
+            all_data = pd.DataFrame(columns=['STATION','DATE'])
+
+        # split the combined response by station
+        fetched = {}
+        for station_id,station_data in all_data.groupby('STATION',sort=False):
+            if station_id in stations:
+                # reindex data by date
+                station_data = station_data.drop(columns=['STATION']).set_index(pd.to_datetime(station_data['DATE'],format='%Y-%m-%d'))
+                fetched[station_id] = station_data.drop(columns=['DATE'])
+
+        for station_id in stations:
+            if station_id in failed:
+                continue
+
+            # merge newly fetched data into the cached series
+            series, covered, fetch_types = cached[station_id]
+            frames = [frame for frame in [series,fetched.get(station_id)] if frame is not None]
+            if len(frames) > 0:
+                series = pd.concat(frames)
+                series = series[~series.index.duplicated(keep='last')].sort_index()
+            else:
+                series = pd.DataFrame(index=pd.DatetimeIndex([]))
+            series.index.name = 'DATE'
+
+            # update the local store if anything was fetched
+            if station_id in to_fetch:
+                if covered is None:
+                    covered = (startdate,enddate)
+                else:
+                    covered = (min(covered[0],startdate),max(covered[1],enddate))
+                try:
+                    SeriesCacheHelper.saveSeries(station_id,series,covered,fetch_types)
+                except:
+                    print("Error saving GHCND data for station %s to local store in GHCNDInput" % stations[station_id])
+
+            if len(series.loc[startdate:enddate]) == 0:
+                print("Error fetching GHCND data for station %s in GHCNDInput" % stations[station_id])
+                continue
 
+            # completeness checks and output use only the requested date range
+            self.write_station(stations[station_id],series.loc[startdate:enddate],datatypes,output_format)
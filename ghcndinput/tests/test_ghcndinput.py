@@ -0,0 +1,85 @@
+import pandas as pd
+import pytest
+import requests
+
+pytest.importorskip('geoedfframework')
+pytest.importorskip('cdo_api_py')
+
+from GeoEDF.connector.input.GHCNDInput import GHCNDInput
+
+# run from the ghcndinput directory with: python -m pytest tests
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+class Session:
+    def __init__(self, text):
+        self.text = text
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append(kwargs)
+        return Response(self.text)
+
+def make_input(tmp_path, **kwargs):
+    params = {'start_date':'01/01/2020','end_date':'01/05/2020','station_id':'GHCND:USW00014835'}
+    params.update(kwargs)
+    plugin = GHCNDInput(**params)
+    plugin.target_path = str(tmp_path)
+    return plugin
+
+def test_fetch_window_has_timeout(tmp_path):
+    session = Session('"STATION","DATE","PRCP"\n"USW00014835","2020-01-01","1.5"\n')
+    window = (pd.Timestamp('2020-01-01'),pd.Timestamp('2020-01-05'))
+    data = make_input(tmp_path).fetch_window(session,['USW00014835'],window,['PRCP'])
+    assert data['PRCP'].tolist() == [1.5]
+    timeout = session.calls[0]['timeout']
+    assert isinstance(timeout,tuple) and len(timeout) == 2
+
+def test_fetch_window_timeout_fails_only_that_station(tmp_path, monkeypatch):
+    from GeoEDF.connector.helper import SeriesCacheHelper
+    monkeypatch.setattr(SeriesCacheHelper,'CACHE_DIR',str(tmp_path / 'cache'))
+    def get(self, url, **kwargs):
+        assert 'timeout' in kwargs
+        raise requests.exceptions.ReadTimeout()
+    monkeypatch.setattr(requests.Session,'get',get)
+    out = tmp_path / 'out'
+    out.mkdir()
+    make_input(out).get()
+    assert list(out.iterdir()) == []
+
+def test_date_windows_split_on_years(tmp_path):
+    windows = make_input(tmp_path).date_windows(pd.Timestamp('2019-06-01'),pd.Timestamp('2021-02-01'))
+    assert windows == [(pd.Timestamp('2019-06-01'),pd.Timestamp('2019-12-31')),
+                       (pd.Timestamp('2020-01-01'),pd.Timestamp('2020-12-31')),
+                       (pd.Timestamp('2021-01-01'),pd.Timestamp('2021-02-01'))]
+
+def station_frame(values):
+    index = pd.DatetimeIndex(pd.date_range('2020-01-01',periods=3),name='DATE')
+    return pd.DataFrame(values,index=index)
+
+def test_unreported_params_not_written(tmp_path):
+    # SNOW was never reported by this station, TAVG has no missing value cutoff
+    data = station_frame({'PRCP':[1.0,None,2.0],'SNOW':[None,None,None],'TAVG':[None,None,None]})
+    make_input(tmp_path).write_station('GHCND:USW00014835',data,['PRCP','SNOW','TAVG'],'csv')
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['GHCND:USW00014835_PRCP.csv']
+
+def test_unreported_params_not_in_parquet(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    data = station_frame({'PRCP':[1.0,None,2.0],'SNOW':[None,None,None]})
+    make_input(tmp_path).write_station('USW00014835',data,['PRCP','SNOW'],'parquet')
+    table = pq.read_table(str(tmp_path / 'USW00014835.parquet'))
+    assert 'SNOW' not in table.column_names
+    assert table.column('PRCP').to_pylist() == [1.0,None,2.0]
+
+def test_params_over_cutoff_not_written(tmp_path):
+    days = pd.DatetimeIndex(pd.date_range('2019-01-01',periods=400),name='DATE')
+    prcp = [1.0] + [None] * 399
+    data = pd.DataFrame({'PRCP':prcp,'SNOW':prcp},index=days)
+    make_input(tmp_path).write_station('USW00014835',data,['PRCP','SNOW'],'csv')
+    # 399 missing values exceed the PRCP cutoff (365) but not the SNOW cutoff (3500)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['USW00014835_SNOW.csv']
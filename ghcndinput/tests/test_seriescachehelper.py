@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from GeoEDF.connector.helper import SeriesCacheHelper
+
+# run from the ghcndinput directory with: python -m pytest tests
+
+def ts(date):
+    return pd.Timestamp(date)
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(SeriesCacheHelper,'CACHE_DIR',str(tmp_path))
+    return SeriesCacheHelper
+
+def test_nothing_covered():
+    assert SeriesCacheHelper.missingIntervals(None,ts('2020-01-01'),ts('2020-12-31')) == [(ts('2020-01-01'),ts('2020-12-31'))]
+
+def test_fully_covered():
+    covered = (ts('2019-01-01'),ts('2021-12-31'))
+    assert SeriesCacheHelper.missingIntervals(covered,ts('2020-01-01'),ts('2020-12-31')) == []
+
+def test_leading_and_trailing():
+    covered = (ts('2020-03-01'),ts('2020-06-30'))
+    assert SeriesCacheHelper.missingIntervals(covered,ts('2020-01-01'),ts('2020-12-31')) == \
+        [(ts('2020-01-01'),ts('2020-02-29')),(ts('2020-07-01'),ts('2020-12-31'))]
+
+def test_request_before_coverage_stays_contiguous():
+    # the fetched interval extends up to the covered range so coverage remains contiguous
+    covered = (ts('2020-06-01'),ts('2020-06-30'))
+    assert SeriesCacheHelper.missingIntervals(covered,ts('2020-01-01'),ts('2020-01-31')) == \
+        [(ts('2020-01-01'),ts('2020-05-31'))]
+
+def test_request_after_coverage_stays_contiguous():
+    covered = (ts('2020-01-01'),ts('2020-01-31'))
+    assert SeriesCacheHelper.missingIntervals(covered,ts('2020-06-01'),ts('2020-06-30')) == \
+        [(ts('2020-02-01'),ts('2020-06-30'))]
+
+def test_save_and_load(cache):
+    series = pd.DataFrame({'PRCP':[1.0,2.0]},index=pd.DatetimeIndex([ts('2020-01-01'),ts('2020-01-02')],name='DATE'))
+    cache.saveSeries('GHCND:USW00014835',series,(ts('2020-01-01'),ts('2020-01-02')),['PRCP'])
+    loaded, covered, datatypes = cache.loadSeries('GHCND:USW00014835')
+    pd.testing.assert_frame_equal(loaded,series,check_freq=False)
+    assert covered == (ts('2020-01-01'),ts('2020-01-02'))
+    assert datatypes == ['PRCP']
+
+def test_recent_days_not_covered(cache):
+    today = pd.Timestamp.now().normalize()
+    start = today - pd.Timedelta(days=30)
+    series = pd.DataFrame({'PRCP':[1.0]},index=pd.DatetimeIndex([start],name='DATE'))
+    cache.saveSeries('USW00014835',series,(start,today),['PRCP'])
+    covered = cache.loadSeries('USW00014835')[1]
+    assert covered == (start,today - pd.Timedelta(days=SeriesCacheHelper.LATE_DAYS))
+
+def test_missing_station(cache):
+    assert cache.loadSeries('USW00000000') == (None,None,None)
@@ -4,21 +4,54 @@
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 
+import io
 import os
+import time
+import requests
 import pandas as pd
 import hydrofunctions as hf
+from concurrent.futures import ThreadPoolExecutor
 
 
 """ Module for implementing the NWISStatInput. This plugin takes a start and end year pair, a two char state 
     code, and a variable (numeric parameterCd) as input. The plugin uses the Hydrofunctions API to fetch the 
     annual mean value for this variable for all stations in this state and for the given year range. The plugin
-    outputs a csv file with year, station ID, and mean value in each row.
+    outputs a csv file with year, station ID, and mean value in each row. The yearly queries are run 
+    concurrently in a bounded thread pool, with retries, and the results are kept in year order.
+    If the optional source parameter is set to stats, the annual means are instead requested directly 
+    from the NWIS statistics service (statReportType=annual) instead of downloading the full daily series.
+    The statistics service only accepts site numbers (at most 10 per request), so the state's stations with
+    daily values for the variable, and their lat-lon, are first listed with a single site service request;
+    their statistics are then requested concurrently in batches of 10 sites.
 """
 
 class NWISStatInput(GeoEDFPlugin):
-    __optional_params = []
+    __optional_params = ['source']
     __required_params = ['start_yr','end_yr','state','variable']
 
+    # maximum number of yearly queries run concurrently
+    __max_workers = 4
+
+    # number of attempts for each yearly query and the base backoff in seconds between attempts
+    __max_attempts = 3
+    __backoff = 5
+
+    # output columns
+    __columns = ['lat','lon','year','stn','value']
+
+    # NWIS statistics and site service endpoints used when source is stats
+    __stat_url = 'https://waterservices.usgs.gov/nwis/stat/'
+    __site_url = 'https://waterservices.usgs.gov/nwis/site/'
+
+    # maximum number of sites the statistics service accepts in a single request
+    __max_stat_sites = 10
+
+    # (connect, read) timeouts in seconds for statistics and site service requests
+    __request_timeout = (10,120)
+
+    # supported data sources
+    __sources = ['data','stats']
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFPlugin super class
     def __init__(self, **kwargs):
@@ -58,55 +91,159 @@ class NWISStatInput(GeoEDFPlugin):
         if self.start_yr > self.end_yr:
             raise GeoEDFError('Start year be later than end year in NWISStatInput')
 
-        # initialize data array
-        var_data = []
-        
-        for year in range(self.start_yr,self.end_yr+1):
-            # next query Hydrofunctions for parameter data for the provided state code
+        # Check (2) source is supported
+        source = self.source.lower() if self.source is not None else 'data'
+        if source not in self.__sources:
+            raise GeoEDFError('Source parameter for NWISStatInput must be one of %s' % ','.join(self.__sources))
+
+        if source == 'stats':
             try:
-                start_dt = '%d-01-01' % year
-                end_dt = '%d-12-31' % year
-                # query data for all stations in given state for this year
-                state_res = hf.NWIS(stateCd=self.state,start_date=start_dt,end_date=end_dt,parameterCd=self.variable)
-                # compute statistics and extract mean
-                state_stats = state_res.df().mean().to_dict()
-                # keys are station IDs
-                for key,val in state_stats.items():
-                    #only extract the annual state values
-                    if key.endswith('00003'):
-                        # construct a new dict record 
-                        data = dict()
-                        # construct station ID
-                        stn_id = 'USGS:%s' % key.split(':')[1]
-                        # determine lat-lon for station from metadata
-                        state_res_meta = state_res.meta
-                        data['lat'] = None
-                        data['lon'] = None
-                        if stn_id in state_res_meta:
-                            if 'siteLatLongSrs' in state_res_meta[stn_id]:
-                                if 'latitude' in state_res_meta[stn_id]['siteLatLongSrs']:
-                                    data['lat'] = state_res_meta[stn_id]['siteLatLongSrs']['latitude']
-                                if 'longitude' in state_res_meta[stn_id]['siteLatLongSrs']:
-                                    data['lon'] = state_res_meta[stn_id]['siteLatLongSrs']['longitude']
-                        data['year'] = year
-                        data['stn'] = stn_id
-                        data['value'] = val
-                        var_data.append(data)
-            except hf.exceptions.HydroNoDataError:
-                pass
-            except hf.exceptions.HydroUserWarning:
-                pass
+                year_data = [self.fetch_stats()]
             except:
-                print("Error retrieving data for variable %s in year %d for state %s in NWISStatInput" % (self.variable,year,self.state))
-                pass
+                raise GeoEDFError("Error retrieving annual statistics for variable %s for state %s in NWISStatInput" % (self.variable,self.state))
+        else:
+            # run yearly queries concurrently; map returns results in year order
+            with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+                year_data = [data for data in executor.map(self.fetch_year,range(self.start_yr,self.end_yr+1)) if data is not None]
+
         try:
             #write out to csv file
-            var_df = pd.DataFrame(var_data)
+            if len(year_data) > 0:
+                var_df = pd.concat(year_data,ignore_index=True)
+            else:
+                var_df = pd.DataFrame(columns=self.__columns)
             outfile = '%s/%s_%s.csv' % (self.target_path,self.state,self.variable)
             var_df.to_csv(outfile,index=False)
         except:
             raise GeoEDFError("Error writing out data for variable %s for state %s in NWISStatInput" % (self.variable,self.state))
 
-                        
-
+    # query Hydrofunctions for parameter data for the provided state code in the given year
+    # returns a DataFrame with a row per station or None if no data could be retrieved
+    def fetch_year(self,year):
+        start_dt = '%d-01-01' % year
+        end_dt = '%d-12-31' % year
 
+        for attempt in range(self.__max_attempts):
+            try:
+                # query data for all stations in given state for this year
+                state_res = hf.NWIS(stateCd=self.state,start_date=start_dt,end_date=end_dt,parameterCd=self.variable)
+                return self.year_means(state_res,year)
+            except hf.exceptions.HydroNoDataError:
+                return None
+            except hf.exceptions.HydroUserWarning:
+                return None
+            except:
+                if attempt < self.__max_attempts - 1:
+                    time.sleep(self.__backoff * (2 ** attempt))
+
+        print("Error retrieving data for variable %s in year %d for state %s in NWISStatInput" % (self.variable,year,self.state))
+        return None
+
+    # compute the annual mean for each station in the response and attach station lat-lon
+    def year_means(self,state_res,year):
+        # compute statistics and extract mean; keys are station IDs
+        state_stats = state_res.df().mean()
+
+        #only extract the annual state values
+        state_stats = state_stats[state_stats.index.str.endswith('00003')]
+
+        # construct station IDs
+        stn_ids = 'USGS:' + state_stats.index.str.split(':').str[1]
+
+        # determine lat-lon for stations from metadata, extracted once for this response
+        locations = {}
+        for stn_id,stn_meta in state_res.meta.items():
+            lat_long = stn_meta.get('siteLatLongSrs',{}) if isinstance(stn_meta,dict) else {}
+            locations[stn_id] = (lat_long.get('latitude'),lat_long.get('longitude'))
+        stn_locations = pd.DataFrame.from_dict(locations,orient='index',columns=['lat','lon'])
+        stn_locations = stn_locations.reindex(stn_ids)
+
+        return pd.DataFrame({'lat': stn_locations['lat'].values,
+                             'lon': stn_locations['lon'].values,
+                             'year': year,
+                             'stn': stn_ids.values,
+                             'value': state_stats.values},columns=self.__columns)
+
+    # parse a tab separated RDB response from NWIS into a DataFrame of strings
+    def read_rdb(self,text):
+        rdb = pd.read_csv(io.StringIO(text),sep='\t',comment='#',dtype=str)
+        # the first row after the header describes the column formats
+        return rdb.iloc[1:]
+
+    # list the stations in the state with daily values for the variable, along with their lat-lon
+    # returns a DataFrame with lat and lon columns indexed by site number
+    def state_sites(self):
+        site_params = {'format': 'rdb',
+                       'stateCd': self.state,
+                       'parameterCd': self.variable,
+                       'hasDataTypeCd': 'dv',
+                       'siteStatus': 'all'}
+        res = requests.get(self.__site_url,params=site_params,timeout=self.__request_timeout)
+        # no stations for this state and variable
+        if res.status_code == 404:
+            return pd.DataFrame(columns=['lat','lon'])
+        res.raise_for_status()
+        sites = self.read_rdb(res.text)
+        sites = pd.DataFrame({'lat': pd.to_numeric(sites['dec_lat_va'],errors='coerce').values,
+                              'lon': pd.to_numeric(sites['dec_long_va'],errors='coerce').values},
+                             index=sites['site_no'].values)
+        return sites[~sites.index.duplicated()]
+
+    # fetch the annual means for a batch of at most __max_stat_sites sites from the statistics service
+    # returns a DataFrame with site_no, year, and value columns or None if they could not be retrieved
+    def fetch_site_stats(self,site_nos):
+        # annual calendar year means for the year range
+        stat_params = {'format': 'rdb',
+                       'sites': ','.join(site_nos),
+                       'parameterCd': self.variable,
+                       'statReportType': 'annual',
+                       'statYearType': 'calendar',
+                       'statTypeCd': 'mean',
+                       'startDT': '%d' % self.start_yr,
+                       'endDT': '%d' % self.end_yr}
+
+        for attempt in range(self.__max_attempts):
+            try:
+                res = requests.get(self.__stat_url,params=stat_params,timeout=self.__request_timeout)
+                # no statistics for these sites
+                if res.status_code == 404:
+                    return pd.DataFrame(columns=['site_no','year','value'])
+                res.raise_for_status()
+                stats = self.read_rdb(res.text)
+                return pd.DataFrame({'site_no': stats['site_no'],
+                                     'year': stats['year_nu'].astype(int),
+                                     'value': pd.to_numeric(stats['mean_va'],errors='coerce')})
+            except:
+                if attempt < self.__max_attempts - 1:
+                    time.sleep(self.__backoff * (2 ** attempt))
+
+        print("Error retrieving annual statistics for variable %s for sites %s in NWISStatInput" % (self.variable,','.join(site_nos)))
+        return None
+
+    # fetch annual means for all stations in the state from the NWIS statistics service
+    def fetch_stats(self):
+        sites = self.state_sites()
+
+        # the statistics service only accepts site numbers, a limited number at a time
+        site_nos = sites.index.tolist()
+        batches = [site_nos[i:i+self.__max_stat_sites] for i in range(0,len(site_nos),self.__max_stat_sites)]
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            batch_stats = [stats for stats in executor.map(self.fetch_site_stats,batches) if stats is not None]
+
+        if len(batch_stats) == 0:
+            return pd.DataFrame(columns=self.__columns)
+        stats = pd.concat(batch_stats,ignore_index=True)
+
+        # average multiple time series of the same station, one row per station-year
+        stats = stats.groupby(['site_no','year'],as_index=False,sort=True)['value'].mean()
+
+        # station lat-lon from the site service listing
+        locations = sites.reindex(stats['site_no'])
+
+        # retain the same format as the per-year queries, in year order
+        stats_df = pd.DataFrame({'lat': locations['lat'].values,
+                                 'lon': locations['lon'].values,
+                                 'year': stats['year'].values,
+                                 'stn': ('USGS:' + stats['site_no']).values,
+                                 'value': stats['value'].values},columns=self.__columns)
+        return stats_df.sort_values(['year','stn'],kind='mergesort').reset_index(drop=True)
@@ -0,0 +1,104 @@
+import pandas as pd
+import pytest
+import requests
+
+pytest.importorskip('geoedfframework')
+pytest.importorskip('hydrofunctions')
+
+from GeoEDF.connector.input.NWISStatInput import NWISStatInput
+
+# run from the nwisstatinput directory with: python -m pytest tests
+
+# responses below follow the tab separated RDB layout of the NWIS site and statistics services:
+# comment lines, a header row, a row of column formats, then the data rows
+SITE_HEADER = '#\n# U.S. Geological Survey\n#\n' \
+              'agency_cd\tsite_no\tstation_nm\tsite_tp_cd\tdec_lat_va\tdec_long_va\tcoord_acy_cd\tdec_coord_datum_cd\talt_va\talt_acy_va\talt_datum_cd\thuc_cd\n' \
+              '5s\t15s\t50s\t7s\t16s\t16s\t1s\t10s\t8s\t3s\t10s\t16s\n'
+STAT_HEADER = '#\n# U.S. Geological Survey\n#\n' \
+              'agency_cd\tsite_no\tparameter_cd\tts_id\tloc_web_ds\tyear_nu\tmean_va\n' \
+              '5s\t15s\t5s\t10n\t15s\t4s\t12s\n'
+
+SITES = ['0333%04d' % i for i in range(25)]
+
+def site_rdb(site_nos):
+    rows = ['USGS\t%s\tSTATION %s\tST\t40.%s\t-86.%s\tS\tNAD83\t 500.00\t.01\tNAVD88\t05120108\n' % (site_no,site_no,site_no[-2:],site_no[-2:]) for site_no in site_nos]
+    return SITE_HEADER + ''.join(rows)
+
+def stat_rdb(site_nos, years):
+    rows = []
+    for site_no in site_nos:
+        # the last site has no statistics
+        if site_no == SITES[-1]:
+            continue
+        for year in years:
+            rows.append('USGS\t%s\t00060\t1234\t\t%d\t%d.5\n' % (site_no,year,int(site_no[-2:]) + year - 2000))
+    return STAT_HEADER + ''.join(rows)
+
+class Response:
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(self.status_code)
+
+class Service:
+    """ stands in for the site and statistics services, enforcing the statistics service's
+        restriction to at most 10 sites per request """
+    def __init__(self, fail_sites=()):
+        self.stat_requests = []
+        self.fail_sites = set(fail_sites)
+
+    def get(self, url, params=None, timeout=None):
+        assert timeout is not None
+        if '/site/' in url:
+            assert params['stateCd'] == 'IN'
+            return Response(200,site_rdb(SITES))
+        if 'stateCd' in params or 'sites' not in params:
+            return Response(400,'Major filter must be sites')
+        site_nos = params['sites'].split(',')
+        if len(site_nos) > 10:
+            return Response(400,'Too many sites')
+        self.stat_requests.append(site_nos)
+        if self.fail_sites & set(site_nos):
+            return Response(503)
+        if site_nos == [SITES[-1]]:
+            return Response(404)
+        years = range(int(params['startDT']),int(params['endDT']) + 1)
+        return Response(200,stat_rdb(site_nos,years))
+
+def make_input(tmp_path):
+    plugin = NWISStatInput(start_yr=2019,end_yr=2020,state='IN',variable='00060',source='stats')
+    plugin.target_path = str(tmp_path)
+    return plugin
+
+def test_stats_requested_by_site_batches(tmp_path, monkeypatch):
+    service = Service()
+    monkeypatch.setattr(requests,'get',service.get)
+    make_input(tmp_path).get()
+
+    assert sorted(len(batch) for batch in service.stat_requests) == [5,10,10]
+    assert sorted(site for batch in service.stat_requests for site in batch) == SITES
+
+    output = pd.read_csv(str(tmp_path / 'IN_00060.csv'),dtype={'stn': str})
+    assert list(output.columns) == ['lat','lon','year','stn','value']
+    # one row per station with statistics per year, in year order
+    assert len(output) == 2 * 24
+    assert output['year'].tolist() == [2019] * 24 + [2020] * 24
+    first = output.iloc[0]
+    assert first['stn'] == 'USGS:' + SITES[0]
+    assert first['lat'] == pytest.approx(40.0) and first['lon'] == pytest.approx(-86.0)
+    assert first['value'] == pytest.approx(19.5)
+
+def test_failed_batch_is_skipped(tmp_path, monkeypatch):
+    service = Service(fail_sites=[SITES[0]])
+    monkeypatch.setattr(requests,'get',service.get)
+    plugin = make_input(tmp_path)
+    monkeypatch.setattr(plugin,'_NWISStatInput__backoff',0)
+    plugin.get()
+
+    output = pd.read_csv(str(tmp_path / 'IN_00060.csv'),dtype={'stn': str})
+    # the first batch of 10 sites failed on every attempt
+    assert len(output) == 2 * 14
+    assert not output['stn'].isin(['USGS:' + site for site in SITES[:10]]).any()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+""" Helper module for caching values computed from a shapefile (lat-lon extents, projection info)
+    on disk so that repeat runs over the same shapefile can skip opening and reprojecting it with GDAL.
+    Entries are keyed by the shapefile's absolute path, size, modification time, and a content hash
+    of the .shp and .prj files. The cache is a small SQLite database bounded both in number of entries
+    and in total size; the least recently used entries are evicted when either limit is exceeded, and
+    values larger than MAX_ENTRY_BYTES are not stored at all.
+    Any error in reading or writing the cache is ignored, the caller simply recomputes the value.
+"""
+
+# cache location can be overridden via the environment, e.g. to point to a shared scratch directory
+CACHE_DIR = os.environ.get('GEOEDF_SHP_CACHE_DIR',os.path.expanduser('~/.cache/geoedf'))
+
+# maximum number of entries retained in the cache
+MAX_ENTRIES = int(os.environ.get('GEOEDF_SHP_CACHE_ENTRIES','256'))
+
+# maximum total size in bytes of the cached (JSON encoded) values
+MAX_CACHE_BYTES = int(os.environ.get('GEOEDF_SHP_CACHE_BYTES',str(256*1024*1024)))
+
+# maximum size in bytes of a single cached value; larger values are not stored
+MAX_ENTRY_BYTES = int(os.environ.get('GEOEDF_SHP_CACHE_ENTRY_BYTES',str(16*1024*1024)))
+
+# values derived from very large geometries (e.g. reprojected polygons) are not worth
+# storing in the cache; callers check against this limit before encoding such values,
+# which is cheaper than encoding them only to find they exceed MAX_ENTRY_BYTES
+MAX_CACHED_VERTICES = int(os.environ.get('GEOEDF_SHP_CACHE_VERTICES','250000'))
+
+# number of bytes hashed from the start and end of the .shp file; the .shp header already
+# encodes the file length and bounding box, so this is sufficient to detect content changes
+# without reading multi-GB files in full
+HASH_SAMPLE_BYTES = 1024*1024
+
+def hashFile(path, digest):
+    """ updates digest with the contents of the file at path; for large files only
+        the leading and trailing HASH_SAMPLE_BYTES are hashed
+    """
+    if not os.path.exists(path):
+        return
+    size = os.path.getsize(path)
+    with open(path,'rb') as inFile:
+        if size <= 2*HASH_SAMPLE_BYTES:
+            digest.update(inFile.read())
+        else:
+            digest.update(inFile.read(HASH_SAMPLE_BYTES))
+            inFile.seek(size - HASH_SAMPLE_BYTES)
+            digest.update(inFile.read(HASH_SAMPLE_BYTES))
+
+def cacheKey(shapefile, tag):
+    """ constructs the cache key for a shapefile; tag distinguishes between different
+        values computed from the same shapefile (e.g. extents with different split counts)
+    """
+    shp_path = os.path.abspath(shapefile)
+    prj_path = '%s.prj' % os.path.splitext(shp_path)[0]
+
+    stat = os.stat(shp_path)
+
+    digest = hashlib.sha256()
+    digest.update(('%s|%d|%f|%s' % (shp_path,stat.st_size,stat.st_mtime,tag)).encode('utf-8'))
+    hashFile(shp_path,digest)
+    hashFile(prj_path,digest)
+    return digest.hexdigest()
+
+def connect():
+    """ opens (and if needed creates) the cache database
+    """
+    os.makedirs(CACHE_DIR,exist_ok=True)
+    conn = sqlite3.connect(os.path.join(CACHE_DIR,'shpcache.db'),timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS shpcache (key TEXT PRIMARY KEY, value TEXT, accessed REAL)')
+    return conn
+
+def getCached(shapefile, tag):
+    """ returns the cached value for this shapefile and tag or None if there is no
+        (valid) cache entry
+    """
+    try:
+        key = cacheKey(shapefile,tag)
+        conn = connect()
+        try:
+            with conn:
+                row = conn.execute('SELECT value FROM shpcache WHERE key = ?',(key,)).fetchone()
+                if row is None:
+                    return None
+                # update access time for LRU eviction
+                conn.execute('UPDATE shpcache SET accessed = ? WHERE key = ?',(time.time(),key))
+            return json.loads(row[0])
+        finally:
+            conn.close()
+    except:
+        return None
+
+def putCached(shapefile, tag, value):
+    """ stores a JSON serializable value for this shapefile and tag, evicting the
+        least recently used entries if the cache is full; values larger than
+        MAX_ENTRY_BYTES are not stored
+    """
+    try:
+        encoded = json.dumps(value)
+        if len(encoded) > MAX_ENTRY_BYTES:
+            return
+        key = cacheKey(shapefile,tag)
+        conn = connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO shpcache (key, value, accessed) VALUES (?,?,?)',(key,encoded,time.time()))
+
+                # keep the most recently used entries within both the entry and byte limits
+                total = 0
+                evicted = []
+                rows = conn.execute('SELECT key, length(value) FROM shpcache ORDER BY accessed DESC').fetchall()
+                for i, (entry_key, nbytes) in enumerate(rows):
+                    total += nbytes
+                    if i >= MAX_ENTRIES or total > MAX_CACHE_BYTES:
+                        evicted.append((entry_key,))
+                conn.executemany('DELETE FROM shpcache WHERE key = ?',evicted)
+        finally:
+            conn.close()
+    except:
+        pass
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import tempfile
+
+""" Times ShpExtentFilter on a shapefile with an empty cache (cold) and then with the
+    cached extents (warm). Requires GDAL, the GeoEDF framework, and the shpextentfilter plugin.
+    Usage: python shpcache_bench.py <shapefile> [split] [warm runs]
+"""
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python shpcache_bench.py <shapefile> [split] [warm runs]')
+        sys.exit(1)
+    shapefile = sys.argv[1]
+    split = sys.argv[2] if len(sys.argv) > 2 else None
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    # point the cache at an empty directory before the helper reads its configuration
+    os.environ['GEOEDF_SHP_CACHE_DIR'] = tempfile.mkdtemp(prefix='shpcache_bench.')
+
+    from GeoEDF.connector.filter.ShpExtentFilter import ShpExtentFilter
+
+    def run():
+        start = time.perf_counter()
+        ShpExtentFilter(shapefile=shapefile,split=split).filter()
+        return time.perf_counter() - start
+
+    cold = run()
+    warm = sorted(run() for i in range(runs))
+    print('cold: %.4fs' % cold)
+    print('warm: %.4fs (median of %d)' % (warm[len(warm)//2],runs))
+
+if __name__ == '__main__':
+    main()
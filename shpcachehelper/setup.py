@@ -0,0 +1,11 @@
+from setuptools import setup, find_packages
+
+setup(name='shpcachehelper',
+      version='0.1',
+      description='On-disk cache of values computed from shapefiles, shared by the shapefile-reading filter plugins',
+      url='http://github.com/geoedf/connectors',
+      author='Rajesh Kalyanam',
+      author_email='rkalyanapurdue@gmail.com',
+      license='MIT',
+      packages=find_packages(exclude=['benchmarks']),
+      zip_safe=False)
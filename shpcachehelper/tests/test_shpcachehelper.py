@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from GeoEDF.connector.helper import ShpCacheHelper
+
+# run from the shpcachehelper directory with: python -m pytest tests
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ShpCacheHelper,'CACHE_DIR',str(tmp_path / 'cache'))
+    return ShpCacheHelper
+
+def write_shapefile(path, content):
+    path.write_bytes(content)
+    path.with_suffix('.prj').write_text('GEOGCS["WGS 84"]')
+    return str(path)
+
+def test_roundtrip(cache, tmp_path):
+    shp = write_shapefile(tmp_path / 'a.shp',b'shape')
+    assert cache.getCached(shp,'extent') is None
+    cache.putCached(shp,'extent',{'extents':[[1,2,3,4]]})
+    assert cache.getCached(shp,'extent') == {'extents':[[1,2,3,4]]}
+    # values are specific to the tag
+    assert cache.getCached(shp,'other') is None
+
+def test_changed_shapefile_misses(cache, tmp_path):
+    shp = write_shapefile(tmp_path / 'a.shp',b'shape')
+    cache.putCached(shp,'extent',[1])
+    write_shapefile(tmp_path / 'a.shp',b'other shape')
+    assert cache.getCached(shp,'extent') is None
+
+def test_changed_projection_misses(cache, tmp_path):
+    shp = write_shapefile(tmp_path / 'a.shp',b'shape')
+    cache.putCached(shp,'extent',[1])
+    (tmp_path / 'a.prj').write_text('PROJCS["NAD83 / Conus Albers"]')
+    assert cache.getCached(shp,'extent') is None
+
+def test_large_file_sampled(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(ShpCacheHelper,'HASH_SAMPLE_BYTES',4)
+    shp = write_shapefile(tmp_path / 'a.shp',b'0123456789abcdef')
+    key = cache.cacheKey(shp,'extent')
+    # a change to the end of the file is detected even when the file is sampled
+    write_shapefile(tmp_path / 'a.shp',b'0123456789abcdeX')
+    os.utime(shp,(0,os.stat(shp).st_mtime))
+    assert cache.cacheKey(shp,'extent') != key
+
+def test_lru_eviction(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(ShpCacheHelper,'MAX_ENTRIES',2)
+    shps = [write_shapefile(tmp_path / ('%d.shp' % i),b'shape %d' % i) for i in range(3)]
+    cache.putCached(shps[0],'extent',0)
+    cache.putCached(shps[1],'extent',1)
+    # touch the first entry so the second is the least recently used
+    assert cache.getCached(shps[0],'extent') == 0
+    cache.putCached(shps[2],'extent',2)
+    assert cache.getCached(shps[0],'extent') == 0
+    assert cache.getCached(shps[1],'extent') is None
+    assert cache.getCached(shps[2],'extent') == 2
+
+def test_unwritable_cache_is_ignored(cache, tmp_path, monkeypatch):
+    blocker = tmp_path / 'blocker'
+    blocker.write_text('')
+    monkeypatch.setattr(ShpCacheHelper,'CACHE_DIR',str(blocker / 'cache'))
+    shp = write_shapefile(tmp_path / 'a.shp',b'shape')
+    cache.putCached(shp,'extent',[1])
+    assert cache.getCached(shp,'extent') is None
+
+def test_byte_bound_eviction(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(ShpCacheHelper,'MAX_CACHE_BYTES',2500)
+    shps = [write_shapefile(tmp_path / ('%d.shp' % i),b'shape %d' % i) for i in range(3)]
+    for i, shp in enumerate(shps):
+        cache.putCached(shp,'polygons','x' * 1000)
+    # only the two most recently stored values fit within the byte limit
+    assert cache.getCached(shps[0],'polygons') is None
+    assert cache.getCached(shps[1],'polygons') is not None
+    assert cache.getCached(shps[2],'polygons') is not None
+
+def test_oversized_value_not_stored(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(ShpCacheHelper,'MAX_ENTRY_BYTES',100)
+    shp = write_shapefile(tmp_path / 'a.shp',b'shape')
+    cache.putCached(shp,'small',[1])
+    cache.putCached(shp,'polygons','x' * 1000)
+    assert cache.getCached(shp,'polygons') is None
+    assert cache.getCached(shp,'small') == [1]
@@ -3,17 +3,25 @@
 
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
+from GeoEDF.connector.helper import ShpCacheHelper
 
 import os
+import numpy as np
 from osgeo import gdal,ogr,osr
 
 """ Module for implementing the ShpExtentFilter. This is a straightforward filter that takes 
     a shapefile (path) as input and then reprojects to EPSG:4326 and returns the lat-lon extents
     as a tuple (latmin,latmax,lonmin,lonmax).
+    If the optional split parameter is set to an integer N > 1, the extent is partitioned into N
+    sub-extents using recursive bisection, with each cut placed so that the shapefile's vertices 
+    are divided evenly between the two halves. Each sub-extent is returned as a separate value so 
+    that downstream plugins can process the pieces in parallel with roughly equal work.
+    Computed extents are cached on disk (see ShpCacheHelper) so repeat runs on an unchanged 
+    shapefile do not need to open it with GDAL.
 """
 
 class ShpExtentFilter(GeoEDFPlugin):
-    __optional_params = []
+    __optional_params = ['split']
     __required_params = ['shapefile']
 
     # we use just kwargs since we need to be able to process the list of attributes
@@ -49,6 +57,22 @@ class ShpExtentFilter(GeoEDFPlugin):
     # assume this method is called only when all params have been fully instantiated
     def filter(self):
 
+        # semantic check on split; needs to be a positive integer
+        if self.split is not None:
+            try:
+                self.split = int(self.split)
+            except:
+                raise GeoEDFError('Split parameter for ShpExtentFilter must be a positive integer')
+            if self.split < 1:
+                raise GeoEDFError('Split parameter for ShpExtentFilter must be a positive integer')
+
+        # check the on-disk cache first; the cache entry is specific to the number of splits
+        cache_tag = 'ShpExtentFilter:%d' % (self.split or 1)
+        cached = ShpCacheHelper.getCached(self.shapefile,cache_tag)
+        if cached is not None:
+            self.values.extend(cached['extents'])
+            return
+
         # first load up the shapefile to determine its projection
         driver = ogr.GetDriverByName('ESRI Shapefile')
         inDataset = driver.Open(self.shapefile, 0)
@@ -87,9 +111,92 @@ class ShpExtentFilter(GeoEDFPlugin):
             bottomLeft.Transform(coordTransform)
             topRight.Transform(coordTransform)
 
-            self.values.append('%f,%f,%f,%f' % (bottomLeft.GetY(),topRight.GetY(),bottomLeft.GetX(),topRight.GetX()))
+            extent = (bottomLeft.GetY(),topRight.GetY(),bottomLeft.GetX(),topRight.GetX())
             
         except:
             raise GeoEDFError("Error occurred when trying to reproject extents")
 
+        # no split requested, return the single extent
+        if self.split is None or self.split == 1:
+            extents = ['%f,%f,%f,%f' % extent]
+        else:
+            try:
+                # reprojected vertices of all features are used to balance the partitions
+                vertices = self.layer_vertices(inLayer,coordTransform)
+
+                extents = ['%f,%f,%f,%f' % sub_extent for sub_extent in self.bisect_extent(extent,vertices,self.split)]
+            except:
+                raise GeoEDFError("Error occurred when trying to split extents in ShpExtentFilter")
+
+        # save extents and source projection for future runs
+        ShpCacheHelper.putCached(self.shapefile,cache_tag,{'extents':extents,'srs':inSpatialRef.ExportToWkt()})
+
+        self.values.extend(extents)
+
+    # helper function to collect the (lon,lat) vertices of every feature in the layer
+    # returns a numpy array of shape (num_vertices,2)
+    def layer_vertices(self,inLayer,coordTransform):
+
+        coords = []
+
+        # recursively walk through geometry collections, polygon rings, etc.
+        def collect(geom):
+            if geom.GetGeometryCount() > 0:
+                for i in range(geom.GetGeometryCount()):
+                    collect(geom.GetGeometryRef(i))
+            else:
+                points = geom.GetPoints()
+                if points is not None:
+                    coords.extend([point[:2] for point in points])
+
+        inLayer.ResetReading()
+        for feature in inLayer:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            geom = geom.Clone()
+            geom.Transform(coordTransform)
+            collect(geom)
+        inLayer.ResetReading()
+
+        return np.array(coords,dtype=float).reshape(-1,2)
+
+    # helper function to recursively bisect an extent (latmin,latmax,lonmin,lonmax) into num_parts
+    # sub-extents; the longer side is cut at the quantile of the vertices that falls in proportion
+    # to the number of parts on either side, so each sub-extent holds roughly the same number of vertices
+    def bisect_extent(self,extent,vertices,num_parts):
+
+        if num_parts == 1:
+            return [extent]
+
+        lat_min, lat_max, lon_min, lon_max = extent
+
+        left_parts = num_parts // 2
+        fraction = left_parts / num_parts
+
+        # cut across the longer side of the extent
+        if (lon_max - lon_min) >= (lat_max - lat_min):
+            axis, low, high = 0, lon_min, lon_max
+        else:
+            axis, low, high = 1, lat_min, lat_max
+
+        # fall back to an area based split if there are no vertices in this extent
+        if len(vertices) > 0:
+            cut = np.percentile(vertices[:,axis],fraction*100)
+        else:
+            cut = low + (high - low) * fraction
+        cut = min(max(cut,low),high)
+
+        in_left = vertices[:,axis] < cut
+
+        if axis == 0:
+            left_extent = (lat_min,lat_max,lon_min,cut)
+            right_extent = (lat_min,lat_max,cut,lon_max)
+        else:
+            left_extent = (lat_min,cut,lon_min,lon_max)
+            right_extent = (cut,lat_max,lon_min,lon_max)
+
+        return self.bisect_extent(left_extent,vertices[in_left],left_parts) + \
+               self.bisect_extent(right_extent,vertices[~in_left],num_parts - left_parts)
+
 
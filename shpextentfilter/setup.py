@@ -1,11 +1,12 @@
 from setuptools import setup, find_packages
 
 setup(name='shpextentfilter',
-      version='0.4',
+      version='0.5',
       description='Filter for returning the lat-lon extents of given shapefile',
       url='http://github.com/geoedf/shpextentfilter',
       author='Rajesh Kalyanam',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
+      install_requires=['shpcachehelper'],
       zip_safe=False)
@@ -0,0 +1,10 @@
+import os
+
+import GeoEDF.connector
+
+# ShpCacheHelper is installed from the shpcachehelper package (see its README); when it is not
+# installed, use it from this repository so the tests can run from the shpextentfilter directory
+try:
+    from GeoEDF.connector.helper import ShpCacheHelper
+except ImportError:
+    GeoEDF.connector.__path__.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','shpcachehelper','GeoEDF','connector'))
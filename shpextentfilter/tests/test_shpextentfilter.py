@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('geoedfframework')
+pytest.importorskip('osgeo')
+
+from GeoEDF.connector.filter.ShpExtentFilter import ShpExtentFilter
+
+# run from the shpextentfilter directory with: python -m pytest tests
+
+@pytest.fixture
+def shp_filter():
+    # bisect_extent does not depend on the plugin's parameters
+    return object.__new__(ShpExtentFilter)
+
+def area(extent):
+    lat_min, lat_max, lon_min, lon_max = extent
+    return (lat_max - lat_min) * (lon_max - lon_min)
+
+def count(extent, vertices):
+    lat_min, lat_max, lon_min, lon_max = extent
+    return int(np.count_nonzero((vertices[:,0] >= lon_min) & (vertices[:,0] < lon_max) &
+                                (vertices[:,1] >= lat_min) & (vertices[:,1] < lat_max)))
+
+@pytest.mark.parametrize('num_parts',[1,2,3,4,7])
+def test_parts_tile_extent(shp_filter, num_parts):
+    extent = (40.0,42.0,-88.0,-84.0)
+    vertices = np.random.RandomState(0).uniform([-88.0,40.0],[-84.0,42.0],size=(1000,2))
+    parts = shp_filter.bisect_extent(extent,vertices,num_parts)
+    assert len(parts) == num_parts
+    assert sum(area(part) for part in parts) == pytest.approx(area(extent))
+
+def test_parts_balance_skewed_vertices(shp_filter):
+    extent = (0.0,10.0,0.0,10.0)
+    # most vertices are packed into one corner, an area split would be badly unbalanced
+    rng = np.random.RandomState(1)
+    vertices = np.vstack([rng.uniform([0.0,0.0],[1.0,1.0],size=(900,2)),
+                          rng.uniform([0.0,0.0],[10.0,10.0],size=(100,2))])
+    parts = shp_filter.bisect_extent(extent,vertices,4)
+    counts = [count(part,vertices) for part in parts]
+    assert sum(counts) == len(vertices)
+    assert max(counts) - min(counts) <= 2
+
+def test_no_vertices_splits_by_area(shp_filter):
+    extent = (0.0,2.0,0.0,4.0)
+    parts = shp_filter.bisect_extent(extent,np.zeros((0,2)),2)
+    # the longer (longitude) side is cut in half
+    assert parts == [(0.0,2.0,0.0,2.0),(0.0,2.0,2.0,4.0)]